@@ -0,0 +1,293 @@
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+class LRUCache(object):
+    """
+    A mapping bounded to `size` entries, which evicts the least
+    recently used entry once full. Entries expire `ttl` seconds after
+    they were set, or `negative_ttl` seconds for `None` values, which
+    record that the looked up entity does not exist.
+
+    :param size: the maximum number of entries.
+    :param ttl: seconds for which an entry stays valid.
+    :param negative_ttl: seconds for which a `None` entry stays valid,
+    defaults to `ttl`.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, size, ttl, negative_ttl=None, clock=None):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+
+        self._clock = clock or reactor
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns a `(hit, value)` tuple for the given key.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False, None
+
+        expires, value = entry
+        if expires <= self._clock.seconds():
+            return False, None
+
+        self._entries[key] = entry
+        return True, value
+
+    def set(self, key, value):
+        """
+        Caches the value under the given key.
+        """
+        ttl = self.ttl if value is not None else self.negative_ttl
+
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock.seconds() + ttl, value)
+
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drops the entry cached under the given key, if any.
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        self._entries.clear()
+
+
+class CachingDatabase(object):
+    """
+    A read-through cache in front of an
+    :class:`ircdd.database.IRCDDatabase`.
+
+    The results of `lookupUser`, `lookupUserSession`, `lookupGroup` and
+    `lookupRoutes` are kept in bounded LRU caches, including those for
+    entities which do not exist. Entries are invalidated by writes made
+    through this instance, by changefeeds over the tables they are built
+    from (which catch the writes made by other nodes), and at the latest
+    when their TTL runs out. Every other attribute is looked up on
+    the wrapped database.
+
+    Cached documents are shared between callers and must not be
+    modified.
+
+    Reports the `cache.<name>.hits`, `cache.<name>.misses` and
+    `cache.<name>.invalidations` counters and the `cache.<name>.size`
+    gauge for the `users`, `sessions`, `groups` and `routes` caches.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` to wrap.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param size: the maximum number of entries of each cache.
+    :param ttl: seconds for which users and groups stay cached.
+    :param session_ttl: seconds for which sessions and routes stay cached.
+    :param negative_ttl: seconds for which missing entities stay cached.
+    :param retry_delay: seconds to wait before restarting a failed
+    invalidation feed.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, metrics, size=10000, ttl=30.0, session_ttl=5.0,
+                 negative_ttl=5.0, retry_delay=5.0, clock=None):
+        self.db = db
+        self.metrics = metrics
+        self.retry_delay = retry_delay
+
+        self._clock = clock or reactor
+        self.caches = {
+            "users": LRUCache(size, ttl, negative_ttl, self._clock),
+            "sessions": LRUCache(size, session_ttl, negative_ttl,
+                                 self._clock),
+            "groups": LRUCache(size, ttl, negative_ttl, self._clock),
+            "routes": LRUCache(size, session_ttl, negative_ttl, self._clock)
+        }
+
+        # Maps each table to the caches its changes invalidate,
+        # along with the field holding the cache key.
+        self.invalidations = {
+            db.USERS_TABLE: [("users", "id")],
+            db.USER_SESSIONS_TABLE: [("sessions", "id"), ("users", "id"),
+                                     ("routes", "id")],
+            db.GROUPS_TABLE: [("groups", "id")],
+            db.GROUP_MEMBERS_TABLE: [("groups", "group"), ("users", "user"),
+                                     ("routes", "group")]
+        }
+
+        self._fetching = {}
+        self._retries = {}
+        self._running = False
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def start(self):
+        """
+        Starts following the invalidation feeds.
+        """
+        self._running = True
+        for table in sorted(self.invalidations):
+            self._follow(table)
+
+    def _follow(self, table):
+        self._retries.pop(table, None)
+        if not self._running:
+            return
+
+        targets = self.invalidations[table]
+        fields = sorted(set(field for (_, field) in targets))
+
+        def invalidate(docs):
+            for doc in docs:
+                for (name, field) in targets:
+                    self.invalidate(name, doc[field])
+
+        def cbEnded(result):
+            # Changes may have been missed while the feed was down.
+            for (name, _) in targets:
+                self.caches[name].clear()
+
+            if self._running:
+                self._retries[table] = self._clock.callLater(
+                    self.retry_delay, self._follow, table)
+            return result
+
+        d = self.db.observeKeys(table, fields)
+        d.addCallback(self.db.follow, invalidate)
+        d.addErrback(log.err, "The %s invalidation feed failed" % table)
+        d.addCallback(cbEnded)
+
+    def close(self):
+        """
+        Stops following the invalidation feeds and closes the
+        wrapped database.
+        """
+        self._running = False
+        for delayed in self._retries.values():
+            delayed.cancel()
+        self._retries.clear()
+
+        return self.db.close()
+
+    def invalidate(self, name, key):
+        """
+        Drops the entry for key from the named cache, and keeps
+        any lookup of it which is in progress from caching its result.
+        """
+        self.caches[name].invalidate(key)
+        self._fetching.pop((name, key), None)
+        self.metrics.increment("cache.%s.invalidations" % name)
+
+    def _lookup(self, name, key, fetch):
+        cache = self.caches[name]
+
+        hit, value = cache.get(key)
+        if hit:
+            self.metrics.increment("cache.%s.hits" % name)
+            return defer.succeed(value)
+
+        self.metrics.increment("cache.%s.misses" % name)
+
+        token = object()
+        self._fetching[(name, key)] = token
+
+        def cbFetched(value):
+            if self._fetching.get((name, key)) is token:
+                del self._fetching[(name, key)]
+                cache.set(key, value)
+                self.metrics.gauge("cache.%s.size" % name, len(cache))
+            return value
+
+        def ebFetched(err):
+            if self._fetching.get((name, key)) is token:
+                del self._fetching[(name, key)]
+            return err
+
+        return fetch(key).addCallbacks(cbFetched, ebFetched)
+
+    def _write(self, d, *keys):
+        for (name, key) in keys:
+            self.invalidate(name, key)
+
+        def cbWritten(result):
+            for (name, key) in keys:
+                self.invalidate(name, key)
+            return result
+
+        return d.addBoth(cbWritten)
+
+    def lookupUser(self, nickname):
+        return self._lookup("users", nickname, self.db.lookupUser)
+
+    def lookupUserSession(self, nickname):
+        return self._lookup("sessions", nickname, self.db.lookupUserSession)
+
+    def lookupGroup(self, name):
+        return self._lookup("groups", name, self.db.lookupGroup)
+
+    def lookupRoutes(self, name):
+        return self._lookup("routes", name, self.db.lookupRoutes)
+
+    def createUser(self, nickname, *args, **kwargs):
+        return self._write(self.db.createUser(nickname, *args, **kwargs),
+                           ("users", nickname))
+
+    def registerUser(self, nickname, email, password):
+        return self._write(self.db.registerUser(nickname, email, password),
+                           ("users", nickname))
+
+    def deleteUser(self, nickname):
+        return self._write(self.db.deleteUser(nickname),
+                           ("users", nickname))
+
+    def setPermission(self, nickname, channel, permission):
+        return self._write(self.db.setPermission(nickname, channel,
+                                                 permission),
+                           ("users", nickname))
+
+    def startUserSession(self, nickname, node):
+        return self._write(self.db.startUserSession(nickname, node),
+                           ("sessions", nickname), ("users", nickname),
+                           ("routes", nickname))
+
+    def touchUserSession(self, nickname):
+        return self._write(self.db.touchUserSession(nickname),
+                           ("sessions", nickname), ("users", nickname))
+
+    def removeUserSession(self, nickname):
+        return self._write(self.db.removeUserSession(nickname),
+                           ("sessions", nickname), ("users", nickname),
+                           ("routes", nickname))
+
+    def addUserToGroup(self, nickname, group, node):
+        return self._write(self.db.addUserToGroup(nickname, group, node),
+                           ("users", nickname), ("groups", group),
+                           ("routes", group))
+
+    def removeUserFromGroup(self, nickname, group):
+        return self._write(self.db.removeUserFromGroup(nickname, group),
+                           ("users", nickname), ("groups", group),
+                           ("routes", group))
+
+    def createGroup(self, name, channelType):
+        return self._write(self.db.createGroup(name, channelType),
+                           ("groups", name))
+
+    def deleteGroup(self, name):
+        return self._write(self.db.deleteGroup(name), ("groups", name))
+
+    def setGroupTopic(self, name, topic, author):
+        return self._write(self.db.setGroupTopic(name, topic, author),
+                           ("groups", name))
@@ -3,11 +3,21 @@ import yaml
 
 from twisted import copyright
 from twisted.cred import portal
+from twisted.python import log
 
-from ircdd.realm import ShardedRealm
+from ircdd.realm import GroupEvictor, ShardedRealm
 from ircdd import cred
-from ircdd.remote import RemoteReadWriter
+from ircdd.remote import ChannelSweeper, RemoteReadWriter, TopicSweeper
+from ircdd.routing import NodeRouter
+from ircdd.transport import LoopbackHub, LoopbackTransport
 from ircdd import database
+from ircdd.cache import CachingDatabase
+from ircdd.dispatcher import FeedDispatcher
+from ircdd.flow import FlowController
+from ircdd.heartbeat import HeartbeatWriter
+from ircdd.listing import GroupSizeReconciler, ListSnapshot
+from ircdd.mesh import MeshTransport
+from ircdd.metrics import Metrics
 
 
 class ConfigStore(dict):
@@ -55,9 +65,68 @@ def makeContext(config):
     cred_checker = cred.DatabaseCredentialsChecker(ctx)
     ctx['portal'] = portal.Portal(ctx['realm'], [cred_checker])
 
-    ctx["db"] = database.IRCDDatabase(db=ctx["db"],
-                                      host=ctx['rdb_host'],
-                                      port=ctx['rdb_port'])
+    ctx['metrics'] = Metrics()
+
+    db = database.IRCDDatabase(
+        db=ctx["db"],
+        host=ctx['rdb_host'],
+        port=ctx['rdb_port'],
+        pool_size=int(ctx.get('rdb_pool_size', 10)),
+        feed_connections=int(ctx.get('rdb_feed_connections', 4)),
+        idle_timeout=float(ctx.get('rdb_idle_timeout', 60.0)),
+        ping_interval=float(ctx.get('rdb_ping_interval', 30.0)),
+        lease_timeout=float(ctx.get('lease_timeout', 30.0)))
+
+    ctx["db"] = CachingDatabase(
+        db,
+        ctx['metrics'],
+        size=int(ctx.get('cache_size', 10000)),
+        ttl=float(ctx.get('cache_ttl', 30.0)),
+        session_ttl=float(ctx.get('cache_session_ttl', 5.0)),
+        negative_ttl=float(ctx.get('cache_negative_ttl', 5.0)))
+
+    ctx["db"].createIndexes().addErrback(log.err,
+                                         "Failed to create the indexes")
+
+    ctx["db"].start()
+
+    ctx['feeds'] = FeedDispatcher(ctx['db'])
+
+    mesh_address = None
+    if ctx.get('message_transport') == "mesh":
+        mesh_address = "%s:%s" % (ctx.get('mesh_host') or ctx['hostname'],
+                                  ctx.get('mesh_port', 5800))
+
+    ctx['heartbeats'] = HeartbeatWriter(
+        ctx['db'],
+        ctx['metrics'],
+        ctx['hostname'],
+        interval=float(ctx.get('heartbeat_interval', 10.0)),
+        mesh_address=mesh_address)
+
+    ctx['list_snapshot'] = None
+    if float(ctx.get('list_snapshot_interval', 30.0)) > 0:
+        ctx['list_snapshot'] = ListSnapshot(
+            ctx['db'],
+            ctx['metrics'],
+            interval=float(ctx.get('list_snapshot_interval', 30.0)),
+            max_age=float(ctx.get('list_max_age', 60.0)),
+            reply_page_size=int(ctx.get('list_page_size', 100)))
+
+    ctx['size_reconciler'] = None
+    if float(ctx.get('group_size_reconcile_interval', 300.0)) > 0:
+        ctx['size_reconciler'] = GroupSizeReconciler(
+            ctx['db'],
+            ctx['metrics'],
+            interval=float(ctx.get('group_size_reconcile_interval', 300.0)))
+
+    ctx['group_evictor'] = None
+    if float(ctx.get('group_idle_timeout', 300.0)) > 0:
+        ctx['group_evictor'] = GroupEvictor(
+            ctx['realm'],
+            ctx['metrics'],
+            idle_timeout=float(ctx.get('group_idle_timeout', 300.0)),
+            max_groups=int(ctx.get('max_local_groups', 10000)))
 
     ctx['server_info'] = dict(
         serviceName=ctx['realm'].name,
@@ -65,8 +134,78 @@ def makeContext(config):
         creationDate=ctime()
         )
 
-    ctx['remote_rw'] = RemoteReadWriter(ctx['nsqd_tcp_address'],
-                                        ctx['lookupd_http_address'],
-                                        ctx['hostname'])
+    # The loopback transport connects the nodes which share its hub
+    # within this process, or serves a single node without a broker.
+    ctx['flow'] = None
+    if ctx.get('message_transport') == "loopback":
+        ctx['remote_rw'] = LoopbackTransport(
+            ctx.get('loopback_hub') or LoopbackHub(),
+            ctx['hostname'])
+    else:
+        if int(ctx.get('nsq_max_in_flight', 100)) > 0:
+            def clientTransports():
+                for user in ctx['realm'].users.values():
+                    transport = getattr(user.mind, "transport", None)
+                    if transport is not None:
+                        yield transport
+
+            ctx['flow'] = FlowController(
+                ctx['metrics'],
+                clients=clientTransports,
+                max_in_flight=int(ctx.get('nsq_max_in_flight', 100)),
+                limits=ctx.get('nsq_in_flight_limits'),
+                max_lag=float(ctx.get('max_reactor_lag', 0.1)))
+
+        ctx['remote_rw'] = RemoteReadWriter(
+            ctx['nsqd_tcp_address'],
+            ctx['lookupd_http_address'],
+            ctx['hostname'],
+            batch_window=float(ctx.get('nsq_batch_window', 0.0)),
+            batch_size=int(ctx.get('nsq_batch_size', 100)),
+            metrics=ctx['metrics'],
+            binary_envelopes=ctx.get('nsq_envelope') == "binary",
+            unsubscribe_grace=float(ctx.get('nsq_unsubscribe_grace', 10.0)),
+            ephemeral_channels=bool(ctx.get('nsq_ephemeral_channels')),
+            flow=ctx['flow'])
+
+    ctx['channel_sweeper'] = None
+    if (ctx.get('message_transport') != "loopback" and
+            float(ctx.get('nsq_channel_sweep_interval', 600.0)) > 0):
+        ctx['channel_sweeper'] = ChannelSweeper(
+            ctx['db'],
+            ctx['lookupd_http_address'],
+            ctx['hostname'],
+            ctx['metrics'],
+            interval=float(ctx.get('nsq_channel_sweep_interval', 600.0)))
+
+    ctx['topic_sweeper'] = None
+    if (ctx.get('message_transport') != "loopback" and
+            float(ctx.get('nsq_topic_sweep_interval', 3600.0)) > 0):
+        ctx['topic_sweeper'] = TopicSweeper(
+            ctx['db'],
+            ctx['lookupd_http_address'],
+            ctx['hostname'],
+            ctx['metrics'],
+            interval=float(ctx.get('nsq_topic_sweep_interval', 3600.0)),
+            retention=float(ctx.get('nsq_topic_retention', 86400.0)),
+            limit=int(ctx.get('nsq_topic_sweep_limit', 100)))
+
+    # The mesh carries the messages to node inboxes over direct
+    # connections, falling back to NSQ, so it implies node routing.
+    ctx['mesh'] = None
+    if mesh_address is not None:
+        ctx['mesh'] = ctx['remote_rw'] = MeshTransport(
+            ctx['remote_rw'],
+            ctx['db'],
+            ctx['hostname'],
+            ctx['metrics'],
+            connect_timeout=float(ctx.get('mesh_connect_timeout', 1.0)))
+
+    # In node routing mode every node consumes a single inbox topic
+    # instead of one topic per local user and group.
+    if ctx.get('message_routing') == "node" or ctx['mesh'] is not None:
+        ctx['remote_rw'] = NodeRouter(ctx['remote_rw'],
+                                      ctx['db'],
+                                      ctx['hostname'])
 
     return ctx
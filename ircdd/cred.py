@@ -21,7 +21,7 @@ class DatabaseCredentialsChecker:
         self.ctx = ctx
 
     def addUser(self, username):
-        self.ctx["db"].createUser(username)
+        return self.ctx["db"].createUser(username)
 
     def _cbPasswordMatch(self, matched, username):
         if matched:
@@ -42,13 +42,11 @@ class DatabaseCredentialsChecker:
         it is created and returned. All other cases result in a failure.
         """
 
-        user = self.ctx["db"].lookupUser(credentials.username)
-        if user:
-            session = self.ctx.db.lookupUserSession(credentials.username)
+        def cbSession(session, user):
             # If the session is active, fail - another user is connected
             # under these credentials. TODO: Add TTL
             if session and session["active"]:
-                return defer.fail(ewords.AlreadyLoggedIn())
+                return failure.Failure(ewords.AlreadyLoggedIn())
 
             # Registered user, session expired -> check password
             if user["registered"]:
@@ -61,12 +59,20 @@ class DatabaseCredentialsChecker:
             elif not user["registered"]:
                 return str(credentials.username)
             else:
-                defer.fail(error.UnauthorizedLogin())
+                return failure.Failure(error.UnauthorizedLogin())
 
-        # User entry not found, check if we can create an anonymous
-        elif self.ctx.user_on_request:
-            # this may need to be changed if we use encrypted credentials
-            self.addUser(credentials.username)
-            return str(credentials.username)
-        else:
-            return defer.fail(error.UnauthorizedLogin())
+        def cbUser(user):
+            if user:
+                d = self.ctx.db.lookupUserSession(credentials.username)
+                return d.addCallback(cbSession, user)
+
+            # User entry not found, check if we can create an anonymous
+            elif self.ctx.user_on_request:
+                # this may need to be changed if we use encrypted credentials
+                d = self.addUser(credentials.username)
+                return d.addCallback(lambda _: str(credentials.username))
+            else:
+                return failure.Failure(error.UnauthorizedLogin())
+
+        return self.ctx["db"].lookupUser(credentials.username).addCallback(
+            cbUser)
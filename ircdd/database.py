@@ -1,28 +1,503 @@
 import re
+import weakref
+from collections import Counter
+
 import rethinkdb as r
-from twisted.python import log
+from rethinkdb.net import DefaultConnection, DefaultCursor
+from rethinkdb.errors import ReqlCursorEmpty, ReqlDriverError
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, log
+
+
+def consumeFeed(changeset, callback):
+    """
+    Delivers every change read from a changefeed cursor to the given
+    callback on the reactor thread.
+    Cursors obtained through RethinkDB's twisted loop type are drained
+    on the reactor itself. Blocking cursors (the default loop type) are
+    drained from the reactor's threadpool instead.
+    Returns a Deferred which fires once the feed is exhausted or closed.
+
+    :param changeset: the cursor returned by a `changes()` query.
+    :param callback: a callable which takes a single change document.
+    """
+    if isinstance(changeset, DefaultCursor):
+        def drain():
+            for change in changeset:
+                reactor.callFromThread(callback, change)
+
+        return threads.deferToThread(drain)
+
+    @defer.inlineCallbacks
+    def drain():
+        while True:
+            try:
+                change = yield changeset.next()
+            except (ReqlCursorEmpty, ReqlDriverError):
+                break
+            callback(change)
+
+    return drain()
+
+
+def maskToRegex(masks):
+    """
+    Translates IRC wildcard masks, where `*` matches any sequence of
+    characters and `?` any single character, into one case-insensitive
+    regular expression which matches names matching any of the masks.
+    The result is suitable for ReQL's `match`.
+
+    :param masks: a list of masks.
+    """
+    def translate(mask):
+        return "".join(".*" if c == "*" else
+                       "." if c == "?" else
+                       "\\" + c if c in "\\.^$|+()[]{}" else
+                       c for c in mask)
+
+    return "(?i)^(?:%s)$" % "|".join(translate(mask) for mask in masks)
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of RethinkDB connections.
+
+    Query connections are opened lazily, up to `size` of them, and are
+    checked out for the duration of a single query. Queries issued while
+    every connection is busy wait for one to be checked back in.
+    Idle connections are pinged every `ping_interval` seconds; dead ones
+    are dropped and transparently replaced on the next checkout, and
+    those left unused for longer than `idle_timeout` are closed.
+
+    Changefeeds are multiplexed over at most `feed_connections`
+    connections, each carrying about `feeds_per_connection` feeds.
+    Blocking connections (the default loop type) cannot multiplex
+    feeds, so each feed then gets a connection of its own.
+
+    :param db: the name of the database to connect to.
+    :param host: the RethinkDB host.
+    :param port: the RethinkDB client port.
+    :param size: the maximum number of query connections.
+    :param feed_connections: the maximum number of feed connections.
+    :param feeds_per_connection: the number of feeds a feed connection
+    should carry before another one is opened.
+    :param idle_timeout: seconds after which idle connections are closed.
+    :param ping_interval: seconds between liveness checks.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, host, port, size=10, feed_connections=4,
+                 feeds_per_connection=64, idle_timeout=60.0,
+                 ping_interval=30.0, clock=None):
+        assert size > 0
+        assert feed_connections > 0
+
+        self.db = db
+        self.host = host
+        self.port = port
+
+        self.size = size
+        self.feed_connections = feed_connections
+        self.feeds_per_connection = feeds_per_connection
+        self.idle_timeout = idle_timeout
+
+        self._clock = clock or reactor
+        self._closed = False
+
+        # (connection, last checkin time) pairs, most recent last
+        self._idle = []
+        self._busy = set()
+        self._opening = 0
+        self._waiting = []
+
+        # feed connection -> number of feeds it carries
+        self._feeds = {}
+        self._feeds_opening = None
+        # changefeed cursor -> the feed connection it was started on
+        self._cursors = weakref.WeakKeyDictionary()
+
+        self._maintenance = task.LoopingCall(self.maintain)
+        self._maintenance.clock = self._clock
+        self._maintenance.start(ping_interval, now=False)
+
+    def _connect(self):
+        return defer.maybeDeferred(r.connect,
+                                   db=self.db,
+                                   host=self.host,
+                                   port=self.port)
+
+    def _close(self, conn):
+        try:
+            d = defer.maybeDeferred(conn.close, noreply_wait=False)
+        except Exception:
+            log.err()
+        else:
+            d.addErrback(lambda _: None)
+
+    def connections(self):
+        """
+        Returns the number of query connections which are open or
+        being opened.
+        """
+        return len(self._idle) + len(self._busy) + self._opening
+
+    def _grow(self):
+        """
+        Opens a new query connection and hands it to the
+        first waiting checkout.
+        """
+        def cbConnected(conn):
+            self._opening -= 1
+            self._busy.add(conn)
+            self.checkin(conn)
+
+        def ebConnected(err):
+            self._opening -= 1
+            log.err(err, "Could not connect to RethinkDB at %s:%s" %
+                    (self.host, self.port))
+
+            # Fail the oldest checkout rather than leaving it hanging
+            # until some other connection frees up.
+            if self._waiting:
+                self._waiting.pop(0).errback(err)
+
+        self._opening += 1
+        self._connect().addCallbacks(cbConnected, ebConnected)
+
+    def checkout(self):
+        """
+        Returns a Deferred which fires with a connection reserved
+        for the caller until it is handed back through `checkin`.
+        """
+        if self._closed:
+            return defer.fail(ReqlDriverError("Connection pool is closed."))
+
+        while self._idle:
+            conn, _ = self._idle.pop()
+            if conn.is_open():
+                self._busy.add(conn)
+                return defer.succeed(conn)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+
+        if self.connections() < self.size:
+            self._grow()
+        return d
+
+    def checkin(self, conn):
+        """
+        Returns a connection obtained through `checkout` to the pool.
+        Dead connections are dropped and replaced if some checkout
+        is waiting for one.
+        """
+        self._busy.discard(conn)
+
+        if self._closed or not conn.is_open():
+            self._close(conn)
+            if self._waiting and self.connections() < self.size:
+                self._grow()
+        elif self._waiting:
+            self._busy.add(conn)
+            self._waiting.pop(0).callback(conn)
+        else:
+            self._idle.append((conn, self._clock.seconds()))
+
+    def discard(self, conn):
+        """
+        Closes a checked out connection which is known to be
+        broken instead of returning it to the pool.
+        """
+        self._busy.discard(conn)
+        self._close(conn)
+
+        if self._waiting and self.connections() < self.size:
+            self._grow()
+
+    def run(self, query):
+        """
+        Runs the query on a pooled connection.
+        Returns a Deferred which fires with the query's result.
+        """
+        def release(result, conn):
+            if isinstance(result, failure.Failure) and \
+                    result.check(ReqlDriverError):
+                self.discard(conn)
+            else:
+                self.checkin(conn)
+            return result
+
+        def cbCheckout(conn):
+            d = defer.maybeDeferred(query.run, conn)
+            return d.addBoth(release, conn)
+
+        return self.checkout().addCallback(cbCheckout)
+
+    def _feedConnection(self):
+        """
+        Returns a Deferred which fires with the connection that
+        the next changefeed should be started on.
+        """
+        if self._closed:
+            return defer.fail(ReqlDriverError("Connection pool is closed."))
+
+        for conn in self._feeds.keys():
+            if not conn.is_open() and not self._feeds[conn]:
+                del self._feeds[conn]
+
+        live = [(count, conn) for (conn, count) in self._feeds.iteritems()
+                if conn.is_open()]
+        multiplexed = r.net.connection_type is not DefaultConnection
+
+        if multiplexed and live:
+            count, conn = min(live)
+            if count < self.feeds_per_connection or \
+                    len(live) >= self.feed_connections:
+                return defer.succeed(conn)
+
+        d = defer.Deferred()
+        if multiplexed and self._feeds_opening is not None:
+            self._feeds_opening.append(d)
+            return d
+
+        def cbConnected(conn):
+            waiting, self._feeds_opening = self._feeds_opening, None
+            self._feeds[conn] = 0
+            for waiter in waiting:
+                waiter.callback(conn)
+
+        def ebConnected(err):
+            waiting, self._feeds_opening = self._feeds_opening, None
+            log.err(err, "Could not connect to RethinkDB at %s:%s" %
+                    (self.host, self.port))
+            for waiter in waiting:
+                waiter.errback(err)
+
+        self._feeds_opening = [d]
+        self._connect().addCallbacks(cbConnected, ebConnected)
+        return d
+
+    def observe(self, query):
+        """
+        Starts the changefeed query on a feed connection.
+        Returns a Deferred which fires with the feed's cursor.
+        The feed must be handed back through `finish` once
+        it is no longer consumed.
+        """
+        def cbConnection(conn):
+            self._feeds[conn] = self._feeds.get(conn, 0) + 1
+
+            def cbRun(cursor):
+                self._cursors[cursor] = conn
+                return cursor
+
+            def ebRun(err):
+                self.release(conn)
+                return err
+
+            d = defer.maybeDeferred(query.run, conn)
+            return d.addCallbacks(cbRun, ebRun)
+
+        return self._feedConnection().addCallback(cbConnection)
+
+    def finish(self, cursor):
+        """
+        Signals that the feed of a cursor obtained through `observe`
+        has finished, releasing the connection it was started on.
+        """
+        conn = self._cursors.pop(cursor, None)
+        if conn is not None:
+            self.release(conn)
+
+    def release(self, conn):
+        """
+        Signals that one of the feeds carried by the connection
+        has finished. Blocking feed connections are closed as soon
+        as their feed finishes.
+        """
+        count = self._feeds.get(conn, 0) - 1
+        if count > 0:
+            self._feeds[conn] = count
+        elif isinstance(conn, DefaultConnection) or not conn.is_open():
+            self._feeds.pop(conn, None)
+            self._close(conn)
+        elif conn in self._feeds:
+            self._feeds[conn] = 0
+
+    def maintain(self):
+        """
+        Closes query connections that have been idle for too long and
+        pings the remaining idle and feed connections, dropping any
+        which fail to respond.
+        """
+        now = self._clock.seconds()
+
+        idle, self._idle = self._idle, []
+        for (conn, last_used) in idle:
+            if now - last_used > self.idle_timeout or not conn.is_open():
+                self._close(conn)
+            else:
+                self._busy.add(conn)
+                self._ping(conn).addCallback(self._cbPing, conn, last_used)
+
+        for (conn, count) in self._feeds.items():
+            if not count or not conn.is_open():
+                # Unused feed connections only take up sockets. The
+                # feeds on a dead one error out and are restarted by
+                # their consumers.
+                del self._feeds[conn]
+                self._close(conn)
+            else:
+                self._ping(conn).addCallback(self._cbPingFeed, conn)
+
+    def _ping(self, conn):
+        d = defer.maybeDeferred(r.expr(1).run, conn)
+        d.addCallbacks(lambda _: True, lambda _: False)
+        return d
+
+    def _cbPing(self, alive, conn, last_used):
+        if alive and (self._waiting or self._closed):
+            self.checkin(conn)
+        elif alive:
+            # Pings do not count as use of the connection.
+            self._busy.discard(conn)
+            self._idle.insert(0, (conn, last_used))
+        else:
+            log.msg("Dropping dead RethinkDB connection to %s:%s" %
+                    (self.host, self.port))
+            self.discard(conn)
+
+    def _cbPingFeed(self, alive, conn):
+        if not alive and conn in self._feeds:
+            log.msg("Dropping dead RethinkDB feed connection to %s:%s" %
+                    (self.host, self.port))
+            del self._feeds[conn]
+            self._close(conn)
+
+    def close(self):
+        """
+        Closes every connection in the pool and fails
+        any waiting checkouts.
+        """
+        self._closed = True
+        if self._maintenance.running:
+            self._maintenance.stop()
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(ReqlDriverError("Connection pool is closed."))
+
+        idle, self._idle = self._idle, []
+        for (conn, _) in idle:
+            self._close(conn)
+
+        feeds, self._feeds = self._feeds, {}
+        for conn in feeds:
+            self._close(conn)
 
 
 class IRCDDatabase:
     """
     Wrapper class for database actions, so that the IRC server
     does not have to know anything about how rethinkDB works
-    in order to use it
+    in order to use it.
+
+    Every query method returns a Deferred. When RethinkDB's loop
+    type is set to `twisted` the queries never block the reactor;
+    with the default loop type the Deferreds fire synchronously.
+    Queries and changefeeds run on connections checked out of a
+    :class:`ConnectionPool`.
+
+    Presence is tracked per node rather than per user: each node
+    renews a lease document, user sessions and group memberships
+    record the node that owns them, and they count as active only
+    while that node's lease is valid.
+
+    Group membership is stored as one row per (group, user) pair,
+    so a member joining or leaving only touches its own row. Each
+    group document also keeps a count of its members, which those
+    writes and the expiry of nodes update, so that reading a group's
+    size does not read its members. Counts may drift, for instance
+    while a node's lease is expired but its memberships are not yet
+    removed; :meth:`reconcileGroupSizes` corrects them.
     """
 
     USERS_TABLE = 'users'
     GROUPS_TABLE = 'groups'
     USER_SESSIONS_TABLE = 'user_sessions'
-    GROUP_STATES_TABLE = 'group_states'
+    GROUP_MEMBERS_TABLE = 'group_members'
+    NODES_TABLE = 'nodes'
+
+    INDEXES = {
+        GROUP_MEMBERS_TABLE: ["group", "user"]
+    }
 
-    def __init__(self, db="ircdd", host="127.0.0.1", port=28015):
+    def __init__(self, db="ircdd", host="127.0.0.1", port=28015,
+                 pool_size=10, feed_connections=4, idle_timeout=60.0,
+                 ping_interval=30.0, lease_timeout=30.0):
         self.rdb_host = host
         self.rdb_port = port
         self.db = db
-        self.conn = r.connect(db=self.db,
-                              host=self.rdb_host,
-                              port=self.rdb_port)
+        self.lease_timeout = lease_timeout
+
+        self.pool = ConnectionPool(self.db, self.rdb_host, self.rdb_port,
+                                   size=pool_size,
+                                   feed_connections=feed_connections,
+                                   idle_timeout=idle_timeout,
+                                   ping_interval=ping_interval)
+
+    def close(self):
+        """
+        Closes all the connections held by this instance.
+        """
+        self.pool.close()
+
+    @defer.inlineCallbacks
+    def createIndexes(self):
+        """
+        Creates the secondary indexes listed in `INDEXES` which do
+        not exist yet, and waits for them to become ready.
+        Returns a Deferred which fires with the list of created indexes.
+        """
+        created = []
+        for table, indexes in sorted(self.INDEXES.items()):
+            existing = yield self._run(r.table(table).index_list())
+            for index in indexes:
+                if index not in existing:
+                    yield self._run(r.table(table).index_create(index))
+                    created.append((table, index))
+            yield self._run(r.table(table).index_wait())
 
+        defer.returnValue(created)
+
+    def _run(self, query):
+        """
+        Runs the query on a pooled connection.
+        Returns a Deferred which fires with the query's result.
+        """
+        return self.pool.run(query)
+
+    def _observe(self, query):
+        """
+        Starts a changefeed query on one of the pool's feed connections.
+        Returns a Deferred which fires with the feed's cursor.
+        """
+        return self.pool.observe(query)
+
+    def follow(self, changeset, callback):
+        """
+        Feeds every change of a cursor obtained from one of the
+        `observe*` methods into the callback, and hands the feed's
+        connection back to the pool once the feed ends.
+        Returns a Deferred which fires when the feed ends.
+        """
+        def cbDone(result):
+            self.pool.finish(changeset)
+            return result
+
+        return consumeFeed(changeset, callback).addBoth(cbDone)
+
+    @defer.inlineCallbacks
     def createUser(self, nickname,
                    email="", password="", registered=False, permissions={}):
         """
@@ -33,190 +508,394 @@ class IRCDDatabase:
         contains channel name (string) and permissions (string))
         """
 
-        exists = r.table(self.USERS_TABLE).get(
+        exists = yield self._run(r.table(self.USERS_TABLE).get(
             nickname
-        ).run(self.conn)
+        ))
 
         if not exists:
-            r.table(self.USERS_TABLE).insert({
+            yield self._run(r.table(self.USERS_TABLE).insert({
                 "id": nickname,
                 "nickname": nickname,
                 "email": email,
                 "password": password,
                 "registered": registered,
                 "permissions": permissions
-            }).run(self.conn)
+            }))
         else:
             log.err("User already exists: %s" % nickname)
 
-    def heartbeatUserSession(self, nickname):
-        session = r.table(self.USER_SESSIONS_TABLE).get(
-            nickname
-        ).run(self.conn)
+    def _nodeAlive(self, node):
+        """
+        Returns a ReQL expression which is true while the lease of
+        the given node is valid.
 
-        if not session:
-            return r.table(self.USER_SESSIONS_TABLE).insert({
-                "id": nickname,
-                "last_heartbeat": r.now(),
-                "last_message": r.now(),
-                "session_start": r.now()
-            }).run(self.conn)
-        else:
-            return r.table(self.USER_SESSIONS_TABLE).get(nickname).update({
-                "last_heartbeat": r.now()
-            }).run(self.conn)
+        :param node: a ReQL expression which evaluates to a node id.
+        """
+        return r.now().sub(
+            r.table(self.NODES_TABLE).get(node)["heartbeat"]
+        ).lt(self.lease_timeout).default(False)
+
+    def renewNodeLease(self, node, mesh_address=None):
+        """
+        Creates or renews the lease of the given node, keeping the
+        sessions and memberships it owns active.
+
+        :param mesh_address: the `host:port` address on which the node
+        accepts connections from its peers, if it does.
+        """
+        lease = {
+            "id": node,
+            "heartbeat": r.now()
+        }
+        if mesh_address is not None:
+            lease["mesh"] = mesh_address
+
+        return self._run(r.table(self.NODES_TABLE).insert(
+            lease, conflict="update"))
+
+    def listLiveNodes(self):
+        """
+        Returns the ids of the nodes whose lease is valid.
+        """
+        return self._run(r.table(self.NODES_TABLE).filter(
+            lambda node: r.now().sub(node["heartbeat"]).lt(self.lease_timeout)
+        )["id"].coerce_to("array"))
+
+    def listActiveTopics(self):
+        """
+        Returns the names of the users with an active session and
+        of the groups with live members, which are those whose
+        message topics are in use.
+        """
+        users = r.table(self.USER_SESSIONS_TABLE).filter(
+            lambda session: self._nodeAlive(session["node"]))["id"]
+        groups = r.table(self.GROUP_MEMBERS_TABLE).filter(
+            lambda member: self._nodeAlive(member["node"]))["group"]
+
+        return self._run(users.union(groups).distinct())
+
+    def listKnownTopics(self, topics):
+        """
+        Returns those of the given topic names which name a user or
+        a group, and so are message topics of this server.
+        """
+        if not topics:
+            return defer.succeed([])
+
+        names = r.args(list(topics))
+        users = r.table(self.USERS_TABLE).get_all(names)["id"]
+        groups = r.table(self.GROUPS_TABLE).get_all(names)["id"]
+        return self._run(users.union(groups).distinct())
+
+    def lookupNodeAddress(self, node):
+        """
+        Returns the mesh address of the given node, or None if the
+        node does not advertise one or its lease has expired.
+        """
+        return self._run(r.branch(
+            self._nodeAlive(node),
+            r.table(self.NODES_TABLE).get(node)["mesh"].default(None),
+            None))
+
+    def removeNodeLease(self, node):
+        """
+        Drops the lease of the given node, which immediately
+        deactivates every session and membership it owns.
+        """
+        return self._run(r.table(self.NODES_TABLE).get(node).delete())
+
+    @defer.inlineCallbacks
+    def expireNodes(self):
+        """
+        Removes the sessions and group memberships owned by nodes whose
+        lease has expired, along with the leases themselves.
+        Returns a Deferred which fires with the list of expired node ids.
+        """
+        def expired(node):
+            return r.now().sub(node["heartbeat"]).ge(self.lease_timeout)
+
+        nodes = yield self._run(r.table(self.NODES_TABLE).filter(
+            expired
+        )["id"].coerce_to("array"))
+
+        if nodes:
+            yield self._run(r.table(self.USER_SESSIONS_TABLE).filter(
+                lambda session: r.expr(nodes).contains(session["node"])
+            ).delete())
+
+            deleted = yield self._run(r.table(
+                self.GROUP_MEMBERS_TABLE
+            ).filter(
+                lambda member: r.expr(nodes).contains(member["node"])
+            ).delete(return_changes=True))
+
+            # Only the rows deleted by this call are counted, so that
+            # nodes expiring the same leases at once count them once.
+            departed = Counter(change["old_val"]["group"]
+                               for change in deleted.get("changes", []))
+            for (group, count) in departed.iteritems():
+                yield self._run(self._changeGroupSize(group, -count))
+
+            yield self._run(r.table(self.NODES_TABLE).get_all(
+                r.args(nodes)
+            ).filter(expired).delete())
+
+        defer.returnValue(nodes)
+
+    def startUserSession(self, nickname, node):
+        """
+        Starts the user's session on the given node, replacing
+        any previous session.
+        """
+        return self._run(r.table(self.USER_SESSIONS_TABLE).insert({
+            "id": nickname,
+            "node": node,
+            "last_message": r.now(),
+            "session_start": r.now()
+        }, conflict="replace"))
+
+    def touchUserSession(self, nickname):
+        """
+        Records that the user just sent a message, which WHOIS reports
+        idle times from.
+        """
+        return self._run(r.table(self.USER_SESSIONS_TABLE).get(
+            nickname
+        ).update({"last_message": r.now()}))
 
     def removeUserSession(self, nickname):
-        return r.table(self.USER_SESSIONS_TABLE).get(
+        return self._run(r.table(self.USER_SESSIONS_TABLE).get(
             nickname
-        ).delete().run(self.conn)
+        ).delete())
 
     def removeUserFromGroup(self, nickname, group):
-        return r.table(self.GROUP_STATES_TABLE).get(group).replace(
-            r.row.without({"users": {nickname: True}})
-        ).run(self.conn)
-
-    def heartbeatUserInGroup(self, nickname, group):
-        presence = r.table(self.GROUP_STATES_TABLE).get(
-            group
-        ).run(self.conn)
-
-        if not presence:
-            return r.table(self.GROUP_STATES_TABLE).insert({
-                "id": group,
-                "users": {
-                    nickname: {
-                        "heartbeat": r.now()
-                    }
-                }
-            }).run(self.conn)
-        else:
-            return r.table(self.GROUP_STATES_TABLE).get(group).update({
-                "users": r.row["users"].merge({
-                    nickname: {
-                        "heartbeat": r.now()
-                    }
-                })
-            }).run(self.conn)
-
-    def observeGroupState(self, group):
-        conn = r.connect(db=self.db,
-                         host=self.rdb_host,
-                         port=self.rdb_port)
-
-        return r.table(self.GROUP_STATES_TABLE).changes().filter(
-            r.row["old_val"]["id"] == group or r.row["new_val"]["id"] == group
-        )["new_val"].merge(
-            lambda state: {
-                "users": state["users"].keys().filter(
-                    lambda user: r.now()
-                                  .sub(state["users"][user]["heartbeat"])
-                                  .lt(30)
-                                  .default(False)
-                )
-            }
-        ).run(conn)
-
-    def observeGroupMeta(self, group):
-        conn = r.connect(db=self.db,
-                         host=self.rdb_host,
-                         port=self.rdb_port)
-
-        return r.table(self.GROUPS_TABLE).changes().filter(
-            r.row["old_val"]["id"] == group or r.row["new_val"]["id"] == group
-        ).run(conn)
+        """
+        Removes the user's presence from the group and decrements the
+        group's member count if the user was present.
+        """
+        return self._run(r.table(self.GROUP_MEMBERS_TABLE).get(
+            [group, nickname]
+        ).delete().do(lambda result: r.branch(
+            result["deleted"].gt(0),
+            self._changeGroupSize(group, -1).do(lambda _: result),
+            result)))
+
+    def addUserToGroup(self, nickname, group, node):
+        """
+        Records the user's presence in the group, owned by the given node,
+        and increments the group's member count if the user was not
+        present yet.
+        """
+        return self._run(r.table(self.GROUP_MEMBERS_TABLE).insert({
+            "id": [group, nickname],
+            "group": group,
+            "user": nickname,
+            "node": node
+        }, conflict="update").do(lambda result: r.branch(
+            result["inserted"].gt(0),
+            self._changeGroupSize(group, 1).do(lambda _: result),
+            result)))
+
+    def _changeGroupSize(self, group, delta):
+        """
+        Returns a ReQL expression which adds `delta` to the member
+        count stored in the group's document, if the group exists.
+        """
+        return r.table(self.GROUPS_TABLE).get(group).update(
+            lambda doc: {"size": doc["size"].default(0).add(delta)})
+
+    def getGroupSize(self, name):
+        """
+        Returns a Deferred which fires with the group's member count,
+        as maintained by the membership writes, without reading its
+        members.
+        """
+        return self._run(r.table(self.GROUPS_TABLE).get(name).default(
+            {})["size"].default(0))
+
+    @defer.inlineCallbacks
+    def reconcileGroupSizes(self):
+        """
+        Recounts the membership rows of every group, and corrects the
+        member counts which drifted from them. The rows of nodes whose
+        lease lapsed are counted until :meth:`expireNodes` removes them,
+        since it decrements the counts as it does. A count which changes
+        while the group is recounted is left for the next call.
+        Returns a Deferred which fires with the list of the corrected
+        groups, each carrying its `id`, its stored `size` and the
+        `actual` count.
+        """
+        drifted = yield self._run(r.table(self.GROUPS_TABLE).pluck(
+            "id", "size"
+        ).merge(lambda group: {
+            "size": group["size"].default(0),
+            "actual": r.table(self.GROUP_MEMBERS_TABLE).get_all(
+                group["id"], index="group").count()
+        }).filter(
+            lambda group: group["size"].ne(group["actual"])
+        ).coerce_to("array"))
+
+        for group in drifted:
+            yield self._run(r.table(self.GROUPS_TABLE).get(
+                group["id"]
+            ).update(lambda doc: r.branch(
+                doc["size"].default(0).eq(group["size"]),
+                {"size": group["actual"]},
+                {})))
+
+        defer.returnValue(drifted)
+
+    def _groupUsers(self, group):
+        """
+        Returns a ReQL expression which evaluates to an object mapping
+        the nickname of every member of the group whose node holds a
+        valid lease to its membership row.
+
+        :param group: a ReQL expression which evaluates to a group name.
+        """
+        return r.table(self.GROUP_MEMBERS_TABLE).get_all(
+            group, index="group"
+        ).filter(
+            lambda member: self._nodeAlive(member["node"])
+        ).map(
+            lambda member: [member["user"], member]
+        ).coerce_to("object")
+
+    def observeGroupStates(self, groups):
+        """
+        Returns a Deferred which fires with a single changefeed cursor
+        over the membership rows of all the given groups. Each change
+        is a member joining or leaving one of them: it carries the
+        `group` and `user` of the row as its `old_val` and `new_val`.
+        Moves of a member between nodes are not reported.
+
+        :param groups: a list of group names.
+        """
+        return self._observe(r.table(self.GROUP_MEMBERS_TABLE).get_all(
+            r.args(groups), index="group"
+        ).pluck("group", "user").changes())
+
+    def observeGroupMetas(self, groups):
+        """
+        Returns a Deferred which fires with a single changefeed cursor
+        over the metadata of all the given groups.
+
+        :param groups: a list of group names.
+        """
+        return self._observe(r.table(self.GROUPS_TABLE).get_all(
+            r.args(groups)
+        ).changes())
+
+    def observeKeys(self, table, fields):
+        """
+        Returns a Deferred which fires with a changefeed cursor over
+        the whole table which only carries the given fields. Each
+        change is the list of the affected document's old and new
+        versions, leaving out those that do not exist.
+
+        :param table: the name of the table to observe.
+        :param fields: a list of field names.
+        """
+        def versions(change):
+            return r.expr([change["old_val"], change["new_val"]]).filter(
+                lambda doc: doc.ne(None)
+            ).pluck(*fields)
+
+        return self._observe(r.table(table).changes().map(versions))
 
     def lookupUser(self, nickname):
         """
         Finds the user with given nickname and returns the dict for it
         Returns None if the user is not found
+        The user's groups are found through the `user` index of the
+        membership table, so the lookup only reads the user's own
+        memberships.
         """
-        exists = r.table(self.USERS_TABLE).get(
-            nickname
-        ).run(self.conn)
-
-        if exists:
-            return r.table(self.USERS_TABLE).get(
-                nickname
-            ).merge({
-                "session": r.table(self.USER_SESSIONS_TABLE).get(nickname),
-                "groups": r.table(self.GROUPS_TABLE).filter(
-                    lambda group: r.table(self.GROUP_STATES_TABLE)
-                                   .get(group["id"])
-                                   .has_fields({
-                                       "users": {
-                                           nickname: True
-                                       }
-                                   })
-                ).coerce_to("array")
-            }).run(self.conn)
-        else:
-            return None
+        user = r.table(self.USERS_TABLE).get(nickname)
+
+        return self._run(r.branch(user.ne(None), user.merge({
+            "session": r.table(self.USER_SESSIONS_TABLE).get(nickname),
+            "groups": r.table(self.GROUP_MEMBERS_TABLE).get_all(
+                nickname, index="user"
+            ).eq_join(
+                "group", r.table(self.GROUPS_TABLE)
+            )["right"].coerce_to("array")
+        }), None))
 
     def lookupUserSession(self, nickname):
-        exists = r.table(self.USER_SESSIONS_TABLE).get(
-            nickname
-        ).run(self.conn)
-
-        if exists:
-            return r.table(self.USER_SESSIONS_TABLE).get(
-                nickname
-            ).merge(
-                lambda session: {
-                    "active": r.now()
-                               .sub(session["last_heartbeat"])
-                               .lt(30).default(False)
-                }
-            ).run(self.conn)
+        session = r.table(self.USER_SESSIONS_TABLE).get(nickname)
+
+        return self._run(r.branch(session.ne(None), session.merge({
+            "active": self._nodeAlive(session["node"].default(""))
+        }), None))
+
+    def lookupRoutes(self, name):
+        """
+        Returns a Deferred which fires with the list of live nodes
+        which host either the session of the user or members of
+        the group with the given name.
+        """
+        sessions = r.table(self.USER_SESSIONS_TABLE).get_all(name)["node"]
+        members = r.table(self.GROUP_MEMBERS_TABLE).get_all(
+            name, index="group"
+        )["node"]
+
+        return self._run(sessions.union(members).distinct().filter(
+            lambda node: self._nodeAlive(node)
+        ).coerce_to("array"))
 
     def registerUser(self, nickname, email, password):
         """
         Finds unregistered user with same nickname and registers them with
         the given email, password, and sets registered to True
         """
+        try:
+            self.checkIfValidEmail(email)
+            self.checkIfValidNickname(nickname)
+            self.checkIfValidPassword(password)
+        except Exception:
+            return defer.fail()
 
-        self.checkIfValidEmail(email)
-        self.checkIfValidNickname(nickname)
-        self.checkIfValidPassword(password)
-
-        result = r.table(self.USERS_TABLE).filter({
+        return self._run(r.table(self.USERS_TABLE).filter({
             "nickname": nickname
             }).update({
                 "email": email,
                 "password": password,
                 "registered": True
-            }).run(self.conn)
-        return result
+            }))
 
     def deleteUser(self, nickname):
         """
         Find and delete the user given by nickname
         """
 
-        return r.table(self.USERS_TABLE).get(
+        return self._run(r.table(self.USERS_TABLE).get(
             nickname
-            ).delete().run(self.conn)
+            ).delete())
 
+    @defer.inlineCallbacks
     def setPermission(self, nickname, channel, permission):
         """
         Set permission for user for the given channel to the permissions string
         defined by permission
         """
-        current_permissions = r.table(self.USERS_TABLE).get(
+        current_permissions = yield self._run(r.table(self.USERS_TABLE).get(
             nickname
-            ).pluck("permissions").run(self.conn)
+            ).pluck("permissions"))
 
         permissions_for_channel = current_permissions.get(channel, [])
         permissions_for_channel.append(permission)
 
-        return r.table(self.USERS_TABLE).get(
+        result = yield self._run(r.table(self.USERS_TABLE).get(
             nickname
             ).update({
                 "permissions": r.row["permissions"].merge({
                     channel: permissions_for_channel
                     })
-            }).run(self.conn)
+            }))
+        defer.returnValue(result)
 
+    @defer.inlineCallbacks
     def createGroup(self, name, channelType):
         """
         Create an IRC channel (if it doesn't exist yet) in the channels table
@@ -229,28 +908,24 @@ class IRCDDatabase:
         assert name
         assert channelType
 
-        exists = r.table(self.GROUPS_TABLE).get(
+        exists = yield self._run(r.table(self.GROUPS_TABLE).get(
             name
-            ).run(self.conn)
+            ))
 
         if not exists:
-            group = r.table(self.GROUPS_TABLE).insert({
+            group = yield self._run(r.table(self.GROUPS_TABLE).insert({
                 "id": name,
                 "name": name,
                 "type": channelType,
+                "size": 0,
                 "meta": {
                     "topic": "",
                     "topic_author": "",
                     "topic_time": r.now()
                 },
-            }).run(self.conn)
-
-            state = r.table(self.GROUP_STATES_TABLE).insert({
-                "id": name,
-                "users": {}
-            }).run(self.conn)
+            }))
 
-            return group, state
+            defer.returnValue(group)
         else:
             log.err("Group already exists: %s" % name)
 
@@ -259,66 +934,109 @@ class IRCDDatabase:
         Return the IRC channel dict for channel with given name,
         along with the merged state data.
         """
-        group = r.table(self.GROUPS_TABLE).get(
-            name
-        ).run(self.conn)
-
-        if group:
-            return r.table(self.GROUPS_TABLE).get(
-                name
-            ).merge({
-                "users": r.table(self.GROUP_STATES_TABLE)
-                          .get(name)["users"]
-            }).run(self.conn)
-        else:
-            return None
+        group = r.table(self.GROUPS_TABLE).get(name)
+
+        return self._run(r.branch(group.ne(None), group.merge({
+            "users": self._groupUsers(name)
+        }), None))
 
     def getGroupState(self, name):
-        return r.table(self.GROUP_STATES_TABLE).get(
-            name
-        ).run(self.conn)
+        """
+        Returns a Deferred which fires with the group's state: a dict
+        whose `users` map the group's active members to their
+        membership rows.
+        """
+        return self._run(r.expr({
+            "id": name,
+            "users": self._groupUsers(name)
+        }))
 
     def listGroups(self):
         """
-        Returns a list of all groups. The documents in the list
-        contain both the current metadata (name, topic, etc) and
-        state information (user sessions).
+        Returns a Deferred which fires with a list of all groups.
+        The documents in the list contain both the current metadata
+        (name, topic, etc) and state information (user sessions).
         """
 
-        return list(r.table(self.GROUPS_TABLE).filter(
+        return self._run(r.table(self.GROUPS_TABLE).filter(
             {"type": "public"}
         ).merge(lambda group: {
-            "users": r.table(self.GROUP_STATES_TABLE)
-                      .get(group["id"])["users"]
-        }).run(self.conn))
+            "users": self._groupUsers(group["id"])
+        }).coerce_to("array"))
+
+    def listGroupsPage(self, after=None, limit=100, min_users=None,
+                       max_users=None, name_masks=None, topic_masks=None):
+        """
+        Returns a Deferred which fires with the next page of at most
+        `limit` public groups, in name order, whose name comes after
+        `after`. Each group carries its `name`, `meta` and `size`,
+        the member count maintained along with its memberships. Passing
+        the name of the last group of a page as `after` returns the
+        following page.
+
+        The filters are evaluated by RethinkDB.
+
+        :param after: the name after which the page starts.
+        :param limit: the maximum number of groups in the page.
+        :param min_users: only list groups with more members than that.
+        :param max_users: only list groups with fewer members than that.
+        :param name_masks: only list groups whose name matches
+        one of these IRC masks.
+        :param topic_masks: only list groups whose topic matches
+        one of these IRC masks.
+        """
+        query = r.table(self.GROUPS_TABLE)
+        if after is not None:
+            query = query.between(after, r.maxval, left_bound="open")
+
+        query = query.order_by(index="id").filter({"type": "public"})
+
+        if name_masks:
+            regex = maskToRegex(name_masks)
+            query = query.filter(lambda group: group["name"].match(regex))
+        if topic_masks:
+            regex = maskToRegex(topic_masks)
+            query = query.filter(
+                lambda group: group["meta"]["topic"].match(regex))
+
+        query = query.pluck("id", "name", "meta", "size").merge(
+            lambda group: {"size": group["size"].default(0)})
 
+        if min_users is not None:
+            query = query.filter(lambda group: group["size"].gt(min_users))
+        if max_users is not None:
+            query = query.filter(lambda group: group["size"].lt(max_users))
+
+        return self._run(query.limit(limit).coerce_to("array"))
+
+    @defer.inlineCallbacks
     def deleteGroup(self, name):
         """
         Delete the IRC channel with the given channel name
         """
 
-        deleted_group = r.table(self.GROUPS_TABLE).get(
+        deleted_group = yield self._run(r.table(self.GROUPS_TABLE).get(
             name
-        ).delete().run(self.conn)
+        ).delete())
 
-        deleted_state = r.table(self.GROUP_STATES_TABLE).get(
-            name
-        ).delete().run(self.conn)
+        deleted_members = yield self._run(r.table(
+            self.GROUP_MEMBERS_TABLE
+        ).get_all(name, index="group").delete())
 
-        return deleted_group, deleted_state
+        defer.returnValue((deleted_group, deleted_members))
 
     def setGroupTopic(self, name, topic, author):
         """
         Set the IRC channel's topic
         """
 
-        return r.table(self.GROUPS_TABLE).get(name).update({
+        return self._run(r.table(self.GROUPS_TABLE).get(name).update({
             "meta": {
                 "topic": topic,
                 "topic_time": r.now(),
                 "topic_author": author
                 }
-            }).run(self.conn)
+            }))
 
     def checkIfValidEmail(self, email):
         """
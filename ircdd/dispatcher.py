@@ -0,0 +1,188 @@
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+class FeedDispatcher(object):
+    """
+    Follows the metadata and membership changes of every group this
+    node is interested in over one changefeed per table, and hands
+    each change to the :class:`ircdd.group.ShardedGroup` it belongs to.
+
+    Groups enter and leave the feeds through `register` and
+    `unregister`. Interest changes made within `restart_delay` seconds
+    of each other are coalesced into a single restart of the feeds.
+    The new feeds are started before the old ones are closed, so no
+    change is lost while they are swapped; the groups tolerate the
+    occasional duplicate. Groups which were not covered by the old
+    feeds are resynced once the new ones are running, which catches
+    the changes made between their creation and the restart.
+
+    A feed which ends on its own, such as when its connection dies, is
+    restarted after `retry_delay` seconds, and so is a failed restart.
+    Every registered group is then resynced, since changes may have
+    been missed in the meantime.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` to observe.
+    :param restart_delay: seconds to wait for further interest changes
+    before the feeds are restarted.
+    :param retry_delay: seconds to wait before restarting feeds which
+    ended or failed to start.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, restart_delay=0.1, retry_delay=5.0, clock=None):
+        self.db = db
+        self.restart_delay = restart_delay
+        self.retry_delay = retry_delay
+        self.groups = {}
+
+        self._clock = clock or reactor
+        self._feeds = {}
+        self._covered = set()
+        self._delayed = None
+        self._restarting = False
+        self._dirty = False
+        self._closed = False
+
+    def register(self, group):
+        """
+        Starts dispatching the changes of the given group to it.
+        """
+        self.groups[group.name] = group
+        self._scheduleRestart()
+
+    def unregister(self, name):
+        """
+        Stops dispatching the changes of the group with the given name.
+        """
+        if self.groups.pop(name, None) is not None:
+            self._scheduleRestart()
+
+    def _scheduleRestart(self, delay=None):
+        if self._closed:
+            return
+        if self._delayed is None or not self._delayed.active():
+            self._delayed = self._clock.callLater(
+                self.restart_delay if delay is None else delay,
+                self.restart)
+
+    def restart(self):
+        """
+        Replaces the running feeds with ones that cover the currently
+        registered groups. A restart requested while another one is
+        in progress runs once the latter completes.
+        Returns a Deferred which fires once the feeds are replaced.
+        """
+        self._delayed = None
+
+        if self._restarting:
+            self._dirty = True
+            return defer.succeed(None)
+
+        self._restarting = True
+        names = sorted(self.groups)
+
+        d = defer.gatherResults([
+            self._replace("meta", names, self.db.observeGroupMetas,
+                          self.dispatchMeta),
+            self._replace("state", names, self.db.observeGroupStates,
+                          self.dispatchState)
+        ], consumeErrors=True)
+
+        def cbRestarted(_):
+            added = set(names) - self._covered
+            self._covered = set(names)
+
+            for name in sorted(added):
+                group = self.groups.get(name)
+                if group is not None:
+                    group.resync()
+
+        def ebRestarted(err):
+            log.err(err, "Failed to restart the group feeds")
+            self._scheduleRestart(self.retry_delay)
+
+        d.addCallbacks(cbRestarted, ebRestarted)
+
+        def cbDone(_):
+            self._restarting = False
+            if self._dirty:
+                self._dirty = False
+                return self.restart()
+
+        return d.addCallback(cbDone)
+
+    def _replace(self, kind, names, observe, dispatch):
+        old = self._feeds.pop(kind, None)
+
+        def cbEnded(_, cursor):
+            if self._feeds.get(kind) is not cursor:
+                # The feed was replaced or closed.
+                return
+
+            log.msg("The %s feed ended, restarting it" % kind)
+            del self._feeds[kind]
+            # Changes may have been missed while the feed was down.
+            self._covered = set()
+            self._scheduleRestart(self.retry_delay)
+
+        def cbStarted(cursor):
+            self._feeds[kind] = cursor
+            d = self.db.follow(cursor, dispatch)
+            d.addErrback(log.err, "The %s feed failed" % kind)
+            d.addCallback(cbEnded, cursor)
+
+        def cbClose(_):
+            if old is not None:
+                return defer.maybeDeferred(old.close)
+
+        def ebStarted(err):
+            # Keep following the old feed until a restart succeeds.
+            if old is not None:
+                self._feeds[kind] = old
+            return err
+
+        if names:
+            d = observe(names).addCallback(cbStarted)
+        else:
+            d = defer.succeed(None)
+        return d.addCallbacks(cbClose, ebStarted)
+
+    def close(self):
+        """
+        Closes the running feeds and cancels any pending restart.
+        """
+        self._closed = True
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+
+        feeds, self._feeds = self._feeds.values(), {}
+        return defer.gatherResults([defer.maybeDeferred(feed.close)
+                                    for feed in feeds])
+
+    def _dispatch(self, change, key, method):
+        doc = change.get("new_val") or change.get("old_val")
+        if not doc:
+            return
+
+        group = self.groups.get(doc[key])
+        if group is None:
+            return
+
+        try:
+            getattr(group, method)(change)
+        except Exception:
+            log.err(None, "Failed to apply a change to %s" % group.name)
+
+    def dispatchMeta(self, change):
+        """
+        Hands a change of the groups table to its group.
+        """
+        self._dispatch(change, "id", "applyMetaChange")
+
+    def dispatchState(self, change):
+        """
+        Hands a change of the membership table to its group.
+        """
+        self._dispatch(change, "group", "applyStateChange")
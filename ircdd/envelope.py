@@ -0,0 +1,118 @@
+"""
+Encoding of the envelopes which carry messages between nodes over NSQ.
+
+A binary envelope starts with a fixed header which holds the envelope
+version, the message type, and the lengths of the origin and recipient
+names. The names follow the header, and the JSON encoded message body
+comes last. The origin, type and recipient of a message can therefore
+be read without decoding its body.
+
+Legacy envelopes are JSON objects holding `msg_body`, `origin` and,
+optionally, `recipient`. They are still understood, so that nodes can
+be upgraded one at a time.
+"""
+import json
+import struct
+
+MAGIC = 0xEE
+VERSION = 1
+
+# magic, version, message type, origin length, recipient length
+HEADER = struct.Struct("!BBBBH")
+
+MESSAGE_TYPES = ["unknown", "privmsg", "join", "part", "batch"]
+MESSAGE_TYPE_CODES = dict((name, code) for (code, name)
+                          in enumerate(MESSAGE_TYPES))
+
+
+class EnvelopeError(ValueError):
+    """
+    Raised when an envelope cannot be decoded.
+    """
+
+
+def encode(msg_body, origin, recipient=None, binary=True):
+    """
+    Returns the envelope for the message, as a byte string.
+
+    :param msg_body: the message dictionary.
+    :param origin: the name of the node sending the message.
+    :param recipient: the name of the user or group the message is
+    addressed to, when it differs from the topic.
+    :param binary: whether to use the binary envelope rather than the
+    legacy JSON one.
+    """
+    if not binary:
+        msg = dict(msg_body=msg_body, origin=origin)
+        if recipient is not None:
+            msg["recipient"] = recipient
+        return json.dumps(msg)
+
+    origin = origin.encode("utf-8")
+    recipient = (recipient or u"").encode("utf-8")
+    msg_type = MESSAGE_TYPE_CODES.get(msg_body.get("type"), 0)
+
+    return "".join([HEADER.pack(MAGIC, VERSION, msg_type,
+                                len(origin), len(recipient)),
+                    origin,
+                    recipient,
+                    json.dumps(msg_body)])
+
+
+class Envelope(object):
+    """
+    A received envelope. The header fields are available as soon as
+    the envelope is created, while the body is only decoded when
+    `parsed` is first called.
+
+    :param data: the raw envelope.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._parsed = None
+
+        if data[:1] != chr(MAGIC):
+            # Legacy JSON envelope, which has to be decoded whole.
+            try:
+                self._parsed = json.loads(data)
+                self.origin = self._parsed["origin"]
+            except (ValueError, KeyError, TypeError) as e:
+                raise EnvelopeError("Invalid envelope: %s" % e)
+            self.recipient = self._parsed.get("recipient")
+
+            msg_body = self._parsed.get("msg_body")
+            self.msg_type = "unknown"
+            if isinstance(msg_body, dict):
+                self.msg_type = msg_body.get("type", "unknown")
+            return
+
+        if len(data) < HEADER.size:
+            raise EnvelopeError("Truncated envelope header")
+
+        (_, version, msg_type, origin_length,
+         recipient_length) = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise EnvelopeError("Unsupported envelope version %d" % version)
+
+        start = HEADER.size
+        self.origin = data[start:start + origin_length].decode("utf-8")
+        start += origin_length
+        self.recipient = data[start:start + recipient_length].decode(
+            "utf-8") or None
+        self._offset = start + recipient_length
+
+        self.msg_type = MESSAGE_TYPES[msg_type] \
+            if msg_type < len(MESSAGE_TYPES) else "unknown"
+
+    def parsed(self):
+        """
+        Returns the envelope as a dictionary holding `msg_body`,
+        `origin` and, when set, `recipient`.
+        """
+        if self._parsed is None:
+            self._parsed = dict(msg_body=json.loads(self.data[self._offset:]),
+                                origin=self.origin)
+            if self.recipient is not None:
+                self._parsed["recipient"] = self.recipient
+        return self._parsed
@@ -0,0 +1,181 @@
+from fnmatch import fnmatchcase
+
+from twisted.internet import reactor, task
+
+
+def parseLimits(limits):
+    """
+    Parses per-topic in-flight limits, given either as a mapping or as
+    a `pattern=limit,pattern=limit` string, into a list of
+    `(pattern, limit)` tuples. Patterns are shell-style wildcards.
+    """
+    if not limits:
+        return []
+
+    if isinstance(limits, basestring):
+        limits = dict(item.split("=", 1) for item in limits.split(",")
+                      if item.strip())
+
+    return sorted((pattern.strip(), int(limit))
+                  for (pattern, limit) in limits.iteritems())
+
+
+def bufferedBytes(transport):
+    """
+    Returns the number of bytes waiting in the output buffer of a
+    transport built on Twisted's `FileDescriptor`, or 0 for others.
+    """
+    data = getattr(transport, "dataBuffer", "")
+    offset = getattr(transport, "offset", 0)
+    return len(data) - offset + getattr(transport, "_tempDataLen", 0)
+
+
+class FlowController(object):
+    """
+    Adapts the `max_in_flight` of every NSQ reader to how fast this
+    node keeps up with its messages.
+
+    Every `interval` seconds the controller measures the reactor's lag
+    and the bytes buffered for the connected clients. When either is
+    over its bound the node is overloaded: every reader's limit is
+    halved, and messages are requeued with backoff instead of being
+    handled until the next check. Otherwise the limit of readers whose
+    handler took less than `target_latency` on average is doubled, and
+    that of readers whose handler took longer is cut by a quarter.
+    Limits stay between `min_in_flight` and the topic's own limit.
+    New limits are sent to nsqd as RDY counts right away, through the
+    readers' `set_max_in_flight` (see
+    :class:`ircdd.remote.ClosableReader`).
+
+    Reports the `reactor.lag` and `flow.buffered_bytes` gauges, the
+    `flow.handler_latency` timing and the `flow.overloaded` and
+    `flow.requeued` counters.
+
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param clients: a callable returning the transports of the
+    connected clients.
+    :param min_in_flight: the lowest limit of a reader.
+    :param max_in_flight: the highest limit of a reader whose topic
+    matches none of `limits`.
+    :param limits: per-topic highest limits, as understood by
+    :func:`parseLimits`.
+    :param target_latency: the average handler latency, in seconds,
+    under which limits are raised.
+    :param max_lag: the reactor lag, in seconds, over which the node
+    is overloaded.
+    :param max_buffered: the number of bytes buffered for the clients
+    over which the node is overloaded.
+    :param interval: seconds between two adjustments.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, metrics, clients=None, min_in_flight=1,
+                 max_in_flight=100, limits=None, target_latency=0.005,
+                 max_lag=0.1, max_buffered=64 * 1024 * 1024, interval=1.0,
+                 clock=None):
+        self.metrics = metrics
+        self.clients = clients or (lambda: [])
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.limits = parseLimits(limits)
+        self.target_latency = target_latency
+        self.max_lag = max_lag
+        self.max_buffered = max_buffered
+        self.interval = interval
+
+        self.overloaded = False
+
+        self._clock = clock or reactor
+        self._readers = {}
+        # Maps each topic to the number and total latency of the
+        # messages handled since the last adjustment.
+        self._handled = {}
+        self._last = self._clock.seconds()
+
+        self._loop = task.LoopingCall(self.adjust)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=False)
+
+    def limit(self, topic):
+        """
+        Returns the highest `max_in_flight` of the topic's reader.
+        """
+        for (pattern, limit) in self.limits:
+            if fnmatchcase(topic, pattern):
+                return limit
+        return self.max_in_flight
+
+    def register(self, topic, reader):
+        """
+        Adapts the limit of the topic's reader from now on.
+        """
+        reader.set_max_in_flight(min(self.min_in_flight, self.limit(topic)))
+        self._readers[topic] = reader
+
+    def unregister(self, topic):
+        """
+        Stops adapting the limit of the topic's reader.
+        """
+        self._readers.pop(topic, None)
+        self._handled.pop(topic, None)
+
+    def handle(self, topic, message, callback):
+        """
+        Hands the message to the callback and records how long it took,
+        or requeues the message with backoff if the node is overloaded.
+        """
+        if self.overloaded:
+            self.metrics.increment("flow.requeued")
+            message.requeue(backoff=True)
+            return False
+
+        start = self._clock.seconds()
+        try:
+            return callback(message)
+        finally:
+            elapsed = self._clock.seconds() - start
+            handled = self._handled.setdefault(topic, [0, 0.0])
+            handled[0] += 1
+            handled[1] += elapsed
+            self.metrics.observe("flow.handler_latency", elapsed)
+
+    def adjust(self):
+        """
+        Checks whether the node is overloaded and adapts the limit of
+        every reader accordingly.
+        """
+        now = self._clock.seconds()
+        lag = max(0.0, now - self._last - self.interval)
+        self._last = now
+
+        buffered = sum(bufferedBytes(transport)
+                       for transport in self.clients())
+
+        self.metrics.gauge("reactor.lag", lag)
+        self.metrics.gauge("flow.buffered_bytes", buffered)
+
+        self.overloaded = lag > self.max_lag or buffered > self.max_buffered
+        if self.overloaded:
+            self.metrics.increment("flow.overloaded")
+
+        for (topic, reader) in self._readers.iteritems():
+            count, total = self._handled.pop(topic, (0, 0.0))
+            current = reader.max_in_flight
+
+            if self.overloaded:
+                current = current // 2
+            elif count and total / count > self.target_latency:
+                current = current * 3 // 4
+            elif count:
+                current = current * 2
+
+            limit = max(self.min_in_flight, min(current, self.limit(topic)))
+            if limit != reader.max_in_flight:
+                reader.set_max_in_flight(limit)
+
+    def stop(self):
+        """
+        Stops adapting the limits.
+        """
+        if self._loop.running:
+            self._loop.stop()
@@ -1,9 +1,13 @@
+from collections import OrderedDict
+
 from zope.interface import implements
 
 from twisted.words import iwords
-from twisted.internet import defer, reactor, threads
+from twisted.internet import defer, reactor
 from twisted.python import failure, log
 
+from ircdd.protocol import encodeJoin, encodePart, encodePrivmsg
+
 
 class ShardedGroup(object):
     implements(iwords.IGroup)
@@ -11,22 +15,116 @@ class ShardedGroup(object):
     """
     A group which may exist in a sharded state on different
     servers. It subscribes to its own topic on the message queue
-    and sends/receives remote messages.
+    and sends/receives remote messages, for as long as it has
+    local users.
+    Creating a group is cheap: its state is only loaded, and its
+    changes followed, once :meth:`load` is called.
+
+    A group with at least `large_threshold` members is large. Its joins
+    and parts are collected for `batch_window` seconds, so that a user
+    who leaves and comes back within the window is not announced at
+    all. The rest are then published to the other shards as a single
+    `batch` message and written to each local user at once. When
+    `idle_timeout` is set, the local users of a large group who have
+    not spoken in it for that many seconds are not told about joins
+    and parts at all, like the audience of an auditorium.
+
+    Reports the `groups.event_batches`, `groups.batched_events`,
+    `groups.coalesced_events` and `groups.suppressed_events` counters.
+
+    :param ctx: the :class:`ircdd.context.ConfigStore` of the node.
+    :param name: the name of the group.
+    :param large_threshold: the number of members from which the group
+    is large, or 0 if it never is.
+    :param batch_window: seconds during which the joins and parts of a
+    large group are collected.
+    :param idle_timeout: seconds of silence after which a local user of
+    a large group no longer sees joins and parts, or 0 if users always
+    see them.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
     """
-    def __init__(self, ctx, name):
+    def __init__(self, ctx, name, large_threshold=0, batch_window=1.0,
+                 idle_timeout=0.0, clock=None):
         self.name = name
-        self.users = {}
+        self.users = set()
         self.local_sessions = {}
         self.meta = {"topic": "", "topic_author": ""}
 
-        self.ctx = ctx
-        self.ctx.remote_rw.subscribe(self.name, self.receiveRemote)
+        self.large_threshold = large_threshold
+        self.batch_window = batch_window
+        self.idle_timeout = idle_timeout
 
-        self.getMeta()
-        self.getState()
+        self.ctx = ctx
+        self._clock = clock or reactor
+        # The joins and parts of a large group which are waiting to be
+        # published and to be written to the local users, by user name.
+        self._shard_events = OrderedDict()
+        self._local_events = OrderedDict()
+        self._flush_call = None
+        # Maps the local users to when they last spoke in the group.
+        self._spoke = {}
+        self.loaded = False
+        # Set whenever the realm hands the group out, see
+        # :class:`ircdd.realm.GroupEvictor`.
+        self.touched = False
+        self._loading = None
+        self._subscribed = False
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self.ctx.remote_rw.subscribe(self.name, self.receiveRemote)
+            self._subscribed = True
+
+    def _unsubscribe(self):
+        if self._subscribed:
+            self.ctx.remote_rw.unsubscribe(self.name)
+            self._subscribed = False
+
+    def load(self):
+        """
+        Loads the group's metadata and state from `RDB` and follows
+        their changes from then on, unless that is already done.
+        Returns a Deferred which fires with the group once loaded.
+        """
+        d = defer.Deferred()
+        if self.loaded:
+            d.callback(self)
+            return d
+
+        first = self._loading is None
+        if first:
+            self._loading = []
+        self._loading.append(d)
+
+        if first:
+            self.ctx.feeds.register(self)
+            loading = self.resync()
+            loading.addErrback(log.err, "Failed to load the group %s" %
+                               self.name)
+            loading.addCallback(self._cbLoaded)
+        return d
+
+    def _cbLoaded(self, _):
+        waiting, self._loading = self._loading, None
+        self.loaded = True
+        for d in waiting:
+            d.callback(self)
+
+    def isIdle(self):
+        """
+        Returns whether the group is loaded and has no local users.
+        """
+        return self.loaded and not self.local_sessions
 
-        threads.deferToThread(self._observeMeta)
-        threads.deferToThread(self._observeState)
+    def close(self):
+        """
+        Stops following the group's changes and releases its topic.
+        The group has to be loaded again before it is used.
+        """
+        self.flushEvents()
+        self.ctx.feeds.unregister(self.name)
+        self._unsubscribe()
+        self.loaded = False
 
     def _ebUserCall(self, err, p):
         return failure.Failure(Exception(p, err))
@@ -42,57 +140,49 @@ class ShardedGroup(object):
         Gets the group's metadata from `RDB` and
         populates the local structure with it.
         """
-        group = self.ctx.db.lookupGroup(self.name)
-        if group:
-            self.updateMeta(group["meta"])
+        def cbGroup(group):
+            if group:
+                self.updateMeta(group["meta"])
+
+        return self.ctx.db.lookupGroup(self.name).addCallback(cbGroup)
 
     def getState(self):
         """
         Gets the groups state from `RDB` and
-        populates the local shard with it.
+        populates the local shard's member set with it.
         """
-        state = self.ctx.db.getGroupState(self.name)
-        if state:
-            self.users = state["users"]
+        def cbState(state):
+            if state:
+                self.users = set(state["users"])
+
+        return self.ctx.db.getGroupState(self.name).addCallback(cbState)
 
-    def _observeState(self):
+    def resync(self):
         """
-        Continuously processes the stream of changes
-        to the group's state.
-        In order to join with the reactor thread on
-        SIGINT, a callback forcefully closes the
-        changeset's connection.
+        Reloads both the group's metadata and state from `RDB`.
         """
-        changeset = self.ctx.db.observeGroupState(self.name)
-
-        reactor.addSystemEventTrigger("before", "shutdown",
-                                      changeset.conn.close,
-                                      False)
+        return defer.gatherResults([self.getMeta(), self.getState()])
 
-        def updateUserList(users):
-            self.users = users
-
-        for change in changeset:
-            reactor.callFromThread(updateUserList,
-                                   change["users"])
-
-    def _observeMeta(self):
+    def applyStateChange(self, change):
         """
-        Continuously processes the stream of changes to the
-        group's metadata.
-        In order to join with the reactor thread on SIGINT
-        a callback forcefully closes the changeset's connection.
+        Applies a change of one of the group's membership rows,
+        as delivered by the :class:`ircdd.dispatcher.FeedDispatcher`,
+        to the member set.
         """
-        changeset = self.ctx.db.observeGroupMeta(self.name)
-
-        reactor.addSystemEventTrigger("before", "shutdown",
-                                      changeset.conn.close,
-                                      False)
+        if change.get("old_val"):
+            self.users.discard(change["old_val"]["user"])
+        if change.get("new_val"):
+            self.users.add(change["new_val"]["user"])
 
-        for change in changeset:
-            if change.get("new_val"):
-                reactor.callFromThread(self.updateMeta,
-                                       change["new_val"]["meta"])
+    def applyMetaChange(self, change):
+        """
+        Applies a change of the group's metadata, as delivered by
+        the :class:`ircdd.dispatcher.FeedDispatcher`.
+        """
+        if change.get("new_val"):
+            meta = change["new_val"]["meta"]
+            if meta != self.meta:
+                self.updateMeta(meta)
 
     def add(self, added_user):
         """
@@ -104,6 +194,7 @@ class ShardedGroup(object):
             "%r is not a chat client" % (added_user,)
 
         if added_user.name not in self.local_sessions:
+            self._subscribe()
             self.local_sessions[added_user.name] = added_user
             self.notifyAdd(added_user.name, added_user.ctx.hostname)
             self.notifyShardsAdd(added_user.name)
@@ -112,7 +203,8 @@ class ShardedGroup(object):
 
     def remove(self, removed_user, reason=None):
         """
-        Remove a local user from the group.
+        Remove a local user from the group. The group's topic is
+        released once its last local user is removed.
         """
         assert reason is None or isinstance(reason, unicode)
 
@@ -122,8 +214,11 @@ class ShardedGroup(object):
             log.err("Removing user %s failed: user does not exist" %
                     removed_user.name)
         else:
+            self._spoke.pop(removed_user.name, None)
             self.notifyRemove(removed_user.name, reason)
             self.notifyShardsRemove(removed_user.name, reason)
+            if not self.local_sessions:
+                self._unsubscribe()
         return defer.succeed(None)
 
     def receiveRemote(self, message):
@@ -147,24 +242,63 @@ class ShardedGroup(object):
         elif msg_type == "part":
             self.notifyRemove(msg_body["sender"]["name"],
                               msg_body["reason"])
+        elif msg_type == "batch":
+            for event in msg_body["events"]:
+                if event["type"] == "join":
+                    self.notifyAdd(event["name"], event["hostname"])
+                else:
+                    self.notifyRemove(event["name"], event["reason"])
 
         message.finish()
 
     def receive(self, sender_name, recipient, message):
         """
         Multicasts the message to all local users.
+
+        The lines of the message are built and encoded once, then
+        written as they are to every local user which supports it
+        (see :meth:`ircdd.protocol.IRCDDUser.receiveEncoded`). Only the
+        other users get a Deferred of their own.
         """
         assert recipient is self
 
+        if self.idle_timeout > 0 and sender_name in self.local_sessions:
+            self._spoke[sender_name] = self._clock.seconds()
+
+        text = message.get("text", "<an unrepresentable message>")
+        encoded = {}
+        failed = []
         recipients = []
 
-        for recipient in self.local_sessions.itervalues():
-            if recipient.name != sender_name:
-                d = defer.maybeDeferred(recipient.receive, sender_name,
+        for user in self.local_sessions.itervalues():
+            if user.name == sender_name:
+                continue
+
+            receiveEncoded = getattr(user, "receiveEncoded", None)
+            if receiveEncoded is None:
+                d = defer.maybeDeferred(user.receive, sender_name,
                                         self, message)
-                d.addErrback(self._ebUserCall, p=recipient)
+                d.addErrback(self._ebUserCall, p=user)
                 recipients.append(d)
-        defer.DeferredList(recipients).addCallback(self._cbUserCall)
+                continue
+
+            key = (user.hostname, user.encoding)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = encodePrivmsg(sender_name,
+                                                    user.hostname,
+                                                    "#" + self.name,
+                                                    text, user.encoding)
+            try:
+                receiveEncoded(data)
+            except Exception as e:
+                failed.append((user, e))
+
+        for (user, e) in failed:
+            self.remove(user, unicode(e))
+
+        if recipients:
+            defer.DeferredList(recipients).addCallback(self._cbUserCall)
         return defer.succeed(None)
 
     def iterusers(self):
@@ -178,13 +312,12 @@ class ShardedGroup(object):
         """
         Attempts to set the group meta in RDB.
         If successful, the local meta will be set via the
-        observer thread.
+        group feed.
         """
-        self.ctx.db.setGroupTopic(self.name,
-                                  meta["topic"],
-                                  meta["topic_author"])
-
-        return defer.succeed(None)
+        d = self.ctx.db.setGroupTopic(self.name,
+                                      meta["topic"],
+                                      meta["topic_author"])
+        return d.addCallback(lambda _: None)
 
     def updateMeta(self, meta):
         """
@@ -206,12 +339,141 @@ class ShardedGroup(object):
         defer.DeferredList(sets).addCallback(self._cbUserCall)
         return defer.succeed(None)
 
+    def isLarge(self):
+        """
+        Returns whether the group's joins and parts are batched. A group
+        stays large while some of them are queued, so that later events
+        are not announced before those.
+        """
+        return (bool(self._shard_events or self._local_events) or
+                0 < self.large_threshold <= len(self.users))
+
+    def _queueEvent(self, events, event):
+        """
+        Queues a join or part of a large group, cancelling the opposite
+        event of the same user if it is still queued.
+        """
+        queued = events.get(event["name"])
+        if queued is not None and queued["type"] != event["type"]:
+            del events[event["name"]]
+            self.ctx.metrics.increment("groups.coalesced_events", 2)
+        else:
+            events[event["name"]] = event
+
+        if self._flush_call is None:
+            self._flush_call = self._clock.callLater(self.batch_window,
+                                                     self.flushEvents)
+
+    def flushEvents(self):
+        """
+        Publishes the queued joins and parts of the group to the other
+        shards as one `batch` message, and writes them to the local
+        users.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        shard_events, self._shard_events = self._shard_events, OrderedDict()
+        local_events, self._local_events = self._local_events, OrderedDict()
+
+        if shard_events:
+            self.ctx.remote_rw.publish(self.name, {
+                "type": "batch",
+                "sender": {
+                    "name": None,
+                    "hostname": self.ctx.hostname,
+                },
+                "events": shard_events.values()
+            })
+            self.ctx.metrics.increment("groups.event_batches")
+            self.ctx.metrics.increment("groups.batched_events",
+                                       len(shard_events))
+
+        if local_events:
+            self._writeEvents(local_events.values())
+
+    def _writeEvents(self, events):
+        """
+        Writes the joins and parts to the local users, except for the
+        users who do not see them, in a single write per user.
+        The lines are encoded once for all the users which support it.
+        """
+        channel = "#" + self.name
+        names = set(event["name"] for event in events)
+        now = self._clock.seconds()
+        encoded = {}
+        failed = []
+        notifications = []
+        suppressed = 0
+
+        for user in self.local_sessions.itervalues():
+            spoke = self._spoke.get(user.name)
+            if self.idle_timeout > 0 and (
+                    spoke is None or now - spoke >= self.idle_timeout):
+                suppressed += len(events)
+                continue
+
+            receiveEncoded = getattr(user, "receiveEncoded", None)
+            if receiveEncoded is None:
+                for event in events:
+                    if event["name"] == user.name:
+                        continue
+                    if event["type"] == "join":
+                        d = defer.maybeDeferred(user.userJoined, self,
+                                                event["name"],
+                                                event["hostname"])
+                    else:
+                        d = defer.maybeDeferred(user.userLeft, self,
+                                                event["name"],
+                                                event["reason"])
+                    d.addErrback(self._ebUserCall, p=user)
+                    notifications.append(d)
+                continue
+
+            key = (user.hostname, user.encoding)
+            if key not in encoded:
+                lines = [(event["name"],
+                          encodeJoin(event["name"], event["hostname"],
+                                     channel, user.encoding)
+                          if event["type"] == "join" else
+                          encodePart(event["name"], user.hostname, channel,
+                                     event["reason"], user.encoding))
+                         for event in events]
+                encoded[key] = (lines, "".join(line for (_, line) in lines))
+            lines, data = encoded[key]
+
+            # Users are not told about their own joins and parts.
+            if user.name in names:
+                data = "".join(line for (name, line) in lines
+                               if name != user.name)
+
+            try:
+                receiveEncoded(data)
+            except Exception as e:
+                failed.append((user, e))
+
+        for (user, e) in failed:
+            self.remove(user, unicode(e))
+
+        if suppressed:
+            self.ctx.metrics.increment("groups.suppressed_events",
+                                       suppressed)
+        if notifications:
+            defer.DeferredList(notifications).addCallback(self._cbUserCall)
+
     def notifyShardsAdd(self, added_user_name):
         """
         Submits a `join` message on this group's topic,
         notifying remote shards of the event so that they
         can in turn relay it to their users.
         """
+        if self.isLarge():
+            return self._queueEvent(self._shard_events, {
+                "type": "join",
+                "name": added_user_name,
+                "hostname": self.ctx.hostname})
+
         message = {
             "type": "join",
             "sender": {
@@ -225,6 +487,12 @@ class ShardedGroup(object):
         """
         Notify the local users of a `join` event.
         """
+        if self.isLarge():
+            return self._queueEvent(self._local_events, {
+                "type": "join",
+                "name": added_user_name,
+                "hostname": added_user_hostname})
+
         additions = []
 
         for user in self.local_sessions.itervalues():
@@ -239,6 +507,12 @@ class ShardedGroup(object):
         """
         Notify the local users of a `part` event.
         """
+        if self.isLarge():
+            return self._queueEvent(self._local_events, {
+                "type": "part",
+                "name": removed_user_name,
+                "reason": reason})
+
         removals = []
         for user in self.local_sessions.itervalues():
             if user.name != removed_user_name:
@@ -255,6 +529,12 @@ class ShardedGroup(object):
         Publishes a `part` message to this group's topic in order to
         notify other instances if the event.
         """
+        if self.isLarge():
+            return self._queueEvent(self._shard_events, {
+                "type": "part",
+                "name": removed_user_name,
+                "reason": reason})
+
         message = {
             "type": "part",
             "sender": {
@@ -266,4 +546,11 @@ class ShardedGroup(object):
         self.ctx.remote_rw.publish(self.name, message)
 
     def size(self):
-        return defer.succeed(len(self.local_sessions))
+        """
+        Returns the number of users in the group across all instances,
+        from its member set once loaded, or else from the member count
+        kept in `RDB`.
+        """
+        if not self.loaded:
+            return self.ctx.db.getGroupSize(self.name)
+        return defer.succeed(len(self.users))
@@ -0,0 +1,82 @@
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+
+class HeartbeatWriter(object):
+    """
+    Maintains the presence of this node and, through it, of every
+    locally connected user.
+    User sessions and group memberships are written once, tagged with
+    the owning node, and stay active for as long as the node's lease
+    does. The writer renews that lease once per tick, so heartbeat
+    writes scale with the number of nodes instead of users x groups.
+    Each tick also removes the sessions and memberships of nodes whose
+    lease has expired, so that the users of a crashed node disappear
+    from the cluster.
+
+    Reports the `heartbeat.flush_latency` timing and the
+    `heartbeat.flush_errors` and `heartbeat.expired_nodes` counters.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` to write to.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param node: the id of this node.
+    :param interval: seconds between lease renewals.
+    :param mesh_address: the address of this node's mesh listener, which
+    is advertised along with the lease, if any.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, metrics, node, interval=10.0, mesh_address=None,
+                 clock=None):
+        self.db = db
+        self.metrics = metrics
+        self.node = node
+        self.interval = interval
+        self.mesh_address = mesh_address
+
+        self._clock = clock or reactor
+
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=True)
+
+    def flush(self):
+        """
+        Renews this node's lease and expires those of dead nodes.
+        Returns a Deferred which fires once both are done.
+        """
+        start = self._clock.seconds()
+
+        def cbExpired(nodes):
+            if nodes:
+                self.metrics.increment("heartbeat.expired_nodes", len(nodes))
+                log.msg("Expired the leases of nodes: %s" %
+                        ", ".join(nodes))
+
+        def cbFlushed(_):
+            self.metrics.observe("heartbeat.flush_latency",
+                                 self._clock.seconds() - start)
+
+        def ebFlush(err):
+            self.metrics.increment("heartbeat.flush_errors")
+            log.err(err, "Heartbeat flush failed")
+
+        lease = {}
+        if self.mesh_address is not None:
+            lease["mesh_address"] = self.mesh_address
+
+        d = defer.gatherResults(
+            [self.db.renewNodeLease(self.node, **lease),
+             self.db.expireNodes().addCallback(cbExpired)],
+            consumeErrors=True)
+        d.addCallbacks(cbFlushed, ebFlush)
+        return d
+
+    def stop(self):
+        """
+        Stops renewing the lease and drops it, which deactivates
+        the sessions and memberships owned by this node.
+        """
+        if self._loop.running:
+            self._loop.stop()
+        return self.db.removeNodeLease(self.node)
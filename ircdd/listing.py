@@ -0,0 +1,393 @@
+import itertools
+import re
+
+from zope.interface import implements
+
+from twisted.internet import defer, interfaces, reactor, task
+from twisted.python import log
+from twisted.words.protocols import irc
+
+from ircdd.database import maskToRegex
+
+
+def parseListFilters(tokens):
+    """
+    Parses the ELIST-style conditions of a LIST query into keyword
+    arguments for :meth:`ircdd.database.IRCDDatabase.listGroupsPage`.
+    Returns None if the tokens only name channels, which are then
+    looked up directly.
+
+    The supported conditions are:
+        `>n` lists channels with more than n users,
+        `<n` lists channels with fewer than n users,
+        `T:mask` lists channels whose topic matches the mask,
+        and any other token is a channel name mask in which
+        `*` and `?` are wildcards.
+
+    :param tokens: the comma-separated items of the LIST query.
+    """
+    filters = {}
+    name_masks = []
+    topic_masks = []
+    conditional = False
+
+    for token in tokens:
+        if token[:1] in (">", "<") and token[1:].isdigit():
+            key = "min_users" if token[0] == ">" else "max_users"
+            filters[key] = int(token[1:])
+            conditional = True
+        elif token[:2].upper() == "T:":
+            topic_masks.append(token[2:])
+            conditional = True
+        else:
+            if token.startswith("#"):
+                token = token[1:]
+            if "*" in token or "?" in token:
+                conditional = True
+            name_masks.append(token)
+
+    if not conditional:
+        return None
+
+    if name_masks:
+        filters["name_masks"] = name_masks
+    if topic_masks:
+        filters["topic_masks"] = topic_masks
+    return filters
+
+
+class GroupListProducer(object):
+    """
+    Streams the replies to a LIST query to a client, one page of
+    groups at a time. Pages are only fetched while the client's
+    transport is willing to take more data, so a LIST of every group
+    neither materializes the whole table nor floods a slow client.
+
+    :param user: the :class:`ircdd.protocol.IRCDDUser` to reply to.
+    :param db: the :class:`ircdd.database.IRCDDatabase` to read from.
+    :param filters: keyword arguments for `listGroupsPage`.
+    :param page_size: the number of groups fetched at once.
+    """
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, user, db, filters=None, page_size=100):
+        self.user = user
+        self.db = db
+        self.filters = filters or {}
+        self.page_size = page_size
+
+        self.finished = defer.Deferred()
+
+        self._after = None
+        self._paused = False
+        self._fetching = False
+        self._done = False
+
+    def start(self):
+        """
+        Starts streaming the replies.
+        Returns a Deferred which fires once the LIST is over.
+        """
+        self.user.transport.registerProducer(self, True)
+        self._fetch()
+        return self.finished
+
+    def _fetch(self):
+        if self._paused or self._fetching or self._done:
+            return
+
+        self._fetching = True
+        d = self.db.listGroupsPage(after=self._after,
+                                   limit=self.page_size,
+                                   **self.filters)
+        d.addCallbacks(self._cbPage, self._ebPage)
+
+    def _cbPage(self, groups):
+        self._fetching = False
+        if self._done:
+            return
+
+        for group in groups:
+            self.user.sendMessage(irc.RPL_LIST,
+                                  group["name"],
+                                  str(group["size"]),
+                                  ":" + group["meta"]["topic"])
+
+        if len(groups) < self.page_size:
+            self.user.sendMessage(irc.RPL_LISTEND, ":End of /LIST")
+            self._finish()
+        else:
+            self._after = groups[-1]["id"]
+            self._fetch()
+
+    def _ebPage(self, err):
+        self._fetching = False
+        log.err(err, "Failed to list groups")
+        if not self._done:
+            self.user.sendMessage(irc.RPL_LISTEND, ":End of /LIST")
+            self._finish()
+
+    def _finish(self):
+        self._done = True
+        self.user.transport.unregisterProducer()
+        self.finished.callback(None)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fetch()
+
+    def stopProducing(self):
+        if not self._done:
+            self._done = True
+            self.finished.callback(None)
+
+
+class SnapshotListProducer(GroupListProducer):
+    """
+    Streams the pre-encoded replies to a LIST query served from a
+    :class:`ListSnapshot`, one page of lines at a time, while the
+    client's transport is willing to take more data.
+
+    :param user: the :class:`ircdd.protocol.IRCDDUser` to reply to.
+    :param lines: the encoded RPL_LIST lines, without their prefix.
+    :param prefix: the encoded prefix of each line.
+    :param page_size: the number of lines written at once.
+    """
+
+    def __init__(self, user, lines, prefix, page_size=100):
+        GroupListProducer.__init__(self, user, None, page_size=page_size)
+        self._lines = iter(lines)
+        self._prefix = prefix
+
+    def _fetch(self):
+        if self._fetching:
+            return
+
+        self._fetching = True
+        while not (self._paused or self._done):
+            page = list(itertools.islice(self._lines, self.page_size))
+            if page:
+                self.user.transport.write(
+                    "".join(self._prefix + line for line in page))
+
+            if len(page) < self.page_size and not self._done:
+                self.user.sendMessage(irc.RPL_LISTEND, ":End of /LIST")
+                self._finish()
+        self._fetching = False
+
+
+class ListSnapshot(object):
+    """
+    A per-node, in-memory copy of the name, member count and topic of
+    every public group, rebuilt from the database every `interval`
+    seconds so that LIST queries do not each join the whole groups and
+    membership tables.
+
+    The snapshot only answers queries while it is at most `max_age`
+    seconds old; callers fall back to the database otherwise. Each
+    group's RPL_LIST reply is encoded once per rebuild, without the
+    prefix naming its recipient, which is added as the reply is
+    written.
+
+    Reports the `list.snapshot_build_latency` timing, the
+    `list.snapshot_groups` gauge and the `list.snapshot_errors` and
+    `list.snapshot_replies` counters.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` to read from.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param interval: seconds between rebuilds.
+    :param max_age: seconds after which the snapshot is too stale
+    to be served.
+    :param page_size: the number of groups fetched at once.
+    :param reply_page_size: the number of replies written at once.
+    :param encoding: the encoding of the pre-encoded replies.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, metrics, interval=30.0, max_age=60.0,
+                 page_size=500, reply_page_size=100, encoding="utf-8",
+                 clock=None):
+        self.db = db
+        self.metrics = metrics
+        self.interval = interval
+        self.max_age = max_age
+        self.page_size = page_size
+        self.reply_page_size = reply_page_size
+        self.encoding = encoding
+
+        self.groups = []
+        self.built = None
+
+        self._clock = clock or reactor
+        self._building = None
+
+        self._loop = task.LoopingCall(self.refresh)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=True)
+
+    def fresh(self):
+        """
+        Returns whether the snapshot may be served.
+        """
+        return (self.built is not None and
+                self._clock.seconds() - self.built <= self.max_age)
+
+    @defer.inlineCallbacks
+    def _build(self):
+        start = self._clock.seconds()
+        groups = []
+        after = None
+
+        while True:
+            page = yield self.db.listGroupsPage(after=after,
+                                                limit=self.page_size)
+            for group in page:
+                topic = group["meta"]["topic"]
+                line = u" %s %d :%s\r\n" % (
+                    group["name"], group["size"], topic)
+                groups.append((group["name"], group["size"], topic,
+                               line, line.encode(self.encoding)))
+
+            if len(page) < self.page_size:
+                break
+            after = page[-1]["id"]
+
+        self.groups = groups
+        self.built = start
+
+        self.metrics.gauge("list.snapshot_groups", len(groups))
+        self.metrics.observe("list.snapshot_build_latency",
+                             self._clock.seconds() - start)
+
+    def refresh(self):
+        """
+        Rebuilds the snapshot, unless a rebuild is already running.
+        Returns a Deferred which fires once the snapshot is rebuilt.
+        """
+        if self._building is not None:
+            return self._building
+
+        def ebBuild(err):
+            self.metrics.increment("list.snapshot_errors")
+            log.err(err, "Failed to rebuild the LIST snapshot")
+
+        def cbDone(_):
+            self._building = None
+
+        d = self._building = self._build()
+        d.addErrback(ebBuild)
+        d.addCallback(cbDone)
+        return d
+
+    def stop(self):
+        """
+        Stops rebuilding the snapshot.
+        """
+        if self._loop.running:
+            self._loop.stop()
+
+    def _matches(self, filters):
+        if not filters:
+            for entry in self.groups:
+                yield entry
+            return
+
+        name = re.compile(maskToRegex(filters["name_masks"])) \
+            if filters.get("name_masks") else None
+        topic = re.compile(maskToRegex(filters["topic_masks"])) \
+            if filters.get("topic_masks") else None
+        min_users = filters.get("min_users")
+        max_users = filters.get("max_users")
+
+        for entry in self.groups:
+            (group_name, size, group_topic, _, _) = entry
+            if min_users is not None and size <= min_users:
+                continue
+            if max_users is not None and size >= max_users:
+                continue
+            if name is not None and not name.match(group_name):
+                continue
+            if topic is not None and not topic.match(group_topic):
+                continue
+            yield entry
+
+    def _lines(self, entries, encoding):
+        for (_, _, _, text, line) in entries:
+            yield line if encoding == self.encoding else \
+                text.encode(encoding, "replace")
+
+    def reply(self, user, filters=None):
+        """
+        Streams the replies to a LIST query with the given filters
+        (as parsed by :func:`parseListFilters`) to the user, in the
+        user's encoding, through a :class:`SnapshotListProducer`.
+        Returns a Deferred which fires once the LIST is over.
+        """
+        prefix = (u":%s %s %s" % (user.hostname, irc.RPL_LIST, user.name)
+                  ).encode(user.encoding)
+
+        self.metrics.increment("list.snapshot_replies")
+        producer = SnapshotListProducer(
+            user, self._lines(self._matches(filters), user.encoding),
+            prefix, page_size=self.reply_page_size)
+        return producer.start()
+
+
+class GroupSizeReconciler(object):
+    """
+    Periodically corrects the member counts kept in the group
+    documents, which LIST and the groups' sizes are read from, against
+    the actual memberships (see
+    :meth:`ircdd.database.IRCDDatabase.reconcileGroupSizes`).
+
+    Reports the `groups.size_drift` and `groups.reconcile_errors`
+    counters.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` to correct.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param interval: seconds between two reconciliations.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, metrics, interval=300.0, clock=None):
+        self.db = db
+        self.metrics = metrics
+        self.interval = interval
+
+        self._clock = clock or reactor
+
+        self._loop = task.LoopingCall(self.reconcile)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=False)
+
+    def reconcile(self):
+        """
+        Corrects the counts which drifted.
+        Returns a Deferred which fires once they are corrected.
+        """
+        def cbReconciled(drifted):
+            if drifted:
+                self.metrics.increment("groups.size_drift", len(drifted))
+                log.msg("Corrected the member counts of groups: %s" %
+                        ", ".join("%s (%d, was %d)" % (group["id"],
+                                                       group["actual"],
+                                                       group["size"])
+                                  for group in drifted))
+
+        def ebReconciled(err):
+            self.metrics.increment("groups.reconcile_errors")
+            log.err(err, "Failed to reconcile the member counts")
+
+        d = self.db.reconcileGroupSizes()
+        d.addCallbacks(cbReconciled, ebReconciled)
+        return d
+
+    def stop(self):
+        """
+        Stops reconciling the counts.
+        """
+        if self._loop.running:
+            self._loop.stop()
@@ -0,0 +1,272 @@
+import struct
+
+from zope.interface import implements
+
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log
+
+from ircdd import envelope
+from ircdd.routing import INBOX_PREFIX
+from ircdd.transport import IMessageTransport
+
+# Length of the topic name which starts every frame.
+TOPIC_HEADER = struct.Struct("!H")
+
+
+def encodeFrame(topic, msg_body, origin, recipient=None):
+    """
+    Returns the mesh frame which carries the message to `topic`: the
+    topic name, followed by the message's binary envelope (see
+    :mod:`ircdd.envelope`).
+    """
+    topic = topic.encode("utf-8")
+    return "".join([TOPIC_HEADER.pack(len(topic)), topic,
+                    envelope.encode(msg_body, origin, recipient)])
+
+
+def decodeFrame(frame):
+    """
+    Returns the `(topic, envelope)` tuple carried by a mesh frame.
+    Raises :class:`ircdd.envelope.EnvelopeError` if the frame is invalid.
+    """
+    if len(frame) < TOPIC_HEADER.size:
+        raise envelope.EnvelopeError("Truncated frame")
+
+    (length,) = TOPIC_HEADER.unpack_from(frame)
+    start = TOPIC_HEADER.size
+    topic = frame[start:start + length].decode("utf-8")
+    return topic, envelope.Envelope(frame[start + length:])
+
+
+class MeshMessage(object):
+    """
+    A message delivered over a direct connection between nodes.
+    There is no broker to hand it back to, so it cannot be requeued.
+    """
+
+    def __init__(self, received):
+        self.envelope = received
+        self.parsed_msg = received.parsed()
+        self.attempts = 1
+
+        self._responded = False
+
+    def finish(self):
+        self._responded = True
+
+    def requeue(self, **kwargs):
+        self._responded = True
+        log.msg("Dropped a requeued message from %s" % self.envelope.origin)
+
+    def touch(self):
+        pass
+
+    def has_responded(self):
+        return self._responded
+
+
+class MeshProtocol(basic.Int32StringReceiver):
+    """
+    One end of a connection between two nodes, over which length
+    prefixed frames flow from the dialing node to the dialed one.
+    """
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, mesh, peer=None):
+        self.mesh = mesh
+        self.peer = peer
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+
+    def stringReceived(self, frame):
+        self.mesh.receiveFrame(frame)
+
+    def connectionLost(self, reason):
+        self.mesh.disconnected(self)
+
+
+class MeshServerFactory(protocol.ServerFactory):
+    """
+    Accepts the connections of the peers of a :class:`MeshTransport`.
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def buildProtocol(self, addr):
+        return MeshProtocol(self.mesh)
+
+
+class MeshTransport(object):
+    """
+    An :class:`ircdd.transport.IMessageTransport` which delivers the
+    messages published to the inbox topic of a node (see
+    :class:`ircdd.routing.NodeRouter`) over a persistent TCP connection
+    to that node, skipping the broker. Every other message, and those
+    published while the connection to their node is not up, go through
+    the fallback transport.
+
+    Peers are found through the mesh addresses the nodes advertise with
+    their leases. A connection is opened the first time a node is
+    published to, and a node which cannot be reached is only tried again
+    after `retry_delay` seconds. Messages may be reordered while the
+    connection to a node comes up or goes down.
+
+    Reports the `mesh.sent`, `mesh.received`, `mesh.fallbacks` and
+    `mesh.connect_errors` counters and the `mesh.peers` gauge.
+
+    :param fallback: the :class:`ircdd.transport.IMessageTransport`
+    which carries the messages the mesh does not.
+    :param db: the :class:`ircdd.database.IRCDDatabase` which knows the
+    mesh addresses of the nodes.
+    :param server_name: the name of this node.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param connect_timeout: seconds to wait for a connection to a peer.
+    :param retry_delay: seconds before connecting again to a peer which
+    could not be reached.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    :param connect: a callable taking a host, a port and a protocol,
+    which returns a Deferred firing once the protocol is connected.
+    Defaults to connecting over TCP.
+    """
+    implements(IMessageTransport)
+
+    def __init__(self, fallback, db, server_name, metrics, connect_timeout=1.0,
+                 retry_delay=5.0, clock=None, connect=None):
+        self.fallback = fallback
+        self.db = db
+        self.server_name = server_name
+        self.metrics = metrics
+        self.connect_timeout = connect_timeout
+        self.retry_delay = retry_delay
+
+        self._clock = clock or reactor
+        self._connect = connect or self._connectTCP
+
+        self._callbacks = {}
+        self._subscribers = {}
+        self._peers = {}
+        self._connecting = set()
+        self._retry_at = {}
+
+    def _connectTCP(self, host, port, proto):
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port,
+                                                timeout=self.connect_timeout)
+        return endpoints.connectProtocol(endpoint, proto)
+
+    def serverFactory(self):
+        """
+        Returns the factory which accepts the connections of the peers.
+        """
+        return MeshServerFactory(self)
+
+    def subscribe(self, topic, callback):
+        self._callbacks[topic] = callback
+        self._subscribers[topic] = self._subscribers.get(topic, 0) + 1
+        self.fallback.subscribe(topic, callback)
+
+    def unsubscribe(self, topic):
+        subscribers = self._subscribers[topic] - 1
+        if subscribers > 0:
+            self._subscribers[topic] = subscribers
+        else:
+            del self._subscribers[topic]
+            del self._callbacks[topic]
+        self.fallback.unsubscribe(topic)
+
+    def publish(self, topic, msg_body, callback=None, recipient=None):
+        node = topic[len(INBOX_PREFIX):] \
+            if topic.startswith(INBOX_PREFIX) else None
+
+        peer = self._peers.get(node)
+        if peer is not None:
+            peer.sendString(encodeFrame(topic, msg_body, self.server_name,
+                                        recipient))
+            self.metrics.increment("mesh.sent")
+            if callback is not None:
+                callback(None, "OK")
+            return
+
+        if node is not None:
+            self.metrics.increment("mesh.fallbacks")
+            self._connectPeer(node)
+        return self.fallback.publish(topic, msg_body, callback=callback,
+                                     recipient=recipient)
+
+    def flush(self):
+        self.fallback.flush()
+
+    def _connectPeer(self, node):
+        if node in self._connecting or node == self.server_name:
+            return
+        if self._retry_at.get(node, 0) > self._clock.seconds():
+            return
+
+        self._connecting.add(node)
+
+        def cbAddress(address):
+            if not address:
+                raise ValueError("%s has no mesh address" % node)
+            host, port = address.rsplit(":", 1)
+            return self._connect(host, int(port), MeshProtocol(self, node))
+
+        def cbConnected(proto):
+            self._retry_at.pop(node, None)
+            self._peers[node] = proto
+            self.metrics.gauge("mesh.peers", len(self._peers))
+            log.msg("Connected to the mesh peer %s" % node)
+
+        def ebConnect(err):
+            self._retry_at[node] = self._clock.seconds() + self.retry_delay
+            self.metrics.increment("mesh.connect_errors")
+            log.msg("Could not connect to the mesh peer %s: %s" %
+                    (node, err.getErrorMessage()))
+
+        def cbDone(_):
+            self._connecting.discard(node)
+
+        d = self.db.lookupNodeAddress(node)
+        d.addCallback(cbAddress)
+        d.addCallbacks(cbConnected, ebConnect)
+        d.addCallback(cbDone)
+
+    def receiveFrame(self, frame):
+        """
+        Hands a frame read from a peer to the callback of its topic.
+        """
+        try:
+            topic, received = decodeFrame(frame)
+            message = MeshMessage(received)
+        except ValueError as e:
+            log.err("Discarding mesh frame: %s" % e)
+            return
+
+        self.metrics.increment("mesh.received")
+
+        callback = self._callbacks.get(topic)
+        if callback is None:
+            return
+
+        try:
+            callback(message)
+        except Exception:
+            log.err(None, "Failed to handle a message on %s" % topic)
+
+    def disconnected(self, proto):
+        """
+        Forgets the connection of a peer once it is lost.
+        """
+        if proto.peer is not None and self._peers.get(proto.peer) is proto:
+            del self._peers[proto.peer]
+            self.metrics.gauge("mesh.peers", len(self._peers))
+            log.msg("Lost the connection to the mesh peer %s" % proto.peer)
+
+    def close(self):
+        """
+        Closes the connections to the peers.
+        """
+        for proto in self._peers.values():
+            proto.transport.loseConnection()
+        return defer.succeed(None)
@@ -0,0 +1,53 @@
+"""
+Lightweight in-process metrics for an ircdd node.
+"""
+
+
+class Metrics(object):
+    """
+    A registry of named counters, gauges and timings kept in memory.
+    Counters only go up, gauges hold the last value they were set to,
+    and timings keep the count, total, maximum and last value of every
+    observation made on them.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        """
+        Adds value to the named counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets the named gauge to value.
+        """
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        """
+        Records an observation (a size, a duration in seconds...)
+        on the named timing.
+        """
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = dict(count=0, total=0,
+                                               max=value, last=value)
+
+        timing["count"] += 1
+        timing["total"] += value
+        timing["max"] = max(timing["max"], value)
+        timing["last"] = value
+
+    def snapshot(self):
+        """
+        Returns a copy of every metric, suitable for reporting.
+        """
+        return dict(counters=dict(self.counters),
+                    gauges=dict(self.gauges),
+                    timings=dict((name, dict(timing)) for (name, timing)
+                                 in self.timings.iteritems()))
@@ -6,6 +6,38 @@ from twisted.words import iwords, ewords
 from twisted.words.protocols import irc
 from twisted.internet import defer
 
+from ircdd.listing import GroupListProducer, parseListFilters
+
+
+def encodePrivmsg(sender_name, hostname, recipient_name, text, encoding):
+    """
+    Returns the PRIVMSG lines which carry the text from the sender to
+    the recipient, encoded and ready to be written to a transport.
+    """
+    prefix = ":%s!%s@%s PRIVMSG %s :" % (
+        sender_name, sender_name, hostname, recipient_name)
+    return "".join((prefix + irc.lowQuote(L) + "\r\n").encode(encoding)
+                   for L in text.splitlines())
+
+
+def encodeJoin(user_name, user_hostname, channel, encoding):
+    """
+    Returns the JOIN line announcing that the user joined the channel,
+    encoded and ready to be written to a transport.
+    """
+    return (u":%s!%s@%s JOIN %s\r\n" % (
+        user_name, user_name, user_hostname, channel)).encode(encoding)
+
+
+def encodePart(user_name, hostname, channel, reason, encoding):
+    """
+    Returns the PART line announcing that the user left the channel,
+    encoded and ready to be written to a transport.
+    """
+    return (u":%s!%s@%s PART %s :%s\r\n" % (
+        user_name, user_name, hostname, channel,
+        reason or u"leaving")).encode(encoding, "replace")
+
 
 class ProxyIRCDDUser():
     """
@@ -29,6 +61,10 @@ class ProxyIRCDDUser():
 class IRCDDUser(IRCUser):
     password = "no password"
 
+    # Serializes the LIST queries of this client, since only one
+    # of them can stream to the transport at a time.
+    _listLock = None
+
     def receive(self, sender_name, recipient, message):
         """
         Receives a message from the sender for the given recipient.
@@ -49,11 +85,17 @@ class IRCDDUser(IRCUser):
 
         text = message.get("text", "<an unrepresentable message>")
 
-        for L in text.splitlines():
-            self.privmsg("%s!%s@%s" % (sender_name,
-                                       sender_name,
-                                       self.hostname),
-                         recipient_name, L)
+        self.receiveEncoded(encodePrivmsg(sender_name, self.hostname,
+                                          recipient_name, text,
+                                          self.encoding))
+
+    def receiveEncoded(self, data):
+        """
+        Writes lines which are already formatted and encoded, such as
+        those built by :func:`encodePrivmsg`, to the client.
+        Groups use it to build a message once for all their local users.
+        """
+        self.transport.write(data)
 
     def userJoined(self, group, user_name, user_hostname):
         self.join(
@@ -166,7 +208,9 @@ class IRCDDUser(IRCUser):
         """List query
 
         Return information about the indicated channels, or about all
-        channels if none are specified.
+        channels if none are specified. Channel masks and the ELIST
+        conditions understood by :func:`ircdd.listing.parseListFilters`
+        restrict the listing to the matching channels.
 
         Parameters: [ <channel> *( "," <channel> ) [ <target> ] ]
         """
@@ -175,8 +219,9 @@ class IRCDDUser(IRCUser):
         # >> :orwell.freenode.net 322 exarkun #python 358 :The Python
         # programming language
         # >> :orwell.freenode.net 323 exarkun :End of /LIST
+        filters = {}
+
         if params:
-            # Return information about indicated channels
             try:
                 channels = params[0].decode(self.encoding).split(',')
             except UnicodeDecodeError:
@@ -185,37 +230,73 @@ class IRCDDUser(IRCUser):
                     ":No such channel (could not decode your unicode!)")
                 return
 
-            groups = []
+            filters = parseListFilters(channels)
 
-            for ch in channels:
-                if ch.startswith('#'):
-                    ch = ch[1:]
-                groups.append(defer.succeed(self.ctx.db.lookupGroup(ch)))
+        if filters is not None:
+            # Stream the channels matching the conditions, or all
+            # channels, page by page.
+            return self._listGroups(filters)
 
-            groups = defer.DeferredList(groups, consumeErrors=True)
-            groups.addCallback(lambda gs: [r for (s, r) in gs if s])
-        else:
-            # Return information about all channels
-            groups = defer.succeed(iter(self.ctx.db.listGroups()))
+        # Return information about indicated channels
+        groups = []
 
-        def cbGroups(groups):
-            def emitInfo(group):
-                return (group["name"],
-                        len(group["users"]),
+        for ch in channels:
+            if ch.startswith('#'):
+                ch = ch[1:]
+            groups.append(self._lookupGroup(ch))
+
+        def cbGroups(results):
+            self.list([(group["name"],
+                        group.get("size", len(group["users"])),
                         group["meta"]["topic"])
+                       for (success, group) in results
+                       if success and group])
+
+        d = defer.DeferredList(groups, consumeErrors=True)
+        return d.addCallback(cbGroups)
+
+    def _lookupGroup(self, name):
+        """
+        Returns a Deferred which fires with the name, members and meta of
+        the group. They are read from the local shard when this node has
+        a loaded one, as the group feeds keep its members current, and
+        from the database otherwise.
+        """
+        group = self.realm.groups.get(name.lower())
+        if group is not None and group.loaded:
+            return defer.succeed({"name": group.name,
+                                  "users": group.users,
+                                  "size": len(group.users),
+                                  "meta": group.meta})
+
+        return self.ctx.db.lookupGroup(name)
 
-            d = defer.DeferredList([
-                defer.succeed(emitInfo(group)) for group in groups])
+    def _listGroups(self, filters):
+        """
+        Sends the LIST replies for the groups matching the filters,
+        from the node's :class:`ircdd.listing.ListSnapshot` while it is
+        fresh enough, or else streamed from the database through a
+        :class:`ircdd.listing.GroupListProducer`.
+        """
+        if self._listLock is None:
+            self._listLock = defer.DeferredLock()
+
+        def start():
+            snapshot = self.ctx.get("list_snapshot")
+            if snapshot is not None and snapshot.fresh():
+                return snapshot.reply(self, filters)
+
+            producer = GroupListProducer(
+                self, self.ctx.db, filters,
+                page_size=int(self.ctx.get("list_page_size", 100)))
+            return producer.start()
 
-            d.addCallback(lambda results:
-                          self.list([r for (s, r) in results if s]))
-            return d
-        groups.addCallback(cbGroups)
+        return self._listLock.run(start)
 
     def _channelWho(self, group):
         self.who(self.name, "#" + group["name"],
                  [(user, self.hostname, self.realm.name, user, "H", 0, user)
-                  for user in group["users"].iterkeys()])
+                  for user in group["users"]])
 
     def irc_WHO(self, prefix, params):
         """Who query
@@ -241,7 +322,7 @@ class IRCDDUser(IRCUser):
                 self.sendMessage(
                     irc.RPL_ENDOFWHO, channelOrUser,
                     ":End of /WHO list.")
-            d = defer.succeed(self.ctx.db.lookupGroup(channelOrUser[1:]))
+            d = self._lookupGroup(channelOrUser[1:])
             d.addCallbacks(self._channelWho, ebGroup)
         else:
             def ebUser(err):
@@ -258,12 +339,29 @@ class IRCDDUser(IRCUser):
         Parameters: [ <target> ] <mask> *( "," <mask> )
         """
         def cbUser(user):
+            session = user and user["session"]
+            if not session:
+                self.sendMessage(
+                    irc.ERR_NOSUCHNICK,
+                    params[0],
+                    ":No such nick/channel")
+                return
+
+            # The session only records the last message of a user every
+            # so often, so the user's own node knows better.
+            local_user = self.realm.users.get(user["nickname"])
+            if local_user is not None:
+                last_message = local_user.lastMessage
+            else:
+                last_message = time.mktime(
+                    session["last_message"].timetuple())
+
             self.whois(
                 self.name,
                 user["nickname"], user["nickname"], self.realm.name,
                 user["nickname"], self.realm.name, 'Hi mom!', False,
-                time.mktime(user["session"]["last_heartbeat"].timetuple()),
-                time.mktime(user["session"]["last_heartbeat"].timetuple()),
+                int(time.time() - last_message),
+                time.mktime(session["session_start"].timetuple()),
                 ['#' + group["name"] for group in user["groups"]])
 
         def ebUser(err):
@@ -282,5 +380,4 @@ class IRCDDUser(IRCUser):
                 ":No such nick/channel")
             return
 
-        defer.succeed(self.ctx.db.lookupUser(user)).addCallbacks(cbUser,
-                                                                 ebUser)
+        self.ctx.db.lookupUser(user).addCallbacks(cbUser, ebUser)
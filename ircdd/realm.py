@@ -1,8 +1,10 @@
+from collections import OrderedDict
+
 from zope.interface import implements
 
 from twisted.cred import portal
 from twisted.words import ewords, iwords
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.python import failure
 
 from ircdd.user import ShardedUser
@@ -37,13 +39,20 @@ class ShardedRealm(object):
         self.createUserOnRequest = ctx["user_on_request"]
         self.createGroupOnRequest = ctx["group_on_request"]
 
+        # Options of the large group mode, see ShardedGroup.
+        self.groupOptions = dict(
+            large_threshold=int(ctx.get("large_group_threshold", 0)),
+            batch_window=float(ctx.get("large_group_batch_window", 1.0)),
+            idle_timeout=float(ctx.get("large_group_idle_timeout", 0.0)))
+
         self.users = {}
 
         # Groups contain proxies to groups that the local users are
         # interested in. The group state and meta found in the DB
         # are the authoritative versions of the data.
         # The local ShardedGroup serves as a local relay and cache.
-        self.groups = {}
+        # Groups are kept from the least to the most recently used.
+        self.groups = OrderedDict()
 
     def userFactory(self, name):
         """
@@ -59,7 +68,7 @@ class ShardedRealm(object):
         The ShardedGroup severs as a controller to the group's
         model.
         """
-        return ShardedGroup(self.ctx, name)
+        return ShardedGroup(self.ctx, name, **self.groupOptions)
 
     def logoutFactory(self, avatar, facet):
         def logout():
@@ -132,17 +141,23 @@ class ShardedRealm(object):
         if local_user:
             return defer.succeed(local_user)
 
-        remote_user = self.ctx.db.lookupUser(name)
-        user_session = self.ctx.db.lookupUserSession(name)
+        def cbRemote(results):
+            remote_user, user_session = results
+
+            # User exists and session is active, so he must be
+            # connected to some remote
+            if remote_user and user_session and user_session["active"]:
+                return ShardedUser(self.ctx,
+                                   name,
+                                   ProxyIRCDDUser(self.ctx, name),
+                                   local=False)
 
-        # User exists and session is active, so he must be
-        # connected to some remote
-        if remote_user and user_session and user_session["active"]:
-            return defer.succeed(ShardedUser(self.ctx,
-                                             name,
-                                             ProxyIRCDDUser(self.ctx, name)))
+            return failure.Failure(ewords.NoSuchUser(name))
 
-        return defer.fail(failure.Failure(ewords.NoSuchUser(name)))
+        d = defer.gatherResults([self.ctx.db.lookupUser(name),
+                                 self.ctx.db.lookupUserSession(name)],
+                                consumeErrors=True)
+        return d.addCallback(cbRemote)
 
     def createUser(self, name):
         """
@@ -170,14 +185,17 @@ class ShardedRealm(object):
 
     def lookupGroup(self, name):
         """
-        Looks for the group in the local shard's store.
+        Looks for the group in the local shard's store, and
+        returns it once loaded.
         """
         assert isinstance(name, unicode)
         name = name.lower()
 
-        group = self.groups.get(name)
+        group = self.groups.pop(name, None)
         if group:
-            return defer.succeed(group)
+            self.groups[name] = group
+            group.touched = True
+            return group.load()
 
         return defer.fail(failure.Failure(ewords.NoSuchGroup(name)))
 
@@ -198,27 +216,116 @@ class ShardedRealm(object):
             return defer.fail(failure.Failure(ewords.DuplicateGroup()))
 
         self.groups[group.name] = group
+        group.touched = True
         return defer.succeed(group)
 
+    def removeGroup(self, name):
+        """
+        Drops the group from the local shard's store and closes it.
+        """
+        self.groups.pop(name).close()
+
     def createGroup(self, name):
         assert isinstance(name, unicode)
 
         def cbLookup(group):
             return failure.Failure(ewords.DuplicateGroup(name))
 
+        def cbGroup(group):
+            if not group:
+                return self.ctx.db.createGroup(name, "public")
+
         def ebLookup(err):
             err.trap(ewords.NoSuchGroup)
-            group = self.ctx.db.lookupGroup(name)
 
-            if not group:
-                self.ctx.db.createGroup(name, "public")
-
-            return self.groupFactory(name)
+            d = self.ctx.db.lookupGroup(name)
+            d.addCallback(cbGroup)
+            d.addCallback(lambda _: self.groupFactory(name))
+            return d
 
         name = name.lower()
 
         d = self.lookupGroup(name)
         d.addCallbacks(cbLookup, ebLookup)
         d.addCallback(self.addGroup)
+        d.addCallback(lambda group: group.load())
 
         return d
+
+
+class GroupEvictor(object):
+    """
+    Drops the groups of a :class:`ShardedRealm` which have not had a
+    local user for `idle_timeout` seconds, along with their feeds and
+    topic subscription, so that a node only keeps the groups that are
+    in use. Once the realm holds more than `max_groups` groups, the
+    least recently used groups without local users are dropped right
+    away. A group looked up since the previous sweep is left alone.
+
+    Reports the `groups.evicted` counter and the `groups.local` gauge.
+
+    :param realm: the :class:`ShardedRealm` whose groups are evicted.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param idle_timeout: seconds after which a group without local
+    users is evicted.
+    :param max_groups: the number of groups over which idle groups are
+    evicted early.
+    :param interval: seconds between two sweeps.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, realm, metrics, idle_timeout=300.0, max_groups=10000,
+                 interval=30.0, clock=None):
+        self.realm = realm
+        self.metrics = metrics
+        self.idle_timeout = idle_timeout
+        self.max_groups = max_groups
+        self.interval = interval
+
+        self._clock = clock or reactor
+        # Maps the name of each idle group to when it was first seen
+        # idle.
+        self._idle_since = {}
+
+        self._loop = task.LoopingCall(self.sweep)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=False)
+
+    def sweep(self):
+        """
+        Evicts the groups which are idle for too long, or over the
+        limit, and returns their names.
+        """
+        now = self._clock.seconds()
+        idle = []
+
+        for (name, group) in self.realm.groups.iteritems():
+            touched, group.touched = group.touched, False
+            if touched or not group.isIdle():
+                self._idle_since.pop(name, None)
+            else:
+                idle.append((name, self._idle_since.setdefault(name, now)))
+
+        excess = len(self.realm.groups) - self.max_groups
+        evicted = []
+        for (name, since) in idle:
+            if excess > 0 or now - since >= self.idle_timeout:
+                self.realm.removeGroup(name)
+                del self._idle_since[name]
+                evicted.append(name)
+                excess -= 1
+
+        for name in set(self._idle_since) - set(self.realm.groups):
+            del self._idle_since[name]
+
+        if evicted:
+            self.metrics.increment("groups.evicted", len(evicted))
+        self.metrics.gauge("groups.local", len(self.realm.groups))
+        return evicted
+
+    def stop(self):
+        """
+        Stops evicting groups.
+        """
+        if self._loop.running:
+            self._loop.stop()
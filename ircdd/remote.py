@@ -1,8 +1,19 @@
 import nsq
-import json
+import random
+import sys
+import time
+import tornado.ioloop
+import urllib
 import requests
 from requests.exceptions import ConnectionError, Timeout
+from twisted.internet import defer, reactor, task, threads
 from twisted.python import log
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from zope.interface import implements
+
+from ircdd import envelope
+from ircdd.routing import INBOX_PREFIX, inboxTopic
+from ircdd.transport import IMessageTransport
 
 
 def _create_topic(topic, lookupd_http_addresses):
@@ -99,7 +110,7 @@ def _create_channel(topic, chan, lookupd_http_addresses):
         params = {"topic": topic, "channel": chan}
 
         try:
-            response = requests.get(endpoint, params=params)
+            response = requests.get(endpoint, params=params, timeout=5)
         except (ConnectionError, Timeout) as e:
             log.err("Error making request to NSQLookupd: %s" % str(e))
         else:
@@ -125,7 +136,7 @@ def _channels(topic, lookupd_http_addresses):
         params = {"topic": topic}
 
         try:
-            response = requests.get(endpoint, params=params)
+            response = requests.get(endpoint, params=params, timeout=5)
         except (ConnectionError, Timeout) as e:
             log.err("Error making request to NSQLookupd: %s" % str(e))
         else:
@@ -155,7 +166,7 @@ def _delete_channel(topic, chan, lookupd_http_addresses):
         params = {"topic": topic, "channel": chan}
 
         try:
-            response = requests.get(endpoint, params=params)
+            response = requests.get(endpoint, params=params, timeout=5)
         except (ConnectionError, Timeout) as e:
             log.err("Error making request to NSQLookupd: %s" % str(e))
         else:
@@ -164,10 +175,367 @@ def _delete_channel(topic, chan, lookupd_http_addresses):
                         (chan, topic, endpoint, str(response)))
 
 
+CHANNEL_PREFIX = "ircdd."
+EPHEMERAL_SUFFIX = "#ephemeral"
+
+
+def channelName(node, ephemeral=False):
+    """
+    Returns the name of the channel on which the given node reads
+    its topics.
+    """
+    channel = CHANNEL_PREFIX + node
+    return channel + EPHEMERAL_SUFFIX if ephemeral else channel
+
+
+def channelNode(channel):
+    """
+    Returns the name of the node which reads from the given channel,
+    or None if the channel was not created by an ircdd node.
+    """
+    if not channel.startswith(CHANNEL_PREFIX):
+        return None
+    if channel.endswith(EPHEMERAL_SUFFIX):
+        channel = channel[:-len(EPHEMERAL_SUFFIX)]
+    return channel[len(CHANNEL_PREFIX):] or None
+
+
+class LookupdProvisioner(object):
+    """
+    Creates topics and channels on every `NSQLookupd` without blocking
+    the reactor.
+
+    Requests are made with Twisted's HTTP client, in parallel across
+    the lookupd addresses and with at most `concurrency` of them in
+    flight at once. Provisioning requests made within `batch_delay`
+    seconds of each other are sent as one batch, in which each topic
+    is only created once. Topics and channels which were provisioned
+    successfully are remembered, so provisioning them again costs no
+    request at all; failed ones are retried on the next request.
+
+    :param lookupd_addresses: a list of address strings that point
+    to `NSQLookupd` instances.
+    :type list:
+
+    :param batch_delay: seconds to wait for more requests before
+    sending a batch.
+    :param concurrency: the maximum number of requests in flight.
+    :param timeout: seconds after which a request is abandoned.
+    :param agent: an `IAgent` provider, defaults to a persistent
+    `twisted.web.client.Agent`.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, lookupd_addresses, batch_delay=0.05, concurrency=16,
+                 timeout=5.0, agent=None, clock=None):
+        self._lookupd_addresses = lookupd_addresses
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+
+        self._clock = clock or reactor
+        self._agent = agent or Agent(reactor,
+                                     connectTimeout=timeout,
+                                     pool=HTTPConnectionPool(reactor))
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+
+        self._topics = set()
+        # Maps each (topic, channel) to True once it is provisioned,
+        # or to the list of Deferreds waiting for it until then.
+        self._channels = {}
+        self._queue = []
+        self._flush = None
+
+    def provision(self, topic, channel):
+        """
+        Makes sure the topic and the channel on it exist.
+        Returns a Deferred which fires with whether they were
+        provisioned on every lookupd.
+        """
+        key = (topic, channel)
+        state = self._channels.get(key)
+        if state is True:
+            return defer.succeed(True)
+
+        d = defer.Deferred()
+        if state is None:
+            self._channels[key] = [d]
+            self._queue.append(key)
+            if self._flush is None:
+                self._flush = self._clock.callLater(self.batch_delay,
+                                                    self.flush)
+        else:
+            state.append(d)
+        return d
+
+    def flush(self):
+        """
+        Sends the pending provisioning requests.
+        Returns a Deferred which fires once they are all answered.
+        """
+        self._flush = None
+        batch, self._queue = self._queue, []
+
+        topics = {}
+        for topic in set(topic for (topic, _) in batch):
+            if topic in self._topics:
+                topics[topic] = defer.succeed(True)
+            else:
+                topics[topic] = self._requestAll("create_topic",
+                                                 {"topic": topic})
+                topics[topic].addCallback(self._cbTopic, topic)
+
+        done = []
+        for (topic, channel) in batch:
+            d = defer.Deferred()
+            topics[topic].addCallback(self._chainChannel, d, topic, channel)
+            d.addCallback(self._cbChannel, (topic, channel))
+            done.append(d)
+        return defer.gatherResults(done)
+
+    def _cbTopic(self, ok, topic):
+        if ok:
+            self._topics.add(topic)
+        return ok
+
+    def _chainChannel(self, ok, d, topic, channel):
+        if ok:
+            params = {"topic": topic, "channel": channel}
+            self._requestAll("create_channel", params).chainDeferred(d)
+        else:
+            d.callback(False)
+        return ok
+
+    def _cbChannel(self, ok, key):
+        waiters = self._channels.pop(key, [])
+        if ok:
+            self._channels[key] = True
+        for d in waiters:
+            d.callback(ok)
+        return ok
+
+    def _requestAll(self, path, params):
+        d = defer.DeferredList([self._request(addr, path, params)
+                                for addr in self._lookupd_addresses])
+        return d.addCallback(
+            lambda results: all(success and ok for (success, ok) in results))
+
+    def _request(self, addr, path, params):
+        query = urllib.urlencode(dict(
+            (key, value.encode("utf-8") if isinstance(value, unicode)
+             else value) for (key, value) in params.items()))
+        url = "http://%s/%s?%s" % (addr, path, query)
+
+        def request():
+            d = self._agent.request("GET", url)
+            d.addTimeout(self.timeout, self._clock)
+            return d.addCallback(cbResponse)
+
+        def cbResponse(response):
+            if response.code != 200:
+                log.err("Failed request %s to NSQLookupd: %s" %
+                        (url, response.code))
+            return readBody(response).addCallback(
+                lambda _: response.code == 200)
+
+        def ebRequest(err):
+            log.err(err, "Error making request to NSQLookupd: %s" % url)
+            return False
+
+        return self._semaphore.run(request).addErrback(ebRequest)
+
+
+class ClosableReader(nsq.Reader):
+    """
+    An `nsq.Reader` which can be closed: the `Reader` of pynsq 0.6.4
+    has no way to stop polling lookupd and consuming its topic. Its
+    `max_in_flight` can also be changed while it is running.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.closed = False
+        self._periodic_callbacks = []
+        self._poll_start = None
+        super(ClosableReader, self).__init__(*args, **kwargs)
+
+    def _run(self):
+        # The same as `nsq.Reader._run`, except that the periodic
+        # callbacks are kept, so that they can be stopped.
+        if self.closed:
+            return
+
+        assert self.message_handler, \
+            "you must specify the Reader's message_handler"
+
+        for addr in self.nsqd_tcp_addresses:
+            address, port = addr.split(":")
+            self.connect_to_nsqd(address, int(port))
+
+        redistribute = tornado.ioloop.PeriodicCallback(
+            self._redistribute_rdy_state, 5 * 1000, io_loop=self.io_loop)
+        redistribute.start()
+        self._periodic_callbacks.append(redistribute)
+
+        if not self.lookupd_http_addresses:
+            return
+        self.query_lookupd()
+
+        poll = tornado.ioloop.PeriodicCallback(
+            self.query_lookupd, self.lookupd_poll_interval * 1000,
+            io_loop=self.io_loop)
+        self._periodic_callbacks.append(poll)
+
+        # Spreads the polls of the readers, like pynsq does.
+        delay = (random.random() * self.lookupd_poll_interval *
+                 self.lookupd_poll_jitter)
+        self._poll_start = self.io_loop.add_timeout(time.time() + delay,
+                                                    poll.start)
+
+    def connect_to_nsqd(self, host, port):
+        # A lookupd query may still complete once the reader is closed.
+        if self.closed:
+            return
+        return super(ClosableReader, self).connect_to_nsqd(host, port)
+
+    def close(self):
+        """
+        Stops polling lookupd and closes the connections to nsqd.
+        """
+        self.closed = True
+
+        if self._poll_start is not None:
+            self.io_loop.remove_timeout(self._poll_start)
+            self._poll_start = None
+        for periodic in self._periodic_callbacks:
+            periodic.stop()
+        self._periodic_callbacks = []
+
+        for conn in self.conns.values():
+            conn.close()
+
+    def set_max_in_flight(self, max_in_flight):
+        """
+        Sets the highest number of messages in flight and sends the
+        matching RDY count to every connection right away, rather than
+        once their current counts run low. A reader in backoff only
+        applies it as it leaves backoff.
+        """
+        self.max_in_flight = max_in_flight
+        if self.closed or not self.conns or self.disabled() or \
+                self.backoff_block or self.backoff_timer.get_interval():
+            return
+
+        # `_send_rdy` counts the current RDY of a connection against the
+        # new limit, so it would refuse to lower it. Connections left at
+        # 0 take turns at RDY 1 as pynsq redistributes it.
+        value = max_in_flight // len(self.conns)
+        for conn in self.conns.values():
+            rdy = min(value, conn.max_rdy_count)
+            previous = conn.rdy
+            if rdy == previous:
+                continue
+            if conn.rdy_timeout:
+                self.io_loop.remove_timeout(conn.rdy_timeout)
+                conn.rdy_timeout = None
+            if conn.send_rdy(rdy):
+                self.total_rdy = max(self.total_rdy - previous + rdy, 0)
+
+
+class BatchingPublisher(object):
+    """
+    Buffers the messages published to each topic and sends them
+    together with a single `MPUB`.
+
+    A topic's buffer is flushed `window` seconds after its first
+    message was buffered, or as soon as it holds `size` messages,
+    whichever comes first. The window is never extended, so no message
+    waits longer than `window` seconds before it is sent. Once a batch
+    completes, the callback of every message in it is called with the
+    outcome of the `MPUB`.
+
+    Reports the `publish.batch_size`, `publish.batch_delay` (how long
+    the oldest message of a batch was buffered) and
+    `publish.flush_latency` (how long the `MPUB` took) timings.
+
+    :param writer: the `nsq.Writer` to publish with.
+    :param window: the maximum number of seconds a message is buffered.
+    :param size: the number of messages which triggers a flush.
+    :param metrics: an optional :class:`ircdd.metrics.Metrics`
+    to report to.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, writer, window=0.01, size=100, metrics=None,
+                 clock=None):
+        self._writer = writer
+        self.window = window
+        self.size = size
+        self.metrics = metrics
+
+        self._clock = clock or reactor
+        self._batches = {}
+
+    def pub(self, topic, msg, callback=None):
+        """
+        Buffers the message for the topic, in the manner of
+        :meth:`nsq.Writer.pub`.
+        """
+        batch = self._batches.get(topic)
+        if batch is None:
+            batch = self._batches[topic] = dict(
+                started=self._clock.seconds(),
+                msgs=[],
+                callbacks=[],
+                flush=self._clock.callLater(self.window, self.flush, topic))
+
+        batch["msgs"].append(msg)
+        batch["callbacks"].append(callback)
+
+        if len(batch["msgs"]) >= self.size:
+            self.flush(topic)
+
+    def flush(self, topic):
+        """
+        Sends the messages buffered for the topic.
+        """
+        batch = self._batches.pop(topic, None)
+        if batch is None:
+            return
+
+        if batch["flush"].active():
+            batch["flush"].cancel()
+
+        sent = self._clock.seconds()
+        if self.metrics is not None:
+            self.metrics.observe("publish.batch_size", len(batch["msgs"]))
+            self.metrics.observe("publish.batch_delay",
+                                 sent - batch["started"])
+
+        def finish(conn, data):
+            if self.metrics is not None:
+                self.metrics.observe("publish.flush_latency",
+                                     self._clock.seconds() - sent)
+            for callback in batch["callbacks"]:
+                if callback is not None:
+                    callback(conn, data)
+
+        if len(batch["msgs"]) == 1:
+            self._writer.pub(topic, batch["msgs"][0], callback=finish)
+        else:
+            self._writer.mpub(topic, batch["msgs"], callback=finish)
+
+    def flushAll(self):
+        """
+        Sends the messages buffered for every topic.
+        """
+        for topic in self._batches.keys():
+            self.flush(topic)
+
+
 class RemoteReadWriter(object):
     """
     A high level producer/consumer for publishing/consuming from NSQ.
-    Maintains a single long-lived `nsq.Writer`, a set of `nsq.Reader`s,
+    Maintains a single long-lived `nsq.Writer`, a set of `nsq.Reader`s
+    (see :class:`ClosableReader`),
     and a set of callbacks. The mapping between `Reader`s and callbacks is 1:1.
 
     Expects a list of `NSQD` and `NSQLookupd` addresses to be passed along with
@@ -185,14 +553,63 @@ class RemoteReadWriter(object):
     :param server_name: a string that uniquely idetifies this server instance.
     It will be used as channel name for both publishing and reading from `NSQ`.
     :type string:
+
+    :param batch_window: when positive, published messages are batched
+    through a :class:`BatchingPublisher` with that window, in seconds.
+    :type float:
+
+    :param batch_size: the number of messages which flushes a batch.
+    :type int:
+
+    :param metrics: an optional :class:`ircdd.metrics.Metrics`
+    to report to.
+
+    :param binary_envelopes: whether to publish binary envelopes (see
+    :mod:`ircdd.envelope`) rather than JSON ones. Both are always read,
+    so this should only be enabled once every node can read them.
+    :type bool:
+
+    :param unsubscribe_grace: seconds for which the reader of a topic
+    outlives its last subscriber, so that a quick resubscription reuses
+    it. The reader is closed at once when this is not positive.
+    :type float:
+
+    :param ephemeral_channels: whether to read from ephemeral channels,
+    which nsqd drops along with their backlog once their last reader
+    disconnects, instead of durable ones. Messages published while this
+    node is away are then lost rather than delivered on its return.
+    :type bool:
+
+    :param flow: an optional :class:`ircdd.flow.FlowController` which
+    adapts the `max_in_flight` of the readers and holds messages back
+    while this node is overloaded.
+
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
     """
+    implements(IMessageTransport)
 
-    def __init__(self, nsqd_addresses, lookupd_addresses, server_name):
+    def __init__(self, nsqd_addresses, lookupd_addresses, server_name,
+                 batch_window=0.0, batch_size=100, metrics=None,
+                 binary_envelopes=False, unsubscribe_grace=0.0,
+                 ephemeral_channels=False, flow=None, clock=None):
         self._readers = {}
+        self._callbacks = {}
+        self._subscribers = {}
+        self._teardowns = {}
         self._writer = None
+        self._publisher = None
         self._nsqd_addresses = nsqd_addresses
         self._lookupd_addresses = lookupd_addresses
         self._server_name = server_name
+        self._channel = channelName(server_name, ephemeral_channels)
+        self._provisioner = LookupdProvisioner(lookupd_addresses)
+        self._batch_window = batch_window
+        self._batch_size = batch_size
+        self._metrics = metrics
+        self._binary_envelopes = binary_envelopes
+        self._unsubscribe_grace = unsubscribe_grace
+        self._flow = flow
+        self._clock = clock or reactor
 
         self._start_writer()
 
@@ -200,12 +617,22 @@ class RemoteReadWriter(object):
         self._writer = nsq.Writer(self._nsqd_addresses,
                                   reconnect_interval=10.0)
 
+        if self._batch_window > 0:
+            self._publisher = BatchingPublisher(self._writer,
+                                                window=self._batch_window,
+                                                size=self._batch_size,
+                                                metrics=self._metrics)
+        else:
+            self._publisher = self._writer
+
     def subscribe(self, topic, callback):
         """
         Used to subscribe a callback to a topic.
         It will spin up a new :class:`nsq.Reader` for the given topic if one
         does not exist already and register the given callback with it.
-        Only one callback per topic exists.
+        Only one callback per topic exists: the latest one replaces
+        the others. Subscriptions are counted, and the reader lives until
+        each of them is released through :meth:`unsubscribe`.
 
         :param topic: a string which identifies the topic on which to listen.
         :type string:
@@ -219,62 +646,128 @@ class RemoteReadWriter(object):
         message (still available in raw from through the `body` attribute).
         :type callable:
         """
-        # Check if topic exists, if not - create it
-        # Check if channel exists, if not - create it
+        self._callbacks[topic] = callback
+        self._subscribers[topic] = self._subscribers.get(topic, 0) + 1
+
+        teardown = self._teardowns.pop(topic, None)
+        if teardown is not None:
+            teardown.cancel()
 
         if not self._readers.get(topic, None):
-            _create_topic(topic, self._lookupd_addresses)
-            _create_channel(topic, self._server_name, self._lookupd_addresses)
-
-            reader = nsq.Reader(message_handler=self.filter_callback(callback),
-                                lookupd_http_addresses=self._lookupd_addresses,
-                                topic=topic,
-                                channel=self._server_name,
-                                lookupd_poll_interval=5)
+            # The reader finds the topic on its next lookupd poll,
+            # so there is no need to wait for the provisioning.
+            self._provisioner.provision(topic, self._channel)
+
+            def dispatch(message):
+                callback = self._callbacks.get(topic)
+                if callback is None:
+                    # Read before the reader was closed.
+                    message.requeue()
+                    return False
+                if self._flow is not None:
+                    return self._flow.handle(topic, message, callback)
+                return callback(message)
+
+            options = {}
+            if self._flow is not None:
+                # Each message requeued while the node is overloaded
+                # counts as an attempt, so pynsq must never give up on
+                # messages. pynsq 0.6.4 has no unlimited setting: a
+                # `max_tries` of 0 gives up on every message.
+                options["max_tries"] = sys.maxint
+
+            reader = ClosableReader(
+                message_handler=self.filter_callback(dispatch),
+                lookupd_http_addresses=self._lookupd_addresses,
+                topic=topic,
+                channel=self._channel,
+                lookupd_poll_interval=5,
+                **options)
             self._readers[topic] = reader
+            if self._flow is not None:
+                self._flow.register(topic, reader)
+            self._reportReaders()
             log.msg("Subscribed on %s on %s" % (topic, self._server_name))
 
     def filter_callback(self, callback):
         """
         Decorator function which wraps the given callback in
         a filter that discards messages which originated from this server
-        instance server.
+        instance server. The origin of binary envelopes is read from
+        their header, so those messages are discarded without decoding
+        their body.
 
         :param callback: the callback which will be wrapped
         :type callable:
         """
 
         def filtered_callback(message):
-            parsed_msg = json.loads(message.body)
+            try:
+                received = envelope.Envelope(message.body)
+            except envelope.EnvelopeError as e:
+                log.err("Discarding message: %s" % e)
+                message.finish()
+                return True
 
-            if parsed_msg['origin'] == self._server_name:
+            if received.origin == self._server_name:
                 message.finish()
                 return True
-            else:
-                message.parsed_msg = parsed_msg
-                return callback(message)
+
+            try:
+                message.parsed_msg = received.parsed()
+            except ValueError as e:
+                log.err("Discarding message from %s: %s" %
+                        (received.origin, e))
+                message.finish()
+                return True
+
+            message.envelope = received
+            return callback(message)
 
         return filtered_callback
 
     def unsubscribe(self, topic):
         """
-        Unsubscribes a callback from the given topic and
-        shut down the reader.
+        Releases one subscription to the given topic. Once the last
+        one is released, the reader is shut down, after the
+        `unsubscribe_grace` period if one is set.
+        Raises `KeyError` if the topic is not subscribed to.
 
         :param topic: the topic for which to stop listening.
         :type string:
         """
-        self._readers[topic].close()
-        del self._readers[topic]
+        subscribers = self._subscribers[topic] - 1
+        if subscribers > 0:
+            self._subscribers[topic] = subscribers
+            return
+
+        del self._subscribers[topic]
+        if self._unsubscribe_grace > 0:
+            self._teardowns[topic] = self._clock.callLater(
+                self._unsubscribe_grace, self._closeReader, topic)
+        else:
+            self._closeReader(topic)
+
+    def _closeReader(self, topic):
+        self._teardowns.pop(topic, None)
+        del self._callbacks[topic]
+        self._readers.pop(topic).close()
+        if self._flow is not None:
+            self._flow.unregister(topic)
+        self._reportReaders()
         log.msg("Unsubscribed from %s on %s" % (topic, self._server_name))
 
-    def publish(self, topic, msg_body, callback=None):
+    def _reportReaders(self):
+        if self._metrics is not None:
+            self._metrics.gauge("nsq.readers", len(self._readers))
+
+    def publish(self, topic, msg_body, callback=None, recipient=None):
         """
         Publishes a message to the given queue and calls
         the optional callback once completed. Creates the
         writer if it does not exist. The message is wrapped in
-        a container dictionary that wears the origin tag,
-        json formatted, and then given to the writer.
+        a container that wears the origin tag, encoded as
+        described in :mod:`ircdd.envelope`, and then given to the writer.
 
         :param topic: the name of the topic to publish to
         :type string:
@@ -286,9 +779,14 @@ class RemoteReadWriter(object):
         called once :method:`nsq.Writer.pub()` completes.
         Defaults to a logging callback.
         :type callable:
+
+        :param recipient: the name of the user or group the message
+        is addressed to, when it differs from the topic.
+        :type string:
         """
 
-        msg = dict(msg_body=msg_body, origin=self._server_name)
+        msg = envelope.encode(msg_body, self._server_name, recipient,
+                              binary=self._binary_envelopes)
 
         def finish_pub(conn, data):
             if isinstance(data, nsq.Error):
@@ -297,4 +795,208 @@ class RemoteReadWriter(object):
         if not callback:
             callback = finish_pub
 
-        self._writer.pub(topic, json.dumps(msg), callback=callback)
+        self._publisher.pub(topic, msg, callback=callback)
+
+    def flush(self):
+        """
+        Sends the messages which are still being batched, if any.
+        """
+        if self._publisher is not self._writer:
+            self._publisher.flushAll()
+
+
+class ChannelSweeper(object):
+    """
+    Periodically deletes the channels of nodes whose lease has expired,
+    so that nsqd stops queuing messages which nobody will read.
+    Only the channels named by :func:`channelName` are considered,
+    those of other consumers of the same nsqd are left alone, along
+    with the channel named after this node itself which it read from
+    before node channels were prefixed.
+
+    A channel is only deleted once it has been found orphaned by two
+    sweeps in a row, which spares the channels of nodes that are just
+    starting. A sweep is skipped when this node's own lease cannot be
+    found, as the list of live nodes is then not trusted. The lookupd
+    calls are blocking and are made in a thread.
+
+    Reports the `nsq.pruned_channels` and `nsq.sweep_errors` counters.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` which holds
+    the node leases.
+    :param lookupd_addresses: the `NSQLookupd` HTTP addresses.
+    :param server_name: the name of this node.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param interval: seconds between two sweeps.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, lookupd_addresses, server_name, metrics,
+                 interval=600.0, clock=None):
+        self.db = db
+        self.lookupd_addresses = lookupd_addresses
+        self.server_name = server_name
+        self.metrics = metrics
+        self.interval = interval
+
+        self._suspects = set()
+
+        self._loop = task.LoopingCall(self.sweep)
+        self._loop.clock = clock or reactor
+        self._loop.start(self.interval, now=False)
+
+    def _orphans(self, nodes):
+        orphans = set()
+        for topic in _topics(self.lookupd_addresses) or []:
+            for chan in _channels(topic, self.lookupd_addresses) or []:
+                node = channelNode(chan)
+                if chan == self.server_name or \
+                        node is not None and node not in nodes:
+                    orphans.add((topic, chan))
+        return orphans
+
+    def _delete(self, channels):
+        for (topic, chan) in channels:
+            _delete_channel(topic, chan, self.lookupd_addresses)
+            log.msg("Deleted the orphaned channel %s of %s" % (chan, topic))
+
+    @defer.inlineCallbacks
+    def _sweep(self):
+        nodes = yield self.db.listLiveNodes()
+        if self.server_name not in nodes:
+            log.msg("Skipping the channel sweep: this node has no lease")
+            return
+
+        orphans = yield threads.deferToThread(self._orphans, set(nodes))
+        confirmed = orphans & self._suspects
+        self._suspects = orphans - confirmed
+
+        if confirmed:
+            yield threads.deferToThread(self._delete, sorted(confirmed))
+            self.metrics.increment("nsq.pruned_channels", len(confirmed))
+
+    def sweep(self):
+        """
+        Deletes the channels found orphaned by the previous sweep which
+        still are, and remembers the newly orphaned ones.
+        Returns a Deferred which fires once the sweep is done.
+        """
+        def ebSweep(err):
+            self.metrics.increment("nsq.sweep_errors")
+            log.err(err, "The channel sweep failed")
+
+        return self._sweep().addErrback(ebSweep)
+
+    def stop(self):
+        """
+        Stops sweeping.
+        """
+        if self._loop.running:
+            self._loop.stop()
+
+
+class TopicSweeper(object):
+    """
+    Periodically deletes the topics of users and groups which are no
+    longer in use, so that lookupd and nsqd stop tracking them.
+
+    Only the topics of this server are considered, which are those
+    named after a known user or group and the inbox topics; those of
+    other producers on the same nsqd are left alone. The topic of a
+    user is in use while the user has an active session, that of a
+    group while it has live members, and the inbox topic of a node
+    while its lease is valid. A topic is deleted, along with its
+    channels, once every sweep has found it unused for `retention`
+    seconds. At most `limit` topics are deleted per sweep, the others
+    being left for the next ones. A sweep is skipped when this node's
+    own lease cannot be found. The lookupd calls are blocking and are
+    made in a thread.
+
+    Reports the `nsq.pruned_topics` and `nsq.sweep_errors` counters.
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` which holds
+    the users, groups, sessions, memberships and node leases.
+    :param lookupd_addresses: the `NSQLookupd` HTTP addresses.
+    :param server_name: the name of this node.
+    :param metrics: the :class:`ircdd.metrics.Metrics` to report to.
+    :param interval: seconds between two sweeps.
+    :param retention: seconds for which a topic must stay unused
+    before it is deleted.
+    :param limit: the maximum number of topics deleted per sweep.
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, db, lookupd_addresses, server_name, metrics,
+                 interval=3600.0, retention=86400.0, limit=100, clock=None):
+        self.db = db
+        self.lookupd_addresses = lookupd_addresses
+        self.server_name = server_name
+        self.metrics = metrics
+        self.interval = interval
+        self.retention = retention
+        self.limit = limit
+
+        self._clock = clock or reactor
+        # Maps each unused topic to the time it was first found unused.
+        self._unused_since = {}
+
+        self._loop = task.LoopingCall(self.sweep)
+        self._loop.clock = self._clock
+        self._loop.start(self.interval, now=False)
+
+    def _delete(self, topics):
+        for topic in topics:
+            _delete_topic(topic, self.lookupd_addresses)
+            log.msg("Deleted the unused topic %s" % topic)
+
+    @defer.inlineCallbacks
+    def _sweep(self):
+        nodes = yield self.db.listLiveNodes()
+        if self.server_name not in nodes:
+            log.msg("Skipping the topic sweep: this node has no lease")
+            return
+
+        active = set((yield self.db.listActiveTopics()))
+        active.update(inboxTopic(node) for node in nodes)
+
+        topics = yield threads.deferToThread(_topics, self.lookupd_addresses)
+        if topics is None:
+            raise Exception("Could not list the topics")
+
+        unused = set(topic for topic in topics if topic not in active)
+        inboxes = set(topic for topic in unused
+                      if topic.startswith(INBOX_PREFIX))
+        owned = set((yield self.db.listKnownTopics(unused - inboxes)))
+        owned.update(inboxes)
+
+        now = self._clock.seconds()
+        unused_since = {}
+        for topic in owned:
+            unused_since[topic] = self._unused_since.get(topic, now)
+        self._unused_since = unused_since
+
+        expired = sorted(topic for (topic, since) in unused_since.iteritems()
+                         if now - since >= self.retention)[:self.limit]
+        if expired:
+            yield threads.deferToThread(self._delete, expired)
+            for topic in expired:
+                del self._unused_since[topic]
+            self.metrics.increment("nsq.pruned_topics", len(expired))
+
+    def sweep(self):
+        """
+        Deletes the topics which have been unused for long enough.
+        Returns a Deferred which fires once the sweep is done.
+        """
+        def ebSweep(err):
+            self.metrics.increment("nsq.sweep_errors")
+            log.err(err, "The topic sweep failed")
+
+        return self._sweep().addErrback(ebSweep)
+
+    def stop(self):
+        """
+        Stops sweeping.
+        """
+        if self._loop.running:
+            self._loop.stop()
@@ -0,0 +1,132 @@
+from zope.interface import implements
+
+from twisted.internet import defer
+from twisted.python import log
+
+from ircdd.transport import IMessageTransport
+
+INBOX_PREFIX = "inbox."
+
+
+def inboxTopic(node):
+    """
+    Returns the name of the topic on which the given node
+    receives its messages.
+    """
+    return INBOX_PREFIX + node
+
+
+class NodeRouter(object):
+    """
+    Routes messages between nodes over one inbox topic per node,
+    instead of one topic per user and per group.
+
+    It is an :class:`ircdd.transport.IMessageTransport` itself, and
+    wraps another one, such as :class:`ircdd.remote.RemoteReadWriter`.
+    Subscribing only registers the callback locally; the node consumes a
+    single inbox topic and hands every message to the callback of its
+    recipient. Publishing looks up the nodes which host the recipient
+    user's session or the recipient group's members, and publishes the
+    message once to each of their inboxes. Messages published to a
+    recipient while its routes are being looked up wait for that lookup,
+    so that they are published in order.
+
+    :param remote_rw: the :class:`ircdd.transport.IMessageTransport` to
+    publish and consume through.
+    :param db: the :class:`ircdd.database.IRCDDatabase` which knows
+    the routes.
+    :param server_name: the name of this node.
+    """
+    implements(IMessageTransport)
+
+    def __init__(self, remote_rw, db, server_name):
+        self.remote_rw = remote_rw
+        self.db = db
+        self.server_name = server_name
+
+        self._callbacks = {}
+        self._subscribers = {}
+        # Maps each recipient whose routes are being looked up to the
+        # messages waiting for them.
+        self._pending = {}
+
+        self.remote_rw.subscribe(inboxTopic(self.server_name),
+                                 self.receive)
+
+    def subscribe(self, topic, callback):
+        """
+        Delivers the messages addressed to `topic` to the callback,
+        replacing any previous callback. Subscriptions are counted
+        like those of :class:`ircdd.remote.RemoteReadWriter`.
+        """
+        self._callbacks[topic] = callback
+        self._subscribers[topic] = self._subscribers.get(topic, 0) + 1
+
+    def unsubscribe(self, topic):
+        """
+        Releases one subscription to `topic`, and stops delivering
+        the messages addressed to it once none is left.
+        Raises `KeyError` if the topic is not subscribed to.
+        """
+        subscribers = self._subscribers[topic] - 1
+        if subscribers > 0:
+            self._subscribers[topic] = subscribers
+            return
+
+        del self._subscribers[topic]
+        del self._callbacks[topic]
+
+    def flush(self):
+        """
+        Sends the messages which are still being batched, if any.
+        """
+        self.remote_rw.flush()
+
+    def receive(self, message):
+        """
+        Hands a message read from this node's inbox to the
+        callback of its recipient.
+        """
+        callback = self._callbacks.get(message.parsed_msg.get("recipient"))
+        if callback is None:
+            message.finish()
+            return True
+
+        return callback(message)
+
+    def publish(self, topic, msg_body, callback=None, recipient=None):
+        """
+        Publishes the message to the inbox of every other node which
+        hosts the recipient named by `topic`, unless `recipient` names
+        another one.
+        Returns a Deferred which fires with the list of those nodes.
+        """
+        topic = recipient or topic
+        d = defer.Deferred()
+
+        pending = self._pending.get(topic)
+        if pending is not None:
+            pending.append((msg_body, callback, d))
+            return d
+
+        self._pending[topic] = [(msg_body, callback, d)]
+        self._route(topic)
+        return d
+
+    def _route(self, topic):
+        def cbRoutes(nodes):
+            nodes = [node for node in nodes or []
+                     if node != self.server_name]
+            for (msg_body, callback, d) in self._pending.pop(topic):
+                for node in nodes:
+                    self.remote_rw.publish(inboxTopic(node), msg_body,
+                                           callback=callback,
+                                           recipient=topic)
+                d.callback(nodes)
+
+        def ebRoutes(err):
+            log.err(err, "Failed to route a message to %s" % topic)
+            for (_, _, d) in self._pending.pop(topic):
+                d.callback(None)
+
+        self.db.lookupRoutes(topic).addCallbacks(cbRoutes, ebRoutes)
@@ -1,5 +1,5 @@
-from twisted.application import internet
-from twisted.internet import protocol
+from twisted.application import internet, service
+from twisted.internet import protocol, reactor
 
 from ircdd.protocol import IRCDDUser
 
@@ -45,5 +45,49 @@ def makeServer(ctx):
     f = IRCDDFactory(ctx)
     IRCDDUser.ctx = ctx
 
+    # Dropping the lease deactivates the sessions of local users
+    # right away instead of once the lease times out.
+    reactor.addSystemEventTrigger("before", "shutdown", ctx.heartbeats.stop)
+
+    reactor.addSystemEventTrigger("before", "shutdown", ctx.feeds.close)
+    reactor.addSystemEventTrigger("before", "shutdown", ctx.remote_rw.flush)
+
+    if ctx.flow is not None:
+        reactor.addSystemEventTrigger("before", "shutdown", ctx.flow.stop)
+
+    if ctx.channel_sweeper is not None:
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      ctx.channel_sweeper.stop)
+
+    if ctx.topic_sweeper is not None:
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      ctx.topic_sweeper.stop)
+
+    if ctx.list_snapshot is not None:
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      ctx.list_snapshot.stop)
+
+    if ctx.size_reconciler is not None:
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      ctx.size_reconciler.stop)
+
+    if ctx.group_evictor is not None:
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      ctx.group_evictor.stop)
+
+    # Closing the database connections also ends the changefeeds,
+    # which lets blocking feed consumers join the reactor thread.
+    reactor.addSystemEventTrigger("during", "shutdown", ctx.db.close)
+
     irc_server = internet.TCPServer(int(ctx['port']), f)
-    return irc_server
+
+    if ctx.mesh is None:
+        return irc_server
+
+    reactor.addSystemEventTrigger("before", "shutdown", ctx.mesh.close)
+
+    servers = service.MultiService()
+    irc_server.setServiceParent(servers)
+    internet.TCPServer(int(ctx.get('mesh_port', 5800)),
+                       ctx.mesh.serverFactory()).setServiceParent(servers)
+    return servers
@@ -14,7 +14,11 @@ def setUp():
     r.db(DB).table_create("users").run(conn)
     r.db(DB).table_create("groups").run(conn)
     r.db(DB).table_create("user_sessions").run(conn)
-    r.db(DB).table_create("group_states").run(conn)
+    r.db(DB).table_create("group_members").run(conn)
+    r.db(DB).table("group_members").index_create("group").run(conn)
+    r.db(DB).table("group_members").index_create("user").run(conn)
+    r.db(DB).table("group_members").index_wait().run(conn)
+    r.db(DB).table_create("nodes").run(conn)
     conn.close()
 
 
@@ -31,5 +35,6 @@ def cleanTables():
     r.db(DB).table("users").delete().run(conn)
     r.db(DB).table("groups").delete().run(conn)
     r.db(DB).table("user_sessions").delete().run(conn)
-    r.db(DB).table("group_states").delete().run(conn)
+    r.db(DB).table("group_members").delete().run(conn)
+    r.db(DB).table("nodes").delete().run(conn)
     conn.close()
@@ -63,7 +63,8 @@ class TestIRCDDAuth:
         self.configs = None
 
         for ctx in self.ctx:
-            ctx.db.conn.close()
+            ctx.feeds.close()
+            ctx.db.close()
         self.ctx = None
 
         for topic in _topics(["127.0.0.1:4161"]):
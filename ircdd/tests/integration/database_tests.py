@@ -1,10 +1,13 @@
 import rethinkdb as r
+
+from twisted.trial import unittest
+
 from ircdd import database
 
 from ircdd.tests import integration
 
 
-class TestIRCDDatabase():
+class TestIRCDDatabase(unittest.SynchronousTestCase):
     def setUp(self):
         self.conn = r.connect(db=integration.DB,
                               host=integration.HOST,
@@ -19,7 +22,7 @@ class TestIRCDDatabase():
 
         self.conn.close()
 
-        self.db.conn.close()
+        self.db.close()
         self.db = None
 
     def test_createUser(self):
@@ -27,7 +30,7 @@ class TestIRCDDatabase():
                            email='user@test.dom',
                            password='password',
                            registered=True)
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['nickname'] == "test_user"
         assert user['email'] == 'user@test.dom'
         assert user['password'] == 'password'
@@ -37,7 +40,7 @@ class TestIRCDDatabase():
     def test_registerUser(self):
         self.db.createUser('test_user')
 
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['nickname'] == 'test_user'
         assert user['email'] == ''
         assert user['password'] == ''
@@ -45,7 +48,7 @@ class TestIRCDDatabase():
         assert user['permissions'] == {}
 
         self.db.registerUser('test_user', 'user@test.dom', 'password')
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['nickname'] == 'test_user'
         assert user['email'] == 'user@test.dom'
         assert user['password'] == 'password'
@@ -54,7 +57,7 @@ class TestIRCDDatabase():
 
     def test_deleteUser(self):
         self.db.createUser('test_user')
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['nickname'] == 'test_user'
         assert user['email'] == ''
         assert user['password'] == ''
@@ -62,25 +65,25 @@ class TestIRCDDatabase():
         assert user['permissions'] == {}
 
         self.db.deleteUser('test_user')
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user is None
 
     def test_setPermission(self):
         self.db.createUser('test_user', 'user@test.dom', 'pass', True)
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['nickname'] == 'test_user'
         assert user['email'] == 'user@test.dom'
         assert user['password'] == 'pass'
         assert user['registered']
         assert user['permissions'] == {}
         self.db.setPermission('test_user', 'test_channel', '+s')
-        user = self.db.lookupUser('test_user')
+        user = self.successResultOf(self.db.lookupUser('test_user'))
         assert user['permissions']['test_channel'] == ['+s']
 
     def test_createGroup(self):
         self.db.createGroup('test_channel', 'public')
 
-        group = self.db.lookupGroup('test_channel')
+        group = self.successResultOf(self.db.lookupGroup('test_channel'))
 
         assert group['name'] == 'test_channel'
         assert group['type'] == 'public'
@@ -89,33 +92,51 @@ class TestIRCDDatabase():
 
     def test_deleteGroup(self):
         self.db.createGroup('test_channel', 'public')
-        channel = self.db.lookupGroup('test_channel')
+        channel = self.successResultOf(self.db.lookupGroup('test_channel'))
         assert channel['name'] == 'test_channel'
         assert channel['type'] == 'public'
         assert channel['meta'] != {}
 
         self.db.deleteGroup('test_channel')
 
-        channel = self.db.lookupGroup('test_channel')
+        channel = self.successResultOf(self.db.lookupGroup('test_channel'))
         assert channel is None
 
-        state = self.db.getGroupState("test_channel")
-        assert state is None
+        state = self.successResultOf(self.db.getGroupState("test_channel"))
+        assert state["users"] == {}
 
     def test_setGroupData(self):
         self.db.createGroup('test_channel', 'public')
-        channel = self.db.lookupGroup('test_channel')
+        channel = self.successResultOf(self.db.lookupGroup('test_channel'))
         assert channel['name'] == 'test_channel'
         assert channel['type'] == 'public'
         assert channel['meta'] != {}
 
         self.db.setGroupTopic('test_channel', 'test', 'john_doe')
-        channel = self.db.lookupGroup('test_channel')
+        channel = self.successResultOf(self.db.lookupGroup('test_channel'))
 
         assert channel['meta']['topic'] == 'test'
         assert channel['meta']['topic_time']
         assert channel['meta']['topic_author'] == 'john_doe'
 
+    def test_listGroupsPage(self):
+        self.db.renewNodeLease("test_node")
+        for name in ["a_group", "b_group", "c_group"]:
+            self.db.createGroup(name, "public")
+        self.db.addUserToGroup("test_user", "b_group", "test_node")
+
+        d = self.db.listGroupsPage(limit=2)
+        page = self.successResultOf(d)
+        assert [group["name"] for group in page] == ["a_group", "b_group"]
+
+        d = self.db.listGroupsPage(after="b_group", limit=2)
+        page = self.successResultOf(d)
+        assert [group["name"] for group in page] == ["c_group"]
+
+        d = self.db.listGroupsPage(min_users=0, name_masks=["?_GROUP"])
+        page = self.successResultOf(d)
+        assert [(g["name"], g["size"]) for g in page] == [("b_group", 1)]
+
     def test_checkIfValidEmail(self):
         email = "validemail@email.com"
 
@@ -131,49 +152,234 @@ class TestIRCDDatabase():
 
         self.db.checkIfValidPassword(password)
 
-    def test_heartbeatsUserSession(self):
-        result = self.db.heartbeatUserSession("test_user")
+    def test_startsUserSession(self):
+        d = self.db.startUserSession("test_user", "test_node")
+        result = self.successResultOf(d)
         assert result["inserted"] == 1
 
-        result = self.db.heartbeatUserSession("test_user")
+        d = self.db.startUserSession("test_user", "test_node")
+        result = self.successResultOf(d)
         assert result["replaced"] == 1
 
-    def test_heartbeatUserInGroup(self):
-        # Creates initial heartbeat
-        result = self.db.heartbeatUserInGroup("test_user", "test_group")
-        group_state = self.db.getGroupState("test_group")
+    def test_touchesUserSession(self):
+        self.db.startUserSession("test_user", "test_node")
+        r.table("user_sessions").get("test_user").update({
+            "last_message": r.now().sub(600)
+        }).run(self.conn)
+
+        self.successResultOf(self.db.touchUserSession("test_user"))
+
+        idle = r.now().sub(r.table("user_sessions").get("test_user")[
+            "last_message"]).run(self.conn)
+        assert idle < 60
+
+    def test_sessionActiveWhileLeaseValid(self):
+        self.db.startUserSession("test_user", "test_node")
+
+        d = self.db.lookupUserSession("test_user")
+        session = self.successResultOf(d)
+        assert not session["active"]
+
+        self.db.renewNodeLease("test_node")
+
+        d = self.db.lookupUserSession("test_user")
+        session = self.successResultOf(d)
+        assert session["active"]
+
+        self.db.removeNodeLease("test_node")
+
+        d = self.db.lookupUserSession("test_user")
+        session = self.successResultOf(d)
+        assert not session["active"]
+
+    def test_expiresNodes(self):
+        self.db.renewNodeLease("test_node")
+        self.db.startUserSession("test_user", "test_node")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+
+        r.table("nodes").get("test_node").update({
+            "heartbeat": r.now().sub(60)
+        }).run(self.conn)
+
+        expired = self.successResultOf(self.db.expireNodes())
+        assert expired == ["test_node"]
+
+        session = self.successResultOf(self.db.lookupUserSession("test_user"))
+        assert session is None
+
+        group_state = self.successResultOf(self.db.getGroupState("test_group"))
+        assert "test_user" not in group_state["users"]
+
+    def test_listsActiveTopics(self):
+        self.db.renewNodeLease("test_node")
+        self.db.startUserSession("test_user", "test_node")
+        self.db.startUserSession("gone_user", "gone_node")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+        self.db.addUserToGroup("gone_user", "gone_group", "gone_node")
+
+        nodes = self.successResultOf(self.db.listLiveNodes())
+        assert nodes == ["test_node"]
+
+        topics = self.successResultOf(self.db.listActiveTopics())
+        assert sorted(topics) == ["test_group", "test_user"]
+
+    def test_listsKnownTopics(self):
+        self.db.createUser("test_user")
+        self.db.createGroup("test_group", "public")
+
+        topics = self.successResultOf(self.db.listKnownTopics(
+            ["test_user", "test_group", "nsq_tool"]))
+        assert sorted(topics) == ["test_group", "test_user"]
+
+        assert self.successResultOf(self.db.listKnownTopics([])) == []
+
+    def test_addUserToGroup(self):
+        self.db.renewNodeLease("test_node")
+        self.db.renewNodeLease("other_node")
+
+        # Creates initial presence
+        d = self.db.addUserToGroup("test_user", "test_group", "test_node")
+        result = self.successResultOf(d)
+        group_state = self.successResultOf(self.db.getGroupState("test_group"))
 
         assert result["inserted"] == 1
-        assert group_state["users"].get("test_user")
+        assert group_state["users"]["test_user"]["node"] == "test_node"
 
-        # Updates user heartbeat
-        result = self.db.heartbeatUserInGroup("test_user", "test_group")
+        # Moves the presence to another node
+        d = self.db.addUserToGroup("test_user", "test_group", "other_node")
+        result = self.successResultOf(d)
         assert result["replaced"] == 1
 
-        new_group_state = self.db.getGroupState("test_group")
-        assert new_group_state["users"]["test_user"] != \
-            group_state["users"]["test_user"]
+        d = self.db.getGroupState("test_group")
+        new_group_state = self.successResultOf(d)
+        assert new_group_state["users"]["test_user"]["node"] == "other_node"
+
+    def test_maintainsGroupSize(self):
+        self.db.renewNodeLease("test_node")
+        self.db.createGroup("test_group", "public")
+
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+        self.db.addUserToGroup("other_user", "test_group", "test_node")
+        size = self.successResultOf(self.db.getGroupSize("test_group"))
+        assert size == 2
+
+        self.db.removeUserFromGroup("test_user", "test_group")
+        self.db.removeUserFromGroup("test_user", "test_group")
+        size = self.successResultOf(self.db.getGroupSize("test_group"))
+        assert size == 1
+
+        r.table("nodes").get("test_node").update({
+            "heartbeat": r.now().sub(60)
+        }).run(self.conn)
+        self.db.expireNodes()
+        size = self.successResultOf(self.db.getGroupSize("test_group"))
+        assert size == 0
+
+    def test_reconcilesGroupSizes(self):
+        self.db.renewNodeLease("test_node")
+        self.db.createGroup("test_group", "public")
+        self.db.createGroup("other_group", "public")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+
+        r.table("groups").get("test_group").update({
+            "size": 5
+        }).run(self.conn)
+
+        drifted = self.successResultOf(self.db.reconcileGroupSizes())
+        assert drifted == [{"id": "test_group", "size": 5, "actual": 1}]
+
+        size = self.successResultOf(self.db.getGroupSize("test_group"))
+        assert size == 1
+        assert self.successResultOf(self.db.reconcileGroupSizes()) == []
+
+    def test_reconcilesBeforeExpiry(self):
+        self.db.renewNodeLease("test_node")
+        self.db.createGroup("test_group", "public")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+
+        r.table("nodes").get("test_node").update({
+            "heartbeat": r.now().sub(60)
+        }).run(self.conn)
+
+        # The rows of the lapsed node still count until they expire.
+        assert self.successResultOf(self.db.reconcileGroupSizes()) == []
+
+        self.db.expireNodes()
+        size = self.successResultOf(self.db.getGroupSize("test_group"))
+        assert size == 0
+
+    def test_lookupUserGroups(self):
+        self.db.createUser("test_user")
+        self.db.createGroup("test_group", "public")
+        self.db.createGroup("other_group", "public")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+
+        user = self.successResultOf(self.db.lookupUser("test_user"))
+
+        assert [group["id"] for group in user["groups"]] == ["test_group"]
 
     def test_removeUserFromGroup(self):
-        self.db.heartbeatUserInGroup("test_user", "test_group")
-        result = self.db.removeUserFromGroup("test_user", "test_group")
+        self.db.addUserToGroup("test_user", "test_group", "test_node")
+        d = self.db.removeUserFromGroup("test_user", "test_group")
+        result = self.successResultOf(d)
 
-        assert result["replaced"] == 1
+        assert result["deleted"] == 1
 
-        group_state = self.db.getGroupState("test_group")
+        group_state = self.successResultOf(self.db.getGroupState("test_group"))
         assert False == group_state["users"].get("test_user",
                                                  False)
 
     def test_observesGroupStateChanges(self):
+        self.db.renewNodeLease("test_node")
+
+        d = self.db.observeGroupStates(["test_group"])
+        changefeed = self.successResultOf(d)
+        self.db.addUserToGroup("john", "test_group", "test_node")
+        self.db.addUserToGroup("bob", "test_group", "test_node")
 
-        changefeed = self.db.observeGroupState("test_group")
-        self.db.heartbeatUserInGroup("john", "test_group")
-        self.db.heartbeatUserInGroup("bob", "test_group")
+        john_added = next(changefeed)
+        assert john_added["old_val"] is None
+        assert john_added["new_val"]["user"] == "john"
 
-        added_users_change = next(changefeed)
-        assert "john" in added_users_change["users"]
-        assert "bob" in added_users_change["users"]
+        bob_added = next(changefeed)
+        assert bob_added["new_val"]["user"] == "bob"
 
         self.db.removeUserFromGroup("john", "test_group")
-        removed_user_change = next(changefeed)
-        assert "john" not in removed_user_change["users"]
+        john_removed = next(changefeed)
+        assert john_removed["old_val"]["user"] == "john"
+        assert john_removed["new_val"] is None
+
+    def test_observesKeys(self):
+        d = self.db.observeKeys("group_members", ["group", "user"])
+        changefeed = self.successResultOf(d)
+        self.db.addUserToGroup("john", "test_group", "test_node")
+
+        change = next(changefeed)
+        assert change == [{"group": "test_group", "user": "john"}]
+
+    def test_observesGroupMetaChanges(self):
+        self.db.createGroup("test_group", "public")
+        self.db.createGroup("other_group", "public")
+
+        d = self.db.observeGroupMetas(["test_group", "other_group"])
+        changefeed = self.successResultOf(d)
+        self.db.setGroupTopic("other_group", "topic", "john")
+
+        change = next(changefeed)
+        assert change["new_val"]["id"] == "other_group"
+        assert change["new_val"]["meta"]["topic"] == "topic"
+
+    def test_membersOfDeadNodesAreInactive(self):
+        self.db.renewNodeLease("test_node")
+        self.db.addUserToGroup("john", "test_group", "test_node")
+        self.db.addUserToGroup("bob", "test_group", "dead_node")
+
+        group_state = self.successResultOf(self.db.getGroupState("test_group"))
+        assert "john" in group_state["users"]
+        assert "bob" not in group_state["users"]
+
+    def test_createIndexesIsIdempotent(self):
+        self.successResultOf(self.db.createIndexes())
+        created = self.successResultOf(self.db.createIndexes())
+        assert created == []
@@ -56,7 +56,8 @@ class TestMessaging():
         self.factory = None
         self.config = None
 
-        self.ctx.db.conn.close()
+        self.ctx.feeds.close()
+        self.ctx.db.close()
         self.ctx = None
 
         for topic in _topics(["127.0.0.1:4161"]):
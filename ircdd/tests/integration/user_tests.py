@@ -1,6 +1,7 @@
 import rethinkdb as r
 
 from twisted.test import proto_helpers
+from twisted.trial import unittest
 
 from ircdd.user import ShardedUser
 from ircdd.group import ShardedGroup
@@ -11,7 +12,7 @@ from ircdd.context import makeContext
 from ircdd.tests import integration
 
 
-class TestShardedUser:
+class TestShardedUser(unittest.SynchronousTestCase):
     def setUp(self):
         self.conn = r.connect(db=integration.DB,
                               host=integration.HOST,
@@ -51,35 +52,38 @@ class TestShardedUser:
                 _delete_channel(topic, chan, self.ctx["lookupd_http_address"])
             _delete_topic(topic, self.ctx["lookupd_http_address"])
 
-        self.ctx["db"].conn.close()
+        self.ctx["feeds"].close()
+        self.ctx["db"].close()
         self.ctx = None
 
-    def test_userHeartbeats(self):
+    def test_userSessionStarts(self):
         self.shardedUser.loggedIn(self.ctx.realm, None)
 
-        session = self.ctx.db.lookupUserSession("john")
+        session = self.successResultOf(self.ctx.db.lookupUserSession("john"))
 
         assert session
-        assert session.get("last_heartbeat")
-        assert session.get("last_heartbeat") != ""
+        assert session["node"] == "testserver"
+        assert session.get("session_start")
+        assert session["active"]
 
-        self.ctx.db.heartbeatUserSession("john")
-        updated_session = self.ctx.db.lookupUserSession("john")
+    def test_userSessionExpiresWithNode(self):
+        self.shardedUser.loggedIn(self.ctx.realm, None)
+
+        self.successResultOf(self.ctx.heartbeats.stop())
 
-        assert updated_session
-        assert updated_session.get("last_heartbeat")
-        assert updated_session.get("last_heartbeat") != ""
+        session = self.successResultOf(self.ctx.db.lookupUserSession("john"))
 
-        assert session.get("last_heartbeat") != \
-            updated_session.get("last_heartbeat")
+        assert session
+        assert not session["active"]
 
-    def test_userInGroupHeartbeats(self):
+    def test_userInGroupPresence(self):
         group = ShardedGroup(self.ctx, "test_group")
 
         self.shardedUser.join(group)
 
-        group_state = self.ctx.db.getGroupState("test_group")
+        d = self.ctx.db.getGroupState("test_group")
+        group_state = self.successResultOf(d)
 
         assert group_state
         assert group_state["users"]["john"]
-        assert group_state["users"]["john"] != ""
+        assert group_state["users"]["john"]["node"] == "testserver"
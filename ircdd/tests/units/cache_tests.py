@@ -0,0 +1,125 @@
+import mock
+from twisted.internet import defer, task
+from ircdd.cache import CachingDatabase, LRUCache
+from ircdd.database import IRCDDatabase
+from ircdd.metrics import Metrics
+
+
+class TestLRUCache:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LRUCache(2, 30.0, negative_ttl=5.0, clock=self.clock)
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        assert self.cache.get("a") == (True, 1)
+        assert self.cache.get("b") == (False, None)
+        assert self.cache.get("c") == (True, 3)
+        assert len(self.cache) == 2
+
+    def testExpiresEntries(self):
+        self.cache.set("a", 1)
+        self.cache.set("missing", None)
+
+        self.clock.advance(5)
+
+        assert self.cache.get("a") == (True, 1)
+        assert self.cache.get("missing") == (False, None)
+
+        self.clock.advance(25)
+
+        assert self.cache.get("a") == (False, None)
+
+
+class TestCachingDatabase:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+
+        self.feeds = {}
+
+        def follow(cursor, callback):
+            self.feeds[cursor] = callback
+            return defer.Deferred()
+
+        self.db = mock.Mock(spec=IRCDDatabase)
+        for table in ("USERS_TABLE", "USER_SESSIONS_TABLE", "GROUPS_TABLE",
+                      "GROUP_MEMBERS_TABLE"):
+            setattr(self.db, table, getattr(IRCDDatabase, table))
+        self.db.observeKeys.side_effect = lambda table, fields: defer.succeed(
+            table)
+        self.db.follow.side_effect = follow
+        self.db.lookupUser.side_effect = lambda nick: defer.succeed(
+            {"id": nick})
+        self.db.lookupGroup.return_value = defer.succeed(None)
+
+        self.cache = CachingDatabase(self.db, self.metrics, clock=self.clock)
+        self.cache.start()
+
+    def testCachesLookups(self):
+        self.cache.lookupUser("john")
+        results = []
+        self.cache.lookupUser("john").addCallback(results.append)
+
+        assert results == [{"id": "john"}]
+        assert self.db.lookupUser.call_count == 1
+        assert self.metrics.counters["cache.users.hits"] == 1
+        assert self.metrics.counters["cache.users.misses"] == 1
+
+    def testCachesMissingEntities(self):
+        self.cache.lookupGroup("#test")
+        self.cache.lookupGroup("#test")
+
+        assert self.db.lookupGroup.call_count == 1
+
+        self.clock.advance(5)
+        self.cache.lookupGroup("#test")
+
+        assert self.db.lookupGroup.call_count == 2
+
+    def testInvalidatesOnChanges(self):
+        self.cache.lookupUser("john")
+
+        self.feeds["group_members"]([{"group": "#test", "user": "john"}])
+        self.cache.lookupUser("john")
+
+        assert self.db.lookupUser.call_count == 2
+
+    def testInvalidatesOnLocalWrites(self):
+        self.db.startUserSession.return_value = defer.succeed(None)
+        self.cache.lookupUser("john")
+
+        self.cache.startUserSession("john", "testserver")
+        self.cache.lookupUser("john")
+
+        assert self.db.lookupUser.call_count == 2
+
+    def testDiscardsLookupsRacingInvalidations(self):
+        pending = defer.Deferred()
+        self.db.lookupUser.side_effect = lambda nick: pending
+
+        self.cache.lookupUser("john")
+        self.feeds["users"]([{"id": "john"}])
+        pending.callback({"id": "john"})
+
+        assert self.cache.caches["users"].get("john") == (False, None)
+
+    def testRestartsEndedFeeds(self):
+        self.cache.lookupGroup("#test")
+
+        self.db.follow.side_effect = lambda cursor, callback: defer.fail(
+            Exception("Connection lost."))
+        self.db.observeKeys.reset_mock()
+        self.cache._follow("groups")
+
+        assert self.cache.caches["groups"].get("#test") == (False, None)
+
+        self.clock.advance(5)
+
+        self.db.observeKeys.assert_called_with("groups", ["id"])
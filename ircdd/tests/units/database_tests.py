@@ -0,0 +1,171 @@
+import mock
+from rethinkdb.errors import ReqlCursorEmpty, ReqlDriverError
+from twisted.internet import defer, task
+from ircdd.database import ConnectionPool, IRCDDatabase, consumeFeed
+
+
+class FakeCursor(object):
+    """
+    Stands in for a cursor obtained through the twisted loop type.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def next(self):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class TestIRCDDatabase:
+
+    @mock.patch("rethinkdb.connect")
+    def testQueriesWaitForConnection(self, mock_connect):
+        connecting = defer.Deferred()
+        mock_connect.return_value = connecting
+
+        db = IRCDDatabase()
+        d = db.getGroupState("test_group")
+
+        assert not d.called
+
+        conn = mock.Mock()
+        connecting.callback(conn)
+
+        assert d.called
+        assert conn._start.called
+
+    @mock.patch("rethinkdb.connect")
+    def testQueriesReturnDeferreds(self, mock_connect):
+        conn = mock.Mock()
+        conn._start.return_value = {"id": "test_group", "users": {}}
+        mock_connect.return_value = conn
+
+        db = IRCDDatabase()
+        results = []
+        db.getGroupState("test_group").addCallback(results.append)
+
+        assert results == [{"id": "test_group", "users": {}}]
+
+    def testConsumesAsyncFeed(self):
+        cursor = FakeCursor()
+        changes = []
+
+        d = consumeFeed(cursor, changes.append)
+
+        cursor.pending.pop().callback({"new_val": 1})
+        cursor.pending.pop().callback({"new_val": 2})
+
+        assert changes == [{"new_val": 1}, {"new_val": 2}]
+        assert not d.called
+
+        cursor.pending.pop().errback(ReqlCursorEmpty())
+
+        assert d.called
+
+
+class TestConnectionPool:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.opened = []
+
+        def connect(**kwargs):
+            conn = mock.Mock()
+            conn.is_open.return_value = True
+            self.opened.append(conn)
+            return conn
+
+        self.patcher = mock.patch("rethinkdb.connect", side_effect=connect)
+        self.patcher.start()
+
+        self.pool = ConnectionPool("testdb", "testhost", 28015, size=2,
+                                   idle_timeout=60.0, ping_interval=30.0,
+                                   clock=self.clock)
+
+    def tearDown(self):
+        self.pool.close()
+        self.patcher.stop()
+
+    def testGrowsLazily(self):
+        assert self.pool.connections() == 0
+        assert self.opened == []
+
+        self.pool.checkout()
+
+        assert self.pool.connections() == 1
+
+    def testBoundsConnections(self):
+        results = []
+        for _ in xrange(3):
+            self.pool.checkout().addCallback(results.append)
+
+        assert len(results) == 2
+        assert len(self.opened) == 2
+
+        self.pool.checkin(results[0])
+
+        assert len(results) == 3
+        assert results[2] is results[0]
+        assert self.pool.connections() == 2
+
+    def testReplacesDeadConnections(self):
+        results = []
+        for _ in xrange(3):
+            self.pool.checkout().addCallback(results.append)
+
+        results[0].is_open.return_value = False
+        self.pool.checkin(results[0])
+
+        assert len(results) == 3
+        assert results[2] is not results[0]
+        assert results[0].close.called
+
+    def testReleasesFinishedFeeds(self):
+        query = mock.Mock()
+        cursors = []
+        self.pool.observe(query).addCallback(cursors.append)
+        conn = query.run.call_args[0][0]
+
+        assert self.pool._feeds[conn] == 1
+
+        self.pool.finish(cursors[0])
+        self.pool.finish(cursors[0])
+
+        assert self.pool._feeds[conn] == 0
+        assert not conn.close.called
+
+    def testReapsIdleConnections(self):
+        results = []
+        self.pool.checkout().addCallback(results.append)
+        self.pool.checkin(results[0])
+
+        self.clock.advance(30)
+        assert self.pool.connections() == 1
+        assert not results[0].close.called
+
+        self.clock.advance(60)
+        assert self.pool.connections() == 0
+        assert results[0].close.called
+
+    def testDropsConnectionsFailingPings(self):
+        results = []
+        self.pool.checkout().addCallback(results.append)
+        self.pool.checkin(results[0])
+
+        results[0]._start.side_effect = ReqlDriverError("Connection lost.")
+        self.clock.advance(30)
+
+        assert self.pool.connections() == 0
+        assert results[0].close.called
+
+    def testDiscardsConnectionsOnDriverErrors(self):
+        query = mock.Mock()
+        query.run.side_effect = ReqlDriverError("Connection lost.")
+
+        errors = []
+        self.pool.run(query).addErrback(errors.append)
+
+        assert len(errors) == 1
+        assert self.opened[0].close.called
+        assert self.pool.connections() == 0
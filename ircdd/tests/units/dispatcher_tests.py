@@ -0,0 +1,165 @@
+import mock
+from twisted.internet import defer, task
+from ircdd.dispatcher import FeedDispatcher
+
+
+class FakeGroup(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.meta_changes = []
+        self.state_changes = []
+        self.resyncs = 0
+
+    def resync(self):
+        self.resyncs += 1
+
+    def applyMetaChange(self, change):
+        self.meta_changes.append(change)
+
+    def applyStateChange(self, change):
+        self.state_changes.append(change)
+
+
+class TestFeedDispatcher:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cursors = []
+
+        def observe(groups):
+            cursor = mock.Mock()
+            cursor.groups = groups
+            self.cursors.append(cursor)
+            return defer.succeed(cursor)
+
+        self.followed = {}
+        self.feeds = {}
+
+        def follow(cursor, callback):
+            self.followed[cursor] = callback
+            self.feeds[cursor] = defer.Deferred()
+            return self.feeds[cursor]
+
+        self.db = mock.Mock()
+        self.db.observeGroupMetas.side_effect = observe
+        self.db.observeGroupStates.side_effect = observe
+        self.db.follow.side_effect = follow
+
+        self.dispatcher = FeedDispatcher(self.db, restart_delay=0.1,
+                                         retry_delay=5.0, clock=self.clock)
+
+    def testCoalescesInterestChanges(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.dispatcher.register(FakeGroup("b"))
+
+        assert not self.db.observeGroupMetas.called
+
+        self.clock.advance(0.1)
+
+        self.db.observeGroupMetas.assert_called_once_with(["a", "b"])
+        self.db.observeGroupStates.assert_called_once_with(["a", "b"])
+
+    def testDispatchesChangesToGroups(self):
+        a, b = FakeGroup("a"), FakeGroup("b")
+        self.dispatcher.register(a)
+        self.dispatcher.register(b)
+        self.clock.advance(0.1)
+
+        meta_cursor, state_cursor = self.cursors
+        self.followed[meta_cursor]({"new_val": {"id": "b"}})
+        self.followed[state_cursor]({"old_val": {"group": "a", "user": "x"},
+                                     "new_val": None})
+
+        assert b.meta_changes == [{"new_val": {"id": "b"}}]
+        assert a.state_changes[0]["old_val"]["user"] == "x"
+        assert not a.meta_changes and not b.state_changes
+
+    def testReplacesFeedsWhenInterestChanges(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.clock.advance(0.1)
+        old_cursors = list(self.cursors)
+
+        self.dispatcher.register(FakeGroup("b"))
+        self.clock.advance(0.1)
+
+        for cursor in old_cursors:
+            assert cursor.close.called
+        self.db.observeGroupStates.assert_called_with(["a", "b"])
+
+    def testClosesFeedsWithoutInterest(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.clock.advance(0.1)
+
+        self.dispatcher.unregister("a")
+        self.clock.advance(0.1)
+
+        assert self.db.observeGroupStates.call_count == 1
+        for cursor in self.cursors:
+            assert cursor.close.called
+
+    def testKeepsOldFeedsWhenRestartFails(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.clock.advance(0.1)
+        meta_cursor, state_cursor = self.cursors
+
+        self.db.observeGroupStates.side_effect = lambda groups: defer.fail(
+            Exception("Connection lost."))
+        self.dispatcher.register(FakeGroup("b"))
+        self.clock.advance(0.1)
+
+        assert not state_cursor.close.called
+        assert self.dispatcher._feeds["state"] is state_cursor
+
+    def testResyncsNewlyCoveredGroups(self):
+        a, b = FakeGroup("a"), FakeGroup("b")
+        self.dispatcher.register(a)
+        self.clock.advance(0.1)
+
+        self.dispatcher.register(b)
+        self.clock.advance(0.1)
+
+        assert a.resyncs == 1
+        assert b.resyncs == 1
+
+    def testRestartsEndedFeeds(self):
+        a, b = FakeGroup("a"), FakeGroup("b")
+        self.dispatcher.register(a)
+        self.dispatcher.register(b)
+        self.clock.advance(0.1)
+        meta_cursor, state_cursor = self.cursors
+
+        self.feeds[state_cursor].callback(None)
+        assert "state" not in self.dispatcher._feeds
+
+        self.clock.advance(5)
+
+        assert self.db.observeGroupStates.call_count == 2
+        assert self.dispatcher._feeds["state"] is self.cursors[-1]
+        assert meta_cursor.close.called
+        assert a.resyncs == 2
+        assert b.resyncs == 2
+
+    def testRetriesFailedRestarts(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.clock.advance(0.1)
+        self.db.observeGroupStates.side_effect = lambda groups: defer.fail(
+            Exception("Connection lost."))
+
+        self.feeds[self.cursors[1]].callback(None)
+        self.clock.advance(5)
+        assert self.db.observeGroupStates.call_count == 2
+
+        self.clock.advance(5)
+        assert self.db.observeGroupStates.call_count == 3
+
+    def testDoesNotRestartClosedFeeds(self):
+        self.dispatcher.register(FakeGroup("a"))
+        self.clock.advance(0.1)
+
+        self.dispatcher.close()
+        for d in self.feeds.values():
+            d.callback(None)
+        self.clock.advance(5)
+
+        assert self.db.observeGroupStates.call_count == 1
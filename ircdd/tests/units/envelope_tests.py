@@ -0,0 +1,47 @@
+import json
+from nose.tools import assert_raises
+from ircdd import envelope
+
+
+class TestEnvelope:
+
+    def testReadsHeaderWithoutBody(self):
+        data = envelope.encode({"type": "join"}, u"testserver", u"#test")
+        # Corrupt the body, which the header fields must not depend on.
+        received = envelope.Envelope(data[:-1])
+
+        assert received.origin == u"testserver"
+        assert received.recipient == u"#test"
+        assert received.msg_type == "join"
+
+    def testRoundTrips(self):
+        msg_body = {"type": "privmsg", "text": u"h\xe9llo"}
+        data = envelope.encode(msg_body, u"testserver")
+
+        parsed = envelope.Envelope(data).parsed()
+
+        assert parsed == {"msg_body": msg_body, "origin": u"testserver"}
+
+    def testReadsLegacyEnvelopes(self):
+        data = json.dumps({"msg_body": {"type": "part"},
+                           "origin": "otherserver"})
+
+        received = envelope.Envelope(data)
+
+        assert received.origin == "otherserver"
+        assert received.msg_type == "part"
+        assert received.parsed()["msg_body"] == {"type": "part"}
+
+    def testEncodesLegacyEnvelopes(self):
+        data = envelope.encode({"type": "part"}, "testserver", "john",
+                               binary=False)
+
+        assert json.loads(data) == {"msg_body": {"type": "part"},
+                                    "origin": "testserver",
+                                    "recipient": "john"}
+
+    def testRejectsUnknownVersions(self):
+        data = envelope.encode({"type": "join"}, u"testserver")
+        data = data[0] + chr(envelope.VERSION + 1) + data[2:]
+
+        assert_raises(envelope.EnvelopeError, envelope.Envelope, data)
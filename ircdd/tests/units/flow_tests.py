@@ -0,0 +1,136 @@
+import mock
+import tornado.ioloop
+from twisted.internet import task
+from ircdd.flow import FlowController, bufferedBytes, parseLimits
+from ircdd.metrics import Metrics
+from ircdd.remote import ClosableReader
+
+
+def makeConnection(rdy):
+    conn = mock.Mock(rdy=rdy, last_rdy=rdy, max_rdy_count=2500,
+                     rdy_timeout=None)
+
+    def send_rdy(value):
+        conn.rdy = conn.last_rdy = value
+        return True
+
+    conn.send_rdy.side_effect = send_rdy
+    return conn
+
+
+class TestParseLimits:
+
+    def testParsesStrings(self):
+        assert parseLimits("inbox.*=500, python=50") == [("inbox.*", 500),
+                                                         ("python", 50)]
+
+    def testParsesMappings(self):
+        assert parseLimits({"python": "50"}) == [("python", 50)]
+
+
+class TestFlowController:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.transports = []
+
+        self.flow = FlowController(self.metrics,
+                                   clients=lambda: self.transports,
+                                   max_in_flight=100,
+                                   limits={"python": 8},
+                                   target_latency=0.01,
+                                   max_lag=0.1,
+                                   max_buffered=1000,
+                                   interval=1.0,
+                                   clock=self.clock)
+
+        self.reader = mock.Mock()
+        self.reader.set_max_in_flight.side_effect = lambda limit: setattr(
+            self.reader, "max_in_flight", limit)
+        self.flow.register("python", self.reader)
+
+    def tearDown(self):
+        self.flow.stop()
+
+    def handle(self, latency=0.0):
+        def callback(message):
+            self.clock.advance(latency)
+            return True
+
+        return self.flow.handle("python", mock.Mock(), callback)
+
+    def testRaisesLimitsUpToTopicLimit(self):
+        assert self.reader.max_in_flight == 1
+
+        for _ in range(5):
+            self.handle()
+            self.clock.advance(1)
+
+        assert self.reader.max_in_flight == 8
+
+    def testKeepsLimitsOfIdleReaders(self):
+        self.clock.advance(1)
+
+        assert self.reader.max_in_flight == 1
+
+    def testLowersLimitsOfSlowHandlers(self):
+        self.reader.max_in_flight = 8
+
+        self.handle(latency=0.05)
+        self.clock.advance(0.95)
+
+        assert self.reader.max_in_flight == 6
+
+    def testRequeuesWhileBuffersAreFull(self):
+        self.reader.max_in_flight = 8
+        self.transports.append(mock.Mock(dataBuffer="x" * 2000, offset=0,
+                                         _tempDataLen=0))
+
+        self.clock.advance(1)
+
+        assert self.flow.overloaded
+        assert self.reader.max_in_flight == 4
+
+        message = mock.Mock()
+        callback = mock.Mock()
+        self.flow.handle("python", message, callback)
+
+        assert not callback.called
+        message.requeue.assert_called_once_with(backoff=True)
+        assert self.metrics.counters["flow.requeued"] == 1
+
+        self.transports[:] = []
+        self.clock.advance(1)
+
+        assert not self.flow.overloaded
+
+    def testLowersRdyCountsWhenOverloaded(self):
+        reader = ClosableReader(
+            topic="zope", channel="ircdd.testserver",
+            message_handler=lambda message: True,
+            lookupd_http_addresses=["testserver:5566"],
+            max_in_flight=100, io_loop=tornado.ioloop.IOLoop())
+        self.flow.register("zope", reader)
+        reader.max_in_flight = 64
+        conns = [makeConnection(32), makeConnection(32)]
+        reader.conns = {"a": conns[0], "b": conns[1]}
+        reader.total_rdy = 64
+
+        self.clock.advance(1.5)
+
+        assert reader.max_in_flight == 32
+        assert [conn.rdy for conn in conns] == [16, 16]
+        assert reader.total_rdy == 32
+
+    def testDetectsReactorLag(self):
+        self.clock.advance(1.5)
+
+        assert self.flow.overloaded
+        assert self.metrics.gauges["reactor.lag"] == 0.5
+
+    def testCountsBufferedBytes(self):
+        transport = mock.Mock(dataBuffer="abcdef", offset=2, _tempDataLen=3)
+
+        assert bufferedBytes(transport) == 7
+        assert bufferedBytes(object()) == 0
@@ -0,0 +1,299 @@
+import mock
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from ircdd.group import ShardedGroup
+from ircdd.metrics import Metrics
+from ircdd.protocol import IRCDDUser, encodePrivmsg
+
+
+def makeUser(name):
+    user = IRCDDUser()
+    user.name = name
+    user.hostname = "testserver"
+    user.transport = proto_helpers.StringTransport()
+    return user
+
+
+class TestShardedGroupReceive:
+
+    def setUp(self):
+        self.ctx = mock.Mock()
+        self.ctx.db.lookupGroup.return_value = defer.succeed(None)
+        self.ctx.db.getGroupState.return_value = defer.succeed(None)
+
+        self.group = ShardedGroup(self.ctx, u"python")
+
+    def testEncodesLinesOnce(self):
+        users = [makeUser(u"user%d" % i) for i in range(3)]
+        for user in users:
+            self.group.local_sessions[user.name] = user
+
+        with mock.patch("ircdd.group.encodePrivmsg",
+                        side_effect=encodePrivmsg) as encode:
+            self.group.receive(u"user0", self.group,
+                               {"text": u"hello\nw\xf6rld"})
+
+        assert encode.call_count == 1
+        assert users[0].transport.value() == ""
+        assert users[1].transport.value() == (
+            ":user0!user0@testserver PRIVMSG #python :hello\r\n"
+            ":user0!user0@testserver PRIVMSG #python :w\xc3\xb6rld\r\n")
+        assert users[2].transport.value() == users[1].transport.value()
+
+    def testMatchesPerUserReceive(self):
+        user = makeUser(u"john")
+        user.receive(u"bob", self.group, {"text": u"hello"})
+        single = user.transport.value()
+
+        user.transport.clear()
+        self.group.local_sessions[user.name] = user
+        self.group.receive(u"bob", self.group, {"text": u"hello"})
+
+        assert user.transport.value() == single
+
+    def testFallsBackToReceive(self):
+        other = mock.Mock(spec=["name", "receive"])
+        other.name = u"proxy"
+        self.group.local_sessions[other.name] = other
+
+        self.group.receive(u"bob", self.group, {"text": u"hello"})
+
+        other.receive.assert_called_once_with(u"bob", self.group,
+                                              {"text": u"hello"})
+
+    def testRemovesFailingUsers(self):
+        user = makeUser(u"john")
+        user.transport = None
+        self.group.local_sessions[user.name] = user
+
+        self.group.receive(u"bob", self.group, {"text": u"hello"})
+
+        assert u"john" not in self.group.local_sessions
+
+
+class TestShardedGroupMembers:
+
+    def setUp(self):
+        self.ctx = mock.Mock()
+        self.ctx.db.lookupGroup.return_value = defer.succeed(None)
+        self.ctx.db.getGroupState.return_value = defer.succeed(
+            {"id": "python", "users": {"john": {"node": "node1"},
+                                       "bob": {"node": "node2"}}})
+
+        self.group = ShardedGroup(self.ctx, u"python")
+        self.group.load()
+
+    def testLoadsMemberSet(self):
+        assert self.group.users == set(["john", "bob"])
+
+    def testAppliesDeltas(self):
+        self.group.applyStateChange({"old_val": None,
+                                     "new_val": {"group": "python",
+                                                 "user": "alice"}})
+        self.group.applyStateChange({"old_val": {"group": "python",
+                                                 "user": "bob"},
+                                     "new_val": None})
+
+        assert sorted(self.group.iterusers()) == ["alice", "john"]
+
+    def testSizeCountsAllMembers(self):
+        sizes = []
+        self.group.size().addCallback(sizes.append)
+
+        assert sizes == [2]
+
+
+class TestShardedGroupLoading:
+
+    def setUp(self):
+        self.ctx = mock.Mock()
+        self.state = defer.Deferred()
+        self.ctx.db.lookupGroup.side_effect = lambda name: defer.succeed(None)
+        self.ctx.db.getGroupState.return_value = self.state
+
+        self.group = ShardedGroup(self.ctx, u"python")
+
+    def testCreatedUnloaded(self):
+        assert not self.group.loaded
+        assert not self.ctx.db.getGroupState.called
+        assert not self.ctx.feeds.register.called
+        assert not self.ctx.remote_rw.subscribe.called
+
+    def testLoadsOnce(self):
+        loaded = []
+        self.group.load().addCallback(loaded.append)
+        self.group.load().addCallback(loaded.append)
+
+        assert loaded == []
+        self.ctx.feeds.register.assert_called_once_with(self.group)
+
+        self.state.callback({"id": "python", "users": {"john": {}}})
+
+        assert loaded == [self.group, self.group]
+        assert self.group.loaded
+        assert self.group.users == set(["john"])
+        assert self.ctx.db.getGroupState.call_count == 1
+
+        self.group.load().addCallback(loaded.append)
+        assert len(loaded) == 3
+
+    def testSizeReadsCountUntilLoaded(self):
+        self.ctx.db.getGroupSize.return_value = defer.succeed(42)
+        sizes = []
+        self.group.size().addCallback(sizes.append)
+
+        self.group.load()
+        self.state.callback({"id": "python", "users": {"john": {}}})
+        self.group.size().addCallback(sizes.append)
+
+        assert sizes == [42, 1]
+        self.ctx.db.getGroupSize.assert_called_once_with(u"python")
+
+    def testClose(self):
+        self.state.callback(None)
+        self.group.load()
+        user = makeUser(u"john")
+        user.ctx = self.ctx
+        self.group.add(user)
+        self.group.remove(user)
+
+        self.group.close()
+
+        self.ctx.feeds.unregister.assert_called_once_with(u"python")
+        self.ctx.remote_rw.unsubscribe.assert_called_once_with(u"python")
+        assert not self.group.loaded
+
+
+class TestShardedGroupLargeMode:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.ctx = mock.Mock()
+        self.ctx.hostname = "testserver"
+        self.ctx.metrics = Metrics()
+
+        self.group = ShardedGroup(self.ctx, u"python", large_threshold=3,
+                                  batch_window=1.0, clock=self.clock)
+        self.group.users = set([u"a", u"b", u"c"])
+
+        self.users = [makeUser(u"user%d" % i) for i in range(2)]
+        for user in self.users:
+            user.ctx = self.ctx
+            self.group.local_sessions[user.name] = user
+
+    def published(self):
+        return [call[0][1]
+                for call in self.ctx.remote_rw.publish.call_args_list]
+
+    def testSmallGroupsNotifyRightAway(self):
+        self.group.users = set([u"a"])
+
+        self.group.notifyShardsAdd(u"john")
+        self.group.notifyAdd(u"john", "otherserver")
+
+        assert self.published()[0]["type"] == "join"
+        assert self.users[0].transport.value() == \
+            ":john!john@otherserver JOIN #python\r\n"
+
+    def testBatchesEvents(self):
+        joiner = makeUser(u"john")
+        joiner.ctx = self.ctx
+        self.group.add(joiner)
+        self.group.notifyAdd(u"bob", "otherserver")
+        self.group.notifyRemove(u"alice", u"bye")
+
+        assert not self.ctx.remote_rw.publish.called
+        assert self.users[0].transport.value() == ""
+
+        self.clock.advance(1.0)
+
+        [batch] = self.published()
+        assert batch["type"] == "batch"
+        assert batch["events"] == [{"type": "join", "name": u"john",
+                                    "hostname": "testserver"}]
+
+        lines = (":john!john@testserver JOIN #python\r\n"
+                 ":bob!bob@otherserver JOIN #python\r\n"
+                 ":alice!alice@testserver PART #python :bye\r\n")
+        assert self.users[0].transport.value() == lines
+        assert self.users[1].transport.value() == lines
+        assert joiner.transport.value() == (
+            ":bob!bob@otherserver JOIN #python\r\n"
+            ":alice!alice@testserver PART #python :bye\r\n")
+
+        assert self.ctx.metrics.counters["groups.event_batches"] == 1
+        assert self.ctx.metrics.counters["groups.batched_events"] == 1
+
+    def testCoalescesRejoins(self):
+        self.group.notifyRemove(u"bob", u"reconnecting")
+        self.group.notifyShardsRemove(u"bob", u"reconnecting")
+        self.group.notifyAdd(u"bob", "testserver")
+        self.group.notifyShardsAdd(u"bob")
+
+        self.clock.advance(1.0)
+
+        assert not self.ctx.remote_rw.publish.called
+        assert self.users[0].transport.value() == ""
+        assert self.ctx.metrics.counters["groups.coalesced_events"] == 4
+
+    def testStaysLargeWhileEventsAreQueued(self):
+        self.group.notifyAdd(u"bob", "otherserver")
+        self.group.notifyShardsAdd(u"john")
+        self.group.users = set([u"a"])
+
+        self.group.notifyRemove(u"carol", u"bye")
+        self.group.notifyShardsRemove(u"john", u"bye")
+
+        assert not self.ctx.remote_rw.publish.called
+        assert self.users[0].transport.value() == ""
+
+        self.clock.advance(1.0)
+
+        assert self.users[0].transport.value() == (
+            ":bob!bob@otherserver JOIN #python\r\n"
+            ":carol!carol@testserver PART #python :bye\r\n")
+        # The join and part of john cancelled out.
+        assert not self.ctx.remote_rw.publish.called
+
+        self.group.notifyShardsAdd(u"john")
+        assert self.published()[0]["type"] == "join"
+
+    def testReceivesBatches(self):
+        message = mock.Mock()
+        message.parsed_msg = {"msg_body": {
+            "type": "batch",
+            "sender": {"name": None, "hostname": "otherserver"},
+            "events": [{"type": "join", "name": u"bob",
+                        "hostname": "otherserver"},
+                       {"type": "part", "name": u"alice",
+                        "reason": None}]}}
+
+        self.group.receiveRemote(message)
+        self.clock.advance(1.0)
+
+        assert self.users[0].transport.value() == (
+            ":bob!bob@otherserver JOIN #python\r\n"
+            ":alice!alice@testserver PART #python :leaving\r\n")
+        message.finish.assert_called_once_with()
+
+    def testSuppressesEventsForIdleUsers(self):
+        self.group.idle_timeout = 60.0
+        self.group.receive(u"user0", self.group, {"text": u"hello"})
+        self.users[1].transport.clear()
+
+        self.clock.advance(30)
+        self.group.notifyAdd(u"bob", "otherserver")
+        self.clock.advance(1.0)
+
+        assert self.users[0].transport.value() == \
+            ":bob!bob@otherserver JOIN #python\r\n"
+        assert self.users[1].transport.value() == ""
+        assert self.ctx.metrics.counters["groups.suppressed_events"] == 1
+
+    def testCloseFlushesEvents(self):
+        self.group.notifyShardsAdd(u"john")
+
+        self.group.close()
+
+        assert self.published()[0]["type"] == "batch"
+        assert not self.clock.getDelayedCalls()
@@ -0,0 +1,65 @@
+import mock
+from twisted.internet import defer, task
+from ircdd.heartbeat import HeartbeatWriter
+from ircdd.metrics import Metrics
+
+
+class TestHeartbeatWriter:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+
+        self.db = mock.Mock()
+        self.db.renewNodeLease.return_value = defer.succeed(None)
+        self.db.expireNodes.return_value = defer.succeed([])
+        self.db.removeNodeLease.return_value = defer.succeed(None)
+
+        self.writer = HeartbeatWriter(self.db, self.metrics, "testserver",
+                                      interval=10.0, clock=self.clock)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def testRenewsLeaseOncePerTick(self):
+        assert self.db.renewNodeLease.call_count == 1
+
+        self.clock.advance(10)
+        self.clock.advance(10)
+
+        assert self.db.renewNodeLease.call_count == 3
+        self.db.renewNodeLease.assert_called_with("testserver")
+
+        timing = self.metrics.timings["heartbeat.flush_latency"]
+        assert timing["count"] == 3
+
+    def testCountsExpiredNodes(self):
+        self.db.expireNodes.return_value = defer.succeed(["deadserver"])
+
+        self.clock.advance(10)
+
+        assert self.metrics.counters["heartbeat.expired_nodes"] == 1
+
+    def testCountsFailedFlushes(self):
+        self.db.renewNodeLease.return_value = defer.fail(
+            Exception("Connection lost."))
+
+        self.clock.advance(10)
+
+        assert self.metrics.counters["heartbeat.flush_errors"] == 1
+        assert self.writer._loop.running
+
+    def testDropsLeaseOnStop(self):
+        self.writer.stop()
+
+        assert not self.writer._loop.running
+        self.db.removeNodeLease.assert_called_with("testserver")
+
+    def testAdvertisesMeshAddress(self):
+        writer = HeartbeatWriter(self.db, self.metrics, "otherserver",
+                                 mesh_address="otherserver:5800",
+                                 clock=self.clock)
+        writer.stop()
+
+        self.db.renewNodeLease.assert_any_call("otherserver",
+                                               mesh_address="otherserver:5800")
@@ -0,0 +1,226 @@
+import mock
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.words.protocols import irc
+from ircdd.listing import (GroupListProducer, GroupSizeReconciler,
+                           ListSnapshot, parseListFilters)
+from ircdd.metrics import Metrics
+
+
+class PausingTransport(proto_helpers.StringTransport):
+    """
+    A transport whose buffer is full after every write.
+    """
+
+    def write(self, data):
+        proto_helpers.StringTransport.write(self, data)
+        self.producer.pauseProducing()
+
+
+def makeGroups(names):
+    return [{"id": name, "name": name, "size": 1, "meta": {"topic": ""}}
+            for name in names]
+
+
+class TestParseListFilters:
+
+    def testChannelNamesAreNotFilters(self):
+        assert parseListFilters(["#python", "twisted"]) is None
+
+    def testParsesConditions(self):
+        filters = parseListFilters([">5", "<100", "#py*", "T:*release*"])
+
+        assert filters == {"min_users": 5,
+                           "max_users": 100,
+                           "name_masks": ["py*"],
+                           "topic_masks": ["*release*"]}
+
+
+class TestGroupListProducer:
+
+    def setUp(self):
+        self.user = mock.Mock()
+        self.user.transport = proto_helpers.StringTransport()
+        self.pages = []
+
+        def listGroupsPage(after=None, limit=100, **filters):
+            d = defer.Deferred()
+            self.pages.append((after, limit, filters, d))
+            return d
+
+        self.db = mock.Mock()
+        self.db.listGroupsPage.side_effect = listGroupsPage
+
+    def sent(self, command):
+        return [call[0] for call in self.user.sendMessage.call_args_list
+                if call[0][0] == command]
+
+    def testStreamsPages(self):
+        producer = GroupListProducer(self.user, self.db, {"min_users": 1},
+                                     page_size=2)
+        finished = producer.start()
+
+        assert self.user.transport.producer is producer
+
+        self.pages[0][3].callback(makeGroups(["a", "b"]))
+        assert self.pages[1][:3] == ("b", 2, {"min_users": 1})
+
+        self.pages[1][3].callback(makeGroups(["c"]))
+
+        assert len(self.sent(irc.RPL_LIST)) == 3
+        assert len(self.sent(irc.RPL_LISTEND)) == 1
+        assert finished.called
+        assert self.user.transport.producer is None
+
+    def testWaitsWhilePaused(self):
+        producer = GroupListProducer(self.user, self.db, page_size=2)
+        producer.start()
+
+        producer.pauseProducing()
+        self.pages[0][3].callback(makeGroups(["a", "b"]))
+
+        assert len(self.pages) == 1
+
+        producer.resumeProducing()
+
+        assert len(self.pages) == 2
+
+    def testEndsListOnFailure(self):
+        producer = GroupListProducer(self.user, self.db)
+        finished = producer.start()
+
+        self.pages[0][3].errback(Exception("Connection lost."))
+
+        assert len(self.sent(irc.RPL_LISTEND)) == 1
+        assert finished.called
+
+
+class TestListSnapshot:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+
+        self.groups = makeGroups(["python", "twisted", "zope"])
+        self.groups[0]["size"] = 10
+
+        def listGroupsPage(after=None, limit=100):
+            names = [group["id"] for group in self.groups]
+            start = names.index(after) + 1 if after else 0
+            return defer.succeed(self.groups[start:start + limit])
+
+        self.db = mock.Mock()
+        self.db.listGroupsPage.side_effect = listGroupsPage
+
+        self.snapshot = ListSnapshot(self.db, self.metrics, interval=30.0,
+                                     max_age=60.0, page_size=2,
+                                     clock=self.clock)
+
+        self.user = mock.Mock()
+        self.user.name = "john"
+        self.user.hostname = "testserver"
+        self.user.encoding = "utf-8"
+        self.user.transport = proto_helpers.StringTransport()
+
+    def tearDown(self):
+        self.snapshot.stop()
+
+    def testBuildsFromAllPages(self):
+        assert [entry[0] for entry in self.snapshot.groups] == \
+            ["python", "twisted", "zope"]
+        assert self.metrics.gauges["list.snapshot_groups"] == 3
+
+    def testServesPreEncodedReplies(self):
+        self.snapshot.reply(self.user)
+        self.snapshot.reply(self.user)
+
+        lines = self.user.transport.value().splitlines()
+        assert lines[0] == ":testserver 322 john python 10 :"
+        assert len(lines) == 6
+        assert self.metrics.counters["list.snapshot_replies"] == 2
+        self.user.sendMessage.assert_called_with(irc.RPL_LISTEND,
+                                                 ":End of /LIST")
+
+    def testEncodesRepliesForTheUser(self):
+        self.groups[0]["meta"]["topic"] = u"caf\xe9"
+        self.snapshot.refresh()
+        self.user.name = u"j\xf6hn"
+        self.user.encoding = "latin-1"
+
+        self.snapshot.reply(self.user, {"min_users": 5})
+
+        assert self.user.transport.value() == \
+            ":testserver 322 j\xf6hn python 10 :caf\xe9\r\n"
+
+    def testStreamsRepliesWhileTheClientReads(self):
+        self.snapshot.reply_page_size = 2
+        self.user.transport = PausingTransport()
+
+        finished = self.snapshot.reply(self.user)
+        producer = self.user.transport.producer
+
+        assert len(self.user.transport.value().splitlines()) == 2
+        assert not self.user.sendMessage.called
+
+        producer.resumeProducing()
+
+        assert len(self.user.transport.value().splitlines()) == 3
+        self.user.sendMessage.assert_called_once_with(irc.RPL_LISTEND,
+                                                      ":End of /LIST")
+        assert self.user.transport.producer is None
+        assert finished.called
+
+    def testFiltersInMemory(self):
+        self.snapshot.reply(self.user, {"min_users": 5})
+
+        lines = self.user.transport.value().splitlines()
+        assert lines == [":testserver 322 john python 10 :"]
+
+    def testGoesStaleWhenRebuildsFail(self):
+        assert self.snapshot.fresh()
+
+        self.db.listGroupsPage.side_effect = lambda **kw: defer.fail(
+            Exception("Connection lost."))
+        self.clock.advance(30)
+        self.clock.advance(30)
+
+        assert self.snapshot.fresh()
+
+        self.clock.advance(1)
+
+        assert not self.snapshot.fresh()
+        assert self.metrics.counters["list.snapshot_errors"] == 2
+
+
+class TestGroupSizeReconciler:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.db = mock.Mock()
+        self.db.reconcileGroupSizes.side_effect = lambda: defer.succeed(
+            [{"id": "python", "size": 3, "actual": 2}])
+
+        self.reconciler = GroupSizeReconciler(self.db, self.metrics,
+                                              interval=300.0,
+                                              clock=self.clock)
+
+    def tearDown(self):
+        self.reconciler.stop()
+
+    def testReconcilesPeriodically(self):
+        assert not self.db.reconcileGroupSizes.called
+
+        self.clock.advance(300)
+        self.clock.advance(300)
+
+        assert self.db.reconcileGroupSizes.call_count == 2
+        assert self.metrics.counters["groups.size_drift"] == 2
+
+    def testCountsErrors(self):
+        self.db.reconcileGroupSizes.side_effect = lambda: defer.fail(
+            RuntimeError("down"))
+
+        self.reconciler.reconcile()
+
+        assert self.metrics.counters["groups.reconcile_errors"] == 1
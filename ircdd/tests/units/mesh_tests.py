@@ -0,0 +1,95 @@
+import mock
+from twisted.internet import defer, task
+from ircdd.mesh import MeshTransport, decodeFrame, encodeFrame
+from ircdd.metrics import Metrics
+
+
+class TestMeshTransport:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.fallback = mock.Mock()
+        self.db = mock.Mock()
+        self.db.lookupNodeAddress.return_value = defer.succeed("node2:5800")
+        self.connected = []
+
+        def connect(host, port, proto):
+            self.connected.append((host, port))
+            proto.sendString = mock.Mock()
+            proto.transport = mock.Mock()
+            return defer.succeed(proto)
+
+        self.mesh = MeshTransport(self.fallback, self.db, "node1",
+                                  self.metrics, retry_delay=5.0,
+                                  clock=self.clock, connect=connect)
+
+    def testEncodesFrames(self):
+        frame = encodeFrame(u"inbox.node2", {"type": "join"}, "node1",
+                            recipient=u"test_group")
+        topic, received = decodeFrame(frame)
+
+        assert topic == u"inbox.node2"
+        assert received.parsed() == {"msg_body": {"type": "join"},
+                                     "origin": "node1",
+                                     "recipient": "test_group"}
+
+    def testFallsBackUntilConnected(self):
+        self.mesh.publish("inbox.node2", {"type": "privmsg"},
+                          recipient="john")
+
+        self.fallback.publish.assert_called_once_with(
+            "inbox.node2", {"type": "privmsg"}, callback=None,
+            recipient="john")
+        assert self.connected == [("node2", 5800)]
+
+        callback = mock.Mock()
+        self.mesh.publish("inbox.node2", {"type": "privmsg"},
+                          callback=callback, recipient="john")
+
+        peer = self.mesh._peers["node2"]
+        topic, received = decodeFrame(peer.sendString.call_args[0][0])
+        assert topic == "inbox.node2"
+        assert received.recipient == "john"
+        assert self.fallback.publish.call_count == 1
+        assert callback.called
+        assert self.metrics.counters["mesh.sent"] == 1
+
+    def testKeepsOtherTopicsOnFallback(self):
+        self.mesh.publish("test_group", {"type": "privmsg"})
+
+        assert self.fallback.publish.called
+        assert not self.db.lookupNodeAddress.called
+
+    def testRetriesUnreachablePeersLater(self):
+        self.db.lookupNodeAddress.return_value = defer.succeed(None)
+
+        self.mesh.publish("inbox.node2", {"type": "privmsg"})
+        self.mesh.publish("inbox.node2", {"type": "privmsg"})
+
+        assert self.db.lookupNodeAddress.call_count == 1
+        assert self.metrics.counters["mesh.connect_errors"] == 1
+
+        self.clock.advance(5)
+        self.mesh.publish("inbox.node2", {"type": "privmsg"})
+
+        assert self.db.lookupNodeAddress.call_count == 2
+
+    def testForgetsLostPeers(self):
+        self.mesh.publish("inbox.node2", {"type": "privmsg"})
+        self.mesh._peers["node2"].connectionLost(None)
+
+        assert self.mesh._peers == {}
+        assert self.metrics.gauges["mesh.peers"] == 0
+
+    def testDeliversFrames(self):
+        callback = mock.Mock()
+        self.mesh.subscribe("inbox.node1", callback)
+
+        self.mesh.receiveFrame(encodeFrame(u"inbox.node1", {"type": "join"},
+                                           "node2", recipient=u"john"))
+
+        message = callback.call_args[0][0]
+        assert message.parsed_msg["recipient"] == "john"
+        self.fallback.subscribe.assert_called_once_with("inbox.node1",
+                                                        callback)
@@ -0,0 +1,74 @@
+import datetime
+import time
+
+import mock
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.words.protocols import irc
+from ircdd.protocol import IRCDDUser
+from ircdd.user import ShardedUser
+
+
+class TestWhois:
+
+    def setUp(self):
+        self.user = IRCDDUser()
+        self.user.name = u"bob"
+        self.user.hostname = "testserver"
+        self.user.transport = proto_helpers.StringTransport()
+        self.user.ctx = mock.Mock()
+        self.user.realm = mock.Mock()
+        self.user.realm.name = "testserver"
+        self.user.realm.users = {}
+
+        self.now = datetime.datetime.now()
+        self.session = {"last_message": self.now - datetime.timedelta(0, 600),
+                        "session_start": self.now}
+        self.user.ctx.db.lookupUser.side_effect = lambda name: defer.succeed(
+            {"nickname": name, "session": self.session, "groups": []})
+
+    def idle(self):
+        for line in self.user.transport.value().splitlines():
+            if " %s " % irc.RPL_WHOISIDLE in line:
+                return int(line.split()[4])
+
+    def testReportsIdleFromSession(self):
+        self.user.irc_WHOIS("", ["john"])
+
+        assert 599 <= self.idle() <= 601
+
+    def testReportsIdleOfLocalUsers(self):
+        john = mock.Mock()
+        john.lastMessage = time.time() - 42
+        self.user.realm.users[u"john"] = john
+
+        self.user.irc_WHOIS("", ["john"])
+
+        assert 41 <= self.idle() <= 43
+
+    def testUnknownSession(self):
+        self.session = None
+
+        self.user.irc_WHOIS("", ["john"])
+
+        assert " %s " % irc.ERR_NOSUCHNICK in self.user.transport.value()
+        assert self.idle() is None
+
+
+class TestShardedUserSession:
+
+    def setUp(self):
+        self.ctx = mock.MagicMock()
+        self.ctx.db.touchUserSession.return_value = defer.succeed(None)
+        self.user = ShardedUser(self.ctx, u"john")
+        self.group = mock.Mock()
+        self.group.name = u"python"
+
+    @mock.patch("ircdd.user.time")
+    def testTouchesSessionEveryInterval(self, mock_time):
+        start = self.user.lastMessage
+        for delay in [1, 30, 61, 90, 122]:
+            mock_time.return_value = start + delay
+            self.user.send(self.group, {"text": u"hello"})
+
+        assert self.ctx.db.touchUserSession.call_count == 2
@@ -0,0 +1,126 @@
+import mock
+from twisted.internet import defer, task
+from twisted.words import ewords
+from ircdd.realm import GroupEvictor, ShardedRealm
+
+
+class StubGroup(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.local_sessions = {}
+        self.loaded = True
+        self.touched = False
+        self.closed = False
+
+    def load(self):
+        return defer.succeed(self)
+
+    def isIdle(self):
+        return self.loaded and not self.local_sessions
+
+    def close(self):
+        self.closed = True
+
+
+class TestShardedRealmGroups:
+
+    def setUp(self):
+        self.ctx = mock.MagicMock()
+        self.realm = ShardedRealm(self.ctx, "node1")
+
+    def testLookupLoadsGroup(self):
+        group = mock.Mock()
+        group.name = u"python"
+        group.load.return_value = defer.succeed(group)
+        self.realm.addGroup(group)
+
+        found = []
+        self.realm.lookupGroup(u"Python").addCallback(found.append)
+
+        assert found == [group]
+        group.load.assert_called_once_with()
+
+    def testLookupMovesGroupLast(self):
+        for name in [u"a", u"b", u"c"]:
+            self.realm.addGroup(StubGroup(name))
+
+        self.realm.lookupGroup(u"a")
+
+        assert list(self.realm.groups) == [u"b", u"c", u"a"]
+
+    def testRemoveGroupClosesIt(self):
+        group = StubGroup(u"python")
+        self.realm.addGroup(group)
+
+        self.realm.removeGroup(u"python")
+
+        assert group.closed
+        failures = []
+        self.realm.lookupGroup(u"python").addErrback(failures.append)
+        assert failures[0].check(ewords.NoSuchGroup)
+
+
+class TestGroupEvictor:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = mock.Mock()
+        self.realm = ShardedRealm(mock.MagicMock(), "node1")
+        self.evictor = GroupEvictor(self.realm, self.metrics,
+                                    idle_timeout=60, max_groups=3,
+                                    interval=30, clock=self.clock)
+
+    def addGroup(self, name, members=()):
+        group = StubGroup(name)
+        for member in members:
+            group.local_sessions[member] = mock.Mock()
+        self.realm.addGroup(group)
+        return group
+
+    def testEvictsIdleGroups(self):
+        idle = self.addGroup(u"idle")
+        busy = self.addGroup(u"busy", [u"john"])
+
+        # The first sweep clears the flags set by adding the groups.
+        assert self.evictor.sweep() == []
+        self.clock.advance(30)
+        self.clock.advance(30)
+        assert u"idle" in self.realm.groups
+
+        self.clock.advance(30)
+
+        assert list(self.realm.groups) == [u"busy"]
+        assert idle.closed
+        assert not busy.closed
+        self.metrics.increment.assert_called_once_with("groups.evicted", 1)
+
+    def testSkipsTouchedGroups(self):
+        self.addGroup(u"python")
+        self.evictor.sweep()
+        self.clock.advance(60)
+        self.realm.lookupGroup(u"python")
+
+        assert self.evictor.sweep() == []
+
+    def testSkipsUnloadedGroups(self):
+        group = self.addGroup(u"python")
+        group.loaded = False
+        self.evictor.sweep()
+        self.clock.advance(120)
+
+        assert self.evictor.sweep() == []
+
+    def testEvictsLeastRecentlyUsedOverLimit(self):
+        for name in [u"a", u"b", u"c", u"d", u"e"]:
+            self.addGroup(name)
+        self.addGroup(u"f", [u"john"])
+        self.evictor.sweep()
+
+        assert self.evictor.sweep() == [u"a", u"b", u"c"]
+        assert list(self.realm.groups) == [u"d", u"e", u"f"]
+
+    def testStop(self):
+        self.evictor.stop()
+
+        assert not self.evictor._loop.running
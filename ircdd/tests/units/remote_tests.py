@@ -1,13 +1,175 @@
 import mock
+import nsq
 import responses
-from ircdd.remote import RemoteReadWriter
+import tornado.ioloop
+from twisted.internet import defer, task
+from ircdd import envelope
+from ircdd.flow import FlowController
+from ircdd.metrics import Metrics
+from ircdd.remote import BatchingPublisher, ChannelSweeper, \
+    ClosableReader, LookupdProvisioner, RemoteReadWriter, TopicSweeper, \
+    channelName, channelNode
 from nose.tools import assert_raises
 
 
+class FakeAgent(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url):
+        d = defer.Deferred()
+        self.requests.append((url, d))
+        return d
+
+    def respond(self, code=200):
+        pending, self.requests = self.requests, []
+        for (url, d) in pending:
+            response = mock.Mock()
+            response.code = code
+            d.callback(response)
+
+
+@mock.patch("ircdd.remote.readBody", lambda response: defer.succeed(""))
+class TestLookupdProvisioner:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.provisioner = LookupdProvisioner(["lookupd1:4161",
+                                               "lookupd2:4161"],
+                                              batch_delay=0.05,
+                                              agent=self.agent,
+                                              clock=self.clock)
+
+    def testProvisionsInParallelBatches(self):
+        results = []
+        for topic in ["a", "b", "a"]:
+            self.provisioner.provision(topic, "testserver").addCallback(
+                results.append)
+
+        assert self.agent.requests == []
+
+        self.clock.advance(0.05)
+
+        urls = [url for (url, _) in self.agent.requests]
+        assert sorted(urls) == [
+            "http://lookupd1:4161/create_topic?topic=a",
+            "http://lookupd1:4161/create_topic?topic=b",
+            "http://lookupd2:4161/create_topic?topic=a",
+            "http://lookupd2:4161/create_topic?topic=b"]
+
+        self.agent.respond()
+        assert len(self.agent.requests) == 4
+
+        self.agent.respond()
+        assert results == [True, True, True]
+
+    def testSkipsProvisionedChannels(self):
+        self.provisioner.provision("a", "testserver")
+        self.clock.advance(0.05)
+        self.agent.respond()
+        self.agent.respond()
+
+        results = []
+        self.provisioner.provision("a", "testserver").addCallback(
+            results.append)
+
+        assert results == [True]
+        assert self.agent.requests == []
+        assert not self.clock.getDelayedCalls()
+
+    def testRetriesFailures(self):
+        results = []
+        self.provisioner.provision("a", "testserver").addCallback(
+            results.append)
+        self.clock.advance(0.05)
+        self.agent.respond(code=500)
+
+        assert results == [False]
+
+        self.provisioner.provision("a", "testserver")
+        self.clock.advance(0.05)
+
+        assert len(self.agent.requests) == 2
+
+    def testTimesOutRequests(self):
+        results = []
+        self.provisioner.provision("a", "testserver").addCallback(
+            results.append)
+        self.clock.advance(0.05)
+        self.clock.advance(5)
+
+        assert results == [False]
+
+
+class TestClosableReader:
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.reader = ClosableReader(
+            topic="testopic", channel="testserver",
+            message_handler=lambda message: True,
+            lookupd_http_addresses=["testserver:5566"],
+            io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    @mock.patch("ircdd.remote.ClosableReader.query_lookupd")
+    def testClose(self, query_lookupd):
+        self.reader._run()
+        periodic_callbacks = self.reader._periodic_callbacks
+        poll_start = self.reader._poll_start
+        conn = mock.Mock()
+        self.reader.conns["testserver:4150"] = conn
+
+        assert query_lookupd.call_count == 1
+        assert [periodic.is_running() for periodic in periodic_callbacks] \
+            == [True, False]
+
+        self.reader.close()
+
+        conn.close.assert_called_once_with()
+        assert not any(periodic.is_running()
+                       for periodic in periodic_callbacks)
+        # The lookupd poll, which had not started yet, never will.
+        assert poll_start.callback is None
+
+    def testStaysClosed(self):
+        self.reader.close()
+
+        self.reader._run()
+        assert self.reader.connect_to_nsqd("testserver", 4150) is None
+        assert self.reader.conns == {}
+        assert self.reader._periodic_callbacks == []
+
+    def testSetsMaxInFlight(self):
+        conn = mock.Mock(rdy=1, max_rdy_count=2500, rdy_timeout=None)
+        conn.send_rdy.return_value = True
+        self.reader.conns["testserver:4150"] = conn
+        self.reader.total_rdy = 1
+
+        self.reader.set_max_in_flight(50)
+
+        conn.send_rdy.assert_called_once_with(50)
+        assert self.reader.total_rdy == 50
+
+    def testKeepsBackoffRdy(self):
+        conn = mock.Mock(rdy=0, max_rdy_count=2500, rdy_timeout=None)
+        self.reader.conns["testserver:4150"] = conn
+        self.reader.backoff_timer.failure()
+
+        self.reader.set_max_in_flight(50)
+
+        assert self.reader.max_in_flight == 50
+        assert not conn.send_rdy.called
+
+
 class TestRemoteReadWriter:
 
     @mock.patch("nsq.Writer")
-    @mock.patch("nsq.Reader")
+    @mock.patch("ircdd.remote.ClosableReader")
     @mock.patch("tornado.ioloop.IOLoop")
     @responses.activate
     def testSubscribes(self, mock_writer, mock_reader, mock_ioloop):
@@ -30,7 +192,7 @@ class TestRemoteReadWriter:
         assert rw._readers.get(topic, False)
 
     @mock.patch("nsq.Writer")
-    @mock.patch("nsq.Reader")
+    @mock.patch("ircdd.remote.ClosableReader")
     @mock.patch("tornado.ioloop.IOLoop")
     @responses.activate
     def testUnsubscribes(self, mock_writer, mock_reader, mock_ioloop):
@@ -55,7 +217,7 @@ class TestRemoteReadWriter:
         assert rw._readers.get(topic, None) is None
 
     @mock.patch("nsq.Writer")
-    @mock.patch("nsq.Reader")
+    @mock.patch("ircdd.remote.ClosableReader")
     @mock.patch("tornado.ioloop.IOLoop")
     def testUnsubscribeFails(self, mock_writer, mock_reader, mock_ioloop):
         server_name = "testserver"
@@ -69,7 +231,105 @@ class TestRemoteReadWriter:
         assert_raises(KeyError, rw.unsubscribe, topic)
 
     @mock.patch("nsq.Writer")
-    @mock.patch("nsq.Reader")
+    @mock.patch("ircdd.remote.ClosableReader")
+    @mock.patch("ircdd.remote.LookupdProvisioner")
+    def testCountsSubscriptions(self, mock_provisioner, mock_reader,
+                                mock_writer):
+        clock = task.Clock()
+        metrics = Metrics()
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", metrics=metrics,
+                              unsubscribe_grace=10.0, clock=clock)
+
+        rw.subscribe("testopic", "first")
+        rw.subscribe("testopic", "second")
+
+        assert mock_reader.call_count == 1
+        assert metrics.gauges["nsq.readers"] == 1
+
+        rw.unsubscribe("testopic")
+        rw.unsubscribe("testopic")
+        clock.advance(5)
+
+        # Resubscribing within the grace period reuses the reader.
+        rw.subscribe("testopic", "third")
+        clock.advance(10)
+
+        assert mock_reader.call_count == 1
+        assert rw._callbacks["testopic"] == "third"
+
+        rw.unsubscribe("testopic")
+        assert_raises(KeyError, rw.unsubscribe, "testopic")
+
+        clock.advance(10)
+
+        assert rw._readers == {}
+        assert mock_reader.return_value.close.called
+        assert metrics.gauges["nsq.readers"] == 0
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("ircdd.remote.ClosableReader")
+    @mock.patch("ircdd.remote.LookupdProvisioner")
+    def testReadsEphemeralChannels(self, mock_provisioner, mock_reader,
+                                   mock_writer):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", ephemeral_channels=True)
+
+        rw.subscribe("testopic", "callback")
+
+        assert mock_reader.call_args[1]["channel"] == \
+            "ircdd.testserver#ephemeral"
+        mock_provisioner.return_value.provision.assert_called_once_with(
+            "testopic", "ircdd.testserver#ephemeral")
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("ircdd.remote.ClosableReader")
+    @mock.patch("ircdd.remote.LookupdProvisioner")
+    def testHandsReadersToFlowController(self, mock_provisioner,
+                                         mock_reader, mock_writer):
+        flow = mock.Mock()
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", flow=flow)
+
+        rw.subscribe("testopic", "callback")
+        flow.register.assert_called_once_with("testopic",
+                                              mock_reader.return_value)
+
+        rw.unsubscribe("testopic")
+        flow.unregister.assert_called_once_with("testopic")
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("ircdd.remote.LookupdProvisioner")
+    def testNeverGivesUpOnRequeuedMessages(self, mock_provisioner,
+                                           mock_writer):
+        flow = FlowController(Metrics(), clock=task.Clock())
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", flow=flow)
+        callback = mock.Mock(return_value=True)
+        rw.subscribe("testopic", callback)
+        reader = rw._readers["testopic"]
+
+        conn = mock.Mock()
+        conn.rdy = conn.last_rdy = 10
+        body = envelope.encode({"type": "privmsg"}, u"otherserver")
+
+        # Every requeue while overloaded counts as an attempt.
+        flow.overloaded = True
+        for attempts in range(1, 8):
+            message = nsq.Message("id", body, 0, attempts)
+            reader._handle_message(conn, message)
+            assert message.has_responded()
+            assert not callback.called
+
+        flow.overloaded = False
+        message = nsq.Message("id", body, 0, 8)
+        reader._handle_message(conn, message)
+
+        callback.assert_called_once_with(message)
+        rw.unsubscribe("testopic")
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("ircdd.remote.ClosableReader")
     @mock.patch("nsq.Message")
     @mock.patch("tornado.ioloop.IOLoop")
     def testFilteredMethodFilters(self, mock_w, mock_r, mock_m, mock_io):
@@ -91,7 +351,7 @@ class TestRemoteReadWriter:
         assert filteredCb(mock_m) != mock_m.parsed_body["message"]
 
     @mock.patch("nsq.Writer")
-    @mock.patch("nsq.Reader")
+    @mock.patch("ircdd.remote.ClosableReader")
     @mock.patch("nsq.Message")
     @mock.patch("tornado.ioloop.IOLoop")
     def testFilteredMethodPassThrough(self, mock_w, mock_r, mock_m, mock_io):
@@ -111,3 +371,188 @@ class TestRemoteReadWriter:
                       }"""
 
         assert filteredCb(mock_m) == mock_m.parsed_body["message"]
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("ircdd.remote.ClosableReader")
+    @mock.patch("nsq.Message")
+    @mock.patch("tornado.ioloop.IOLoop")
+    def testFiltersBinaryEnvelopes(self, mock_w, mock_r, mock_m, mock_io):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver")
+        callback = mock.Mock()
+        filteredCb = rw.filter_callback(callback)
+
+        # The body is cut short, so it cannot be parsed.
+        mock_m.body = envelope.encode({"type": "join"}, u"testserver")[:-1]
+        filteredCb(mock_m)
+
+        assert not callback.called
+        assert mock_m.finish.called
+
+        mock_m.body = envelope.encode({"type": "join"}, u"otherserver")
+        filteredCb(mock_m)
+
+        callback.assert_called_once_with(mock_m)
+        assert mock_m.parsed_msg["msg_body"] == {"type": "join"}
+
+
+class TestBatchingPublisher:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.writer = mock.Mock()
+        self.publisher = BatchingPublisher(self.writer, window=0.01, size=3,
+                                           metrics=self.metrics,
+                                           clock=self.clock)
+
+    def testFlushesAfterWindow(self):
+        self.publisher.pub("a", "1")
+        self.publisher.pub("a", "2")
+        self.publisher.pub("b", "3")
+
+        assert not self.writer.mpub.called
+
+        self.clock.advance(0.01)
+
+        assert self.writer.mpub.call_args[0][:2] == ("a", ["1", "2"])
+        assert self.writer.pub.call_args[0][:2] == ("b", "3")
+        assert self.metrics.timings["publish.batch_size"]["max"] == 2
+
+    def testFlushesFullBatches(self):
+        for msg in ["1", "2", "3"]:
+            self.publisher.pub("a", msg)
+
+        assert self.writer.mpub.call_args[0][:2] == ("a", ["1", "2", "3"])
+        assert not self.clock.getDelayedCalls()
+
+    def testCallsEveryCallback(self):
+        callbacks = [mock.Mock(), mock.Mock()]
+        for (msg, callback) in zip(["1", "2"], callbacks):
+            self.publisher.pub("a", msg, callback=callback)
+        self.clock.advance(0.01)
+
+        finish = self.writer.mpub.call_args[1]["callback"]
+        finish("conn", "OK")
+
+        for callback in callbacks:
+            callback.assert_called_once_with("conn", "OK")
+        assert self.metrics.timings["publish.flush_latency"]["count"] == 1
+
+
+@mock.patch("twisted.internet.threads.deferToThread",
+            lambda f, *args: defer.maybeDeferred(f, *args))
+@mock.patch("ircdd.remote._topics", lambda addresses: ["john", "python"])
+@mock.patch("ircdd.remote._channels", lambda topic, addresses: [
+    "ircdd.testserver", "ircdd.deadserver", "ircdd.otherserver#ephemeral",
+    "testserver", "otherserver", "deadserver", "tail123456#ephemeral",
+    "ircdd.", "ircdd.#ephemeral"])
+class TestChannelSweeper:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.db = mock.Mock()
+        self.db.listLiveNodes.side_effect = lambda: defer.succeed(
+            ["testserver", "otherserver"])
+
+        self.sweeper = ChannelSweeper(self.db, ["testserver:4161"],
+                                      "testserver", self.metrics,
+                                      interval=600.0, clock=self.clock)
+
+    def tearDown(self):
+        self.sweeper.stop()
+
+    @mock.patch("ircdd.remote._delete_channel")
+    def testDeletesChannelsOrphanedTwice(self, delete_channel):
+        self.clock.advance(600)
+
+        assert not delete_channel.called
+
+        self.clock.advance(600)
+
+        assert delete_channel.call_args_list == [
+            mock.call("john", "ircdd.deadserver", ["testserver:4161"]),
+            mock.call("john", "testserver", ["testserver:4161"]),
+            mock.call("python", "ircdd.deadserver", ["testserver:4161"]),
+            mock.call("python", "testserver", ["testserver:4161"])]
+        assert self.metrics.counters["nsq.pruned_channels"] == 4
+
+    def testChannelNames(self):
+        assert channelNode(channelName("testserver")) == "testserver"
+        assert channelNode(channelName("testserver", True)) == "testserver"
+        assert channelNode("testserver") is None
+        assert channelNode("tail123456#ephemeral") is None
+
+    @mock.patch("ircdd.remote._delete_channel")
+    def testSkipsSweepsWithoutOwnLease(self, delete_channel):
+        self.db.listLiveNodes.side_effect = lambda: defer.succeed([])
+
+        self.clock.advance(600)
+        self.clock.advance(600)
+
+        assert not delete_channel.called
+
+
+@mock.patch("twisted.internet.threads.deferToThread",
+            lambda f, *args: defer.maybeDeferred(f, *args))
+@mock.patch("ircdd.remote._topics", lambda addresses: [
+    "john", "bob", "python", "zope", "inbox.testserver", "nsq_tool"])
+class TestTopicSweeper:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.db = mock.Mock()
+        self.db.listLiveNodes.side_effect = lambda: defer.succeed(
+            ["testserver"])
+        self.db.listActiveTopics.side_effect = lambda: defer.succeed(
+            ["john", "python"])
+        self.db.listKnownTopics.side_effect = lambda topics: defer.succeed(
+            [topic for topic in topics
+             if topic in ("john", "bob", "python", "zope")])
+
+        self.sweeper = TopicSweeper(self.db, ["testserver:4161"],
+                                    "testserver", self.metrics,
+                                    interval=3600.0, retention=7200.0,
+                                    limit=1, clock=self.clock)
+
+    def tearDown(self):
+        self.sweeper.stop()
+
+    @mock.patch("ircdd.remote._delete_topic")
+    def testDeletesTopicsUnusedForRetention(self, delete_topic):
+        self.clock.advance(3600)
+        self.clock.advance(3600)
+
+        assert not delete_topic.called
+
+        self.clock.advance(3600)
+
+        delete_topic.assert_called_once_with("bob", ["testserver:4161"])
+
+        self.clock.advance(3600)
+
+        delete_topic.assert_called_with("zope", ["testserver:4161"])
+        assert self.metrics.counters["nsq.pruned_topics"] == 2
+
+    @mock.patch("ircdd.remote._delete_topic")
+    def testOnlyDeletesTopicsOfThisServer(self, delete_topic):
+        with mock.patch("ircdd.remote._topics", lambda addresses: [
+                "nsq_tool", "inbox.deadserver"]):
+            for _ in range(4):
+                self.clock.advance(3600)
+
+        delete_topic.assert_called_once_with("inbox.deadserver",
+                                             ["testserver:4161"])
+
+    @mock.patch("ircdd.remote._delete_topic")
+    def testForgetsTopicsInUseAgain(self, delete_topic):
+        self.clock.advance(3600)
+        self.db.listActiveTopics.side_effect = lambda: defer.succeed(
+            ["john", "bob", "python", "zope"])
+        self.clock.advance(3600)
+        self.db.listActiveTopics.side_effect = lambda: defer.succeed([])
+        self.clock.advance(3600)
+
+        assert not delete_topic.called
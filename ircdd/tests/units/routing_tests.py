@@ -0,0 +1,100 @@
+import mock
+from twisted.internet import defer
+from ircdd.routing import NodeRouter
+from nose.tools import assert_raises
+
+
+class TestNodeRouter:
+
+    def setUp(self):
+        self.remote_rw = mock.Mock()
+        self.db = mock.Mock()
+        self.router = NodeRouter(self.remote_rw, self.db, "testserver")
+
+    def testConsumesInbox(self):
+        self.remote_rw.subscribe.assert_called_once_with(
+            "inbox.testserver", self.router.receive)
+
+    def testPublishesOncePerRemoteNode(self):
+        self.db.lookupRoutes.return_value = defer.succeed(
+            ["testserver", "node1", "node2"])
+
+        nodes = []
+        self.router.publish("test_group", {"type": "privmsg"}).addCallback(
+            nodes.extend)
+
+        assert nodes == ["node1", "node2"]
+        self.remote_rw.publish.assert_any_call(
+            "inbox.node1", {"type": "privmsg"}, callback=None,
+            recipient="test_group")
+        assert self.remote_rw.publish.call_count == 2
+
+    def testPublishesInOrder(self):
+        lookups = []
+
+        def lookupRoutes(topic):
+            lookups.append(defer.Deferred())
+            return lookups[-1]
+
+        self.db.lookupRoutes.side_effect = lookupRoutes
+
+        self.router.publish("test_group", {"text": "first"})
+        self.router.publish("test_group", {"text": "second"})
+        self.router.publish("other_group", {"text": "third"})
+
+        # The lookup of the second topic completes first.
+        lookups[-1].callback(["node2"])
+        lookups[0].callback(["node1"])
+
+        assert len(lookups) == 2
+        assert [call[0][:2] for call in
+                self.remote_rw.publish.call_args_list] == [
+            ("inbox.node2", {"text": "third"}),
+            ("inbox.node1", {"text": "first"}),
+            ("inbox.node1", {"text": "second"})]
+
+        # Later messages look their routes up again.
+        self.db.lookupRoutes.side_effect = None
+        self.db.lookupRoutes.return_value = defer.succeed(["node3"])
+        self.router.publish("test_group", {"text": "fourth"})
+
+        self.remote_rw.publish.assert_called_with(
+            "inbox.node3", {"text": "fourth"}, callback=None,
+            recipient="test_group")
+
+    def testFailedLookupsReleaseWaitingMessages(self):
+        self.db.lookupRoutes.return_value = defer.fail(Exception("down"))
+
+        results = []
+        self.router.publish("test_group", {}).addCallback(results.append)
+
+        assert results == [None]
+        assert "test_group" not in self.router._pending
+
+    def testDispatchesByRecipient(self):
+        callback = mock.Mock()
+        self.router.subscribe("john", callback)
+
+        message = mock.Mock()
+        message.parsed_msg = {"recipient": "john", "msg_body": {}}
+        self.router.receive(message)
+
+        callback.assert_called_once_with(message)
+
+    def testDropsMessagesWithoutRecipient(self):
+        message = mock.Mock()
+        message.parsed_msg = {"recipient": "bob", "msg_body": {}}
+
+        assert self.router.receive(message)
+        assert message.finish.called
+
+    def testCountsSubscriptions(self):
+        self.router.subscribe("john", mock.Mock())
+        self.router.subscribe("john", mock.Mock())
+
+        self.router.unsubscribe("john")
+        assert "john" in self.router._callbacks
+
+        self.router.unsubscribe("john")
+        assert "john" not in self.router._callbacks
+        assert_raises(KeyError, self.router.unsubscribe, "john")
@@ -0,0 +1,65 @@
+import mock
+from twisted.internet import task
+from zope.interface.verify import verifyClass
+from ircdd.remote import RemoteReadWriter
+from ircdd.routing import NodeRouter
+from ircdd.transport import IMessageTransport, LoopbackHub, \
+    LoopbackTransport
+from nose.tools import assert_raises
+
+
+class TestLoopbackTransport:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.hub = LoopbackHub(clock=self.clock)
+        self.node1 = LoopbackTransport(self.hub, "node1")
+        self.node2 = LoopbackTransport(self.hub, "node2")
+
+    def testImplementsTransport(self):
+        for cls in [LoopbackTransport, RemoteReadWriter, NodeRouter]:
+            assert verifyClass(IMessageTransport, cls)
+
+    def testDeliversToOtherNodes(self):
+        received1 = mock.Mock()
+        received2 = mock.Mock()
+        self.node1.subscribe("test_group", received1)
+        self.node2.subscribe("test_group", received2)
+
+        self.node1.publish("test_group", {"type": "privmsg"},
+                           recipient="john")
+
+        assert not received2.called
+
+        self.clock.advance(0)
+
+        assert not received1.called
+        message = received2.call_args[0][0]
+        assert message.parsed_msg == {"msg_body": {"type": "privmsg"},
+                                      "origin": "node1",
+                                      "recipient": "john"}
+
+    def testRequeuesMessages(self):
+        received = mock.Mock(side_effect=lambda message: message.requeue()
+                             if message.attempts == 1 else message.finish())
+        self.node2.subscribe("john", received)
+
+        self.node1.publish("john", {"type": "privmsg"})
+        self.clock.advance(0)
+        self.clock.advance(0)
+
+        assert received.call_count == 2
+        assert received.call_args[0][0].has_responded()
+
+    def testCountsSubscriptions(self):
+        received = mock.Mock()
+        self.node2.subscribe("john", received)
+        self.node2.subscribe("john", received)
+
+        self.node2.unsubscribe("john")
+        self.node1.publish("john", {"type": "privmsg"})
+        self.node2.unsubscribe("john")
+        self.clock.advance(0)
+
+        assert not received.called
+        assert_raises(KeyError, self.node2.unsubscribe, "john")
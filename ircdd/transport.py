@@ -0,0 +1,166 @@
+from zope.interface import Interface, implements
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class IMessageTransport(Interface):
+    """
+    Carries messages between the nodes of a cluster. Every node reads
+    its own copy of each message published to the topics it subscribes
+    to, except for the messages it published itself.
+    """
+
+    def subscribe(topic, callback):
+        """
+        Delivers the messages published to `topic` to the callback,
+        replacing any previous callback. Subscriptions are counted, and
+        the topic is listened to until each of them is released.
+
+        The callback receives a message which provides the `parsed_msg`
+        dictionary, holding `msg_body`, `origin` and, optionally,
+        `recipient`, and must call its `finish` or `requeue` method.
+        """
+
+    def unsubscribe(topic):
+        """
+        Releases one subscription to `topic`.
+        Raises `KeyError` if the topic is not subscribed to.
+        """
+
+    def publish(topic, msg_body, callback=None, recipient=None):
+        """
+        Publishes the message body to `topic`. The optional callback
+        is called with `(conn, data)` once the message is sent, where
+        `data` is an error if sending failed. `recipient` names the
+        user or group the message is addressed to, when it differs
+        from the topic.
+        """
+
+    def flush():
+        """
+        Sends the messages which are still buffered, if any.
+        """
+
+
+class LoopbackMessage(object):
+    """
+    A message delivered by a :class:`LoopbackTransport`.
+    """
+
+    def __init__(self, hub, node, topic, parsed_msg):
+        self.parsed_msg = parsed_msg
+        self.attempts = 1
+
+        self._hub = hub
+        self._node = node
+        self._topic = topic
+        self._responded = False
+
+    def finish(self):
+        self._responded = True
+
+    def requeue(self, **kwargs):
+        self._responded = True
+        self.attempts += 1
+        self._hub.deliver(self._node, self._topic, self)
+
+    def touch(self):
+        pass
+
+    def has_responded(self):
+        return self._responded
+
+
+class LoopbackHub(object):
+    """
+    Connects the :class:`LoopbackTransport` of several nodes running
+    in the same process, standing in for a message broker.
+
+    Messages are delivered on a later reactor iteration, like those
+    read from a broker. Their bodies are handed over without being
+    serialized, so they must not be modified once published. Unlike a
+    broker, the hub drops the messages of topics no node subscribes to.
+
+    :param clock: an `IReactorTime` provider, defaults to the reactor.
+    """
+
+    def __init__(self, clock=None):
+        self._clock = clock or reactor
+        # Maps each topic to the callbacks of the nodes subscribed to it.
+        self._topics = {}
+
+    def attach(self, node, topic, callback):
+        self._topics.setdefault(topic, {})[node] = callback
+
+    def detach(self, node, topic):
+        nodes = self._topics[topic]
+        del nodes[node]
+        if not nodes:
+            del self._topics[topic]
+
+    def publish(self, origin, topic, parsed_msg):
+        """
+        Delivers a copy of the message to every node subscribed to
+        `topic`, other than its origin.
+        """
+        for node in self._topics.get(topic, {}).keys():
+            if node != origin:
+                self.deliver(node, topic,
+                             LoopbackMessage(self, node, topic, parsed_msg))
+
+    def deliver(self, node, topic, message):
+        self._clock.callLater(0, self._dispatch, node, topic, message)
+
+    def _dispatch(self, node, topic, message):
+        callback = self._topics.get(topic, {}).get(node)
+        if callback is None:
+            return
+
+        try:
+            callback(message)
+        except Exception:
+            log.err(None, "Failed to handle a message on %s" % topic)
+
+
+class LoopbackTransport(object):
+    """
+    An in-process :class:`IMessageTransport`, which exchanges messages
+    with the other nodes attached to the same :class:`LoopbackHub`
+    without a broker or any serialization.
+
+    :param hub: the :class:`LoopbackHub` shared by the nodes.
+    :param server_name: the name of this node.
+    """
+    implements(IMessageTransport)
+
+    def __init__(self, hub, server_name):
+        self.hub = hub
+        self.server_name = server_name
+
+        self._subscribers = {}
+
+    def subscribe(self, topic, callback):
+        self.hub.attach(self.server_name, topic, callback)
+        self._subscribers[topic] = self._subscribers.get(topic, 0) + 1
+
+    def unsubscribe(self, topic):
+        subscribers = self._subscribers[topic] - 1
+        if subscribers > 0:
+            self._subscribers[topic] = subscribers
+            return
+
+        del self._subscribers[topic]
+        self.hub.detach(self.server_name, topic)
+
+    def publish(self, topic, msg_body, callback=None, recipient=None):
+        parsed_msg = dict(msg_body=msg_body, origin=self.server_name)
+        if recipient is not None:
+            parsed_msg["recipient"] = recipient
+
+        self.hub.publish(self.server_name, topic, parsed_msg)
+        if callback is not None:
+            callback(None, "OK")
+
+    def flush(self):
+        pass
@@ -3,7 +3,7 @@ from time import time
 from zope.interface import implements
 
 from twisted.words import iwords
-from twisted.internet import task
+from twisted.python import log
 
 
 class ShardedUser(object):
@@ -11,36 +11,59 @@ class ShardedUser(object):
     mind = None
     realm = None
 
+    # Seconds between two updates of the session's last message time.
+    SESSION_TOUCH_INTERVAL = 60
+
     """
     A User which may exist in a sharded state on different IRC
     servers. It subscribes to its own topic on the message queue
     and sends/responds to remote messages.
+
+    Users connected to other nodes are only represented locally, and
+    do not subscribe to their topic: the node they are connected to
+    does. A local user releases its subscription on logout.
     """
-    def __init__(self, ctx, name, mind=None):
+    def __init__(self, ctx, name, mind=None, local=True):
         self.name = name
         self.groups = []
         self.lastMessage = time()
+        self._sessionTouched = self.lastMessage
         self.mind = mind
 
         self.ctx = ctx
-        self.ctx["remote_rw"].subscribe(self.name, self.receiveRemote)
+        self._subscribed = False
+        if local:
+            self._subscribe()
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self.ctx["remote_rw"].subscribe(self.name, self.receiveRemote)
+            self._subscribed = True
 
-        self.heartbeat = task.LoopingCall(self._hbSession)
-        self.heartbeat_groups = task.LoopingCall(self._hbGroupSession)
+    def _unsubscribe(self):
+        if self._subscribed:
+            self.ctx["remote_rw"].unsubscribe(self.name)
+            self._subscribed = False
 
-    def _hbSession(self):
+    def _startSession(self):
         """
-        Sends a hearbeat to the user's session document.
+        Creates the user's session document, owned by this node.
+        The session stays active for as long as the node's lease,
+        which is renewed by :class:`ircdd.heartbeat.HeartbeatWriter`.
         """
-        self.ctx.db.heartbeatUserSession(self.name)
+        d = self.ctx.db.startUserSession(self.name, self.ctx.hostname)
+        return d.addErrback(log.err, "Starting session failed for %s" %
+                            self.name)
 
-    def _hbGroupSession(self):
+    def _enterGroup(self, group):
         """
-        Sends heartbeats to all the groups that this user is a part of
-        in order to maintain presence in them.
+        Records the user's presence in the given group, owned by
+        this node.
         """
-        for group in self.groups:
-            self.ctx.db.heartbeatUserInGroup(self.name, group.name)
+        d = self.ctx.db.addUserToGroup(self.name, group.name,
+                                       self.ctx.hostname)
+        return d.addErrback(log.err, "Entering %s failed for %s" %
+                            (group.name, self.name))
 
     def send(self, recipient, message):
         """
@@ -65,8 +88,24 @@ class ShardedUser(object):
 
         self.ctx.remote_rw.publish(recipient.name, message)
         self.lastMessage = time()
+        self._touchSession()
         return recipient.receive(self.name, recipient, message)
 
+    def _touchSession(self):
+        """
+        Records the time of the user's last message in its session, at
+        most once every `SESSION_TOUCH_INTERVAL` seconds. The nodes
+        which answer WHOIS for this user report its idle time from it.
+        """
+        if self.lastMessage - self._sessionTouched < \
+                self.SESSION_TOUCH_INTERVAL:
+            return
+
+        self._sessionTouched = self.lastMessage
+        d = self.ctx.db.touchUserSession(self.name)
+        d.addErrback(log.err, "Touching the session failed for %s" %
+                     self.name)
+
     def receiveRemote(self, message):
         """
         Callback which is executed when the Reader for this user's
@@ -87,30 +126,24 @@ class ShardedUser(object):
     def loggedIn(self, realm, mind):
         """
         Associates this ShardedUser with a client connection
-        and starts to heartbeat the user's session and group
-        subscription,
-        completing the login process.
+        and starts the user's session, completing the login process.
         """
         self.realm = realm
         self.mind = mind
 
-        self._hbSession()
-
-        self.heartbeat.start(10.0)
-        self.heartbeat_groups.start(10.0)
+        self._subscribe()
+        self._startSession()
 
     def logout(self):
         """
         Stops maintaining the sessions and cleans them,
         completing the logout process
         """
-        self.heartbeat.stop()
-        self.heartbeat_groups.stop()
-
-        for g in self.groups:
+        for g in self.groups[:]:
             self.leave(g)
 
-        self.ctx.db.removeUserSession(self.name)
+        self._unsubscribe()
+        return self.ctx.db.removeUserSession(self.name)
 
     def join(self, group):
         """
@@ -120,8 +153,7 @@ class ShardedUser(object):
         """
         def cbJoin(result):
             self.groups.append(group)
-            self._hbGroupSession()
-            return result
+            return self._enterGroup(group).addCallback(lambda _: result)
 
         return group.add(self.mind).addCallback(cbJoin)
 
@@ -132,6 +164,6 @@ class ShardedUser(object):
         """
         def cbLeave(result):
             self.groups.remove(group)
-            self.ctx.db.removeUserFromGroup(self.name, group.name)
+            return self.ctx.db.removeUserFromGroup(self.name, group.name)
 
         return group.remove(self.mind, reason).addCallback(cbLeave)
@@ -0,0 +1,109 @@
+#! /usr/bin/env python2.7
+"""
+Measures how many messages per second a group delivers to its local
+users, against the number of those users.
+
+Each size is measured twice: through the fast path, which encodes a
+message once for every user, and through the per-user `receive` path,
+which every user took before.
+
+    python scripts/benchmarks/fanout.py --sizes 10,100,1000,5000
+"""
+import argparse
+import time
+
+from twisted.internet import defer
+
+from ircdd.group import ShardedGroup
+from ircdd.protocol import IRCDDUser
+
+
+class NullTransport(object):
+    """
+    Discards everything written to it.
+    """
+
+    def write(self, data):
+        pass
+
+
+class SlowPathUser(object):
+    """
+    Hides the fast path of the user it wraps.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.name = user.name
+
+    def receive(self, sender_name, recipient, message):
+        return self.user.receive(sender_name, recipient, message)
+
+
+class StubRemote(object):
+
+    def subscribe(self, topic, callback):
+        pass
+
+
+class StubDatabase(object):
+
+    def lookupGroup(self, name):
+        return defer.succeed(None)
+
+    def getGroupState(self, name):
+        return defer.succeed(None)
+
+
+class StubFeeds(object):
+
+    def register(self, group):
+        pass
+
+
+class StubContext(object):
+    remote_rw = StubRemote()
+    db = StubDatabase()
+    feeds = StubFeeds()
+
+
+def makeGroup(size, fast):
+    group = ShardedGroup(StubContext(), u"bench")
+    for i in range(size):
+        user = IRCDDUser()
+        user.name = u"user%d" % i
+        user.hostname = "benchserver"
+        user.transport = NullTransport()
+        group.local_sessions[user.name] = user if fast else \
+            SlowPathUser(user)
+    return group
+
+
+def measure(group, duration):
+    message = {"type": "privmsg", "text": u"Hello, everyone!"}
+    sent = 0
+    start = time.time()
+    while time.time() - start < duration:
+        group.receive(u"sender", group, message)
+        sent += 1
+    return sent / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000",
+                        help="comma-separated numbers of local users")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="seconds spent measuring each case")
+    args = parser.parse_args()
+
+    print "%8s %14s %14s %8s" % ("users", "fast msg/s", "slow msg/s",
+                                 "speedup")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        fast = measure(makeGroup(size, True), args.duration)
+        slow = measure(makeGroup(size, False), args.duration)
+        print "%8d %14.1f %14.1f %7.1fx" % (size, fast, slow, fast / slow)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#! /usr/bin/env python2.7
+"""
+Compares the latency of cross-node deliveries over the node mesh with
+that of deliveries through NSQ.
+
+Two nodes run in this process. The first one publishes messages to the
+inbox of the second one, which records how long each message took to
+arrive. The mesh runs over localhost TCP; the NSQ run only happens when
+nsqd and lookupd addresses are given.
+
+    python scripts/benchmarks/mesh_latency.py -n 10000 \\
+        --nsqd 127.0.0.1:4150 --lookupd 127.0.0.1:4161
+"""
+import argparse
+import time
+
+from twisted.internet import defer, reactor, task
+
+from ircdd.mesh import MeshTransport
+from ircdd.metrics import Metrics
+from ircdd.remote import RemoteReadWriter
+from ircdd.routing import inboxTopic
+
+
+class StaticAddresses(object):
+    """
+    Stands in for the nodes table, with fixed mesh addresses.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+
+    def lookupNodeAddress(self, node):
+        return defer.succeed(self.addresses.get(node))
+
+
+class NullTransport(object):
+    """
+    A fallback which drops every message, so that only the deliveries
+    made over the mesh are measured.
+    """
+
+    def subscribe(self, topic, callback):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+    def publish(self, topic, msg_body, callback=None, recipient=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(name, latencies, count):
+    if not latencies:
+        print "%-5s no message delivered" % name
+        return
+
+    print ("%-5s delivered %d/%d  p50 %.3fms  p95 %.3fms  p99 %.3fms  "
+           "max %.3fms" % (name, len(latencies), count,
+                           percentile(latencies, 50) * 1000,
+                           percentile(latencies, 95) * 1000,
+                           percentile(latencies, 99) * 1000,
+                           max(latencies) * 1000))
+
+
+@defer.inlineCallbacks
+def measure(sender, receiver, count, interval, warmup):
+    """
+    Publishes `count` timestamped messages from the sender to the
+    receiver's inbox, `interval` seconds apart, and returns the
+    latencies of those which arrived.
+    """
+    latencies = []
+    topic = inboxTopic("node2")
+
+    def received(message):
+        sent = message.parsed_msg["msg_body"]["sent"]
+        if sent is not None:
+            latencies.append(time.time() - sent)
+        message.finish()
+        return True
+
+    receiver.subscribe(topic, received)
+
+    # Lets the connections and readers come up before measuring.
+    for _ in range(warmup):
+        sender.publish(topic, {"type": "privmsg", "sent": None},
+                       recipient="bench")
+        yield task.deferLater(reactor, 0.1, lambda: None)
+
+    for _ in range(count):
+        sender.publish(topic, {"type": "privmsg", "sent": time.time()},
+                       recipient="bench")
+        sender.flush()
+        yield task.deferLater(reactor, interval, lambda: None)
+
+    yield task.deferLater(reactor, 1.0, lambda: None)
+    receiver.unsubscribe(topic)
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def main(args):
+    metrics = Metrics()
+    addresses = StaticAddresses({"node2": "127.0.0.1:%d" % args.port})
+
+    receiver = MeshTransport(NullTransport(), addresses, "node2", metrics)
+    listener = reactor.listenTCP(args.port, receiver.serverFactory(),
+                                 interface="127.0.0.1")
+    sender = MeshTransport(NullTransport(), addresses, "node1", metrics)
+
+    latencies = yield measure(sender, receiver, args.count, args.interval,
+                              args.warmup)
+    report("mesh", latencies, args.count)
+
+    yield sender.close()
+    yield listener.stopListening()
+
+    if args.nsqd and args.lookupd:
+        sender = RemoteReadWriter(args.nsqd, args.lookupd, "node1")
+        receiver = RemoteReadWriter(args.nsqd, args.lookupd, "node2")
+
+        latencies = yield measure(sender, receiver, args.count,
+                                  args.interval, args.warmup)
+        report("nsq", latencies, args.count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--count", type=int, default=1000,
+                        help="number of messages to measure")
+    parser.add_argument("--interval", type=float, default=0.001,
+                        help="seconds between two messages")
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="number of unmeasured messages sent first")
+    parser.add_argument("--port", type=int, default=5899,
+                        help="port of the receiving node's mesh listener")
+    parser.add_argument("--nsqd", action="append", default=[],
+                        help="nsqd TCP address, may be repeated")
+    parser.add_argument("--lookupd", action="append", default=[],
+                        help="lookupd HTTP address, may be repeated")
+    args = parser.parse_args()
+
+    if args.nsqd and args.lookupd:
+        # The NSQ clients have to run on the reactor as well.
+        from tornado.platform.twisted import TwistedIOLoop
+        TwistedIOLoop().install()
+
+    def run():
+        d = main(args)
+        d.addErrback(lambda err: err.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -9,9 +9,14 @@ from twisted.application.service import IServiceMaker
 import ircdd.server as ircdd_server
 from ircdd import context
 
+import rethinkdb as r
+
 from tornado.platform.twisted import TwistedIOLoop
 TwistedIOLoop().install()
 
+# Run all RethinkDB queries on the reactor instead of blocking it.
+r.set_loop_type("twisted")
+
 logging.basicConfig()
 observer = log.PythonLoggingObserver()
 observer.start()
@@ -26,13 +31,105 @@ class Options(usage.Options, strcred.AuthOptionMixin):
         ["db", "D", "ircdd", "Name of the database holding cluster data."],
         ["rdb_port", "", 28015, "Database port for client connections."],
         ["rdb_host", "", "localhost", "Database host."],
+        ["rdb_pool_size", "", 10, "Maximum number of query connections."],
+        ["rdb_feed_connections", "", 4,
+         "Maximum number of connections carrying changefeeds."],
+        ["rdb_idle_timeout", "", 60.0,
+         "Seconds after which idle database connections are closed."],
+        ["rdb_ping_interval", "", 30.0,
+         "Seconds between database connection liveness checks."],
+        ["heartbeat_interval", "", 10.0,
+         "Seconds between renewals of this node's presence lease."],
+        ["lease_timeout", "", 30.0,
+         "Seconds after which a node that stopped renewing its lease "
+         "is considered dead."],
+        ["cache_size", "", 10000,
+         "Maximum number of users, sessions and groups cached each."],
+        ["cache_ttl", "", 30.0,
+         "Seconds for which users and groups stay cached."],
+        ["cache_session_ttl", "", 5.0,
+         "Seconds for which user sessions stay cached."],
+        ["cache_negative_ttl", "", 5.0,
+         "Seconds for which missing users and groups stay cached."],
+        ["group_idle_timeout", "", 300.0,
+         "Seconds after which a channel without local users is dropped "
+         "from memory, 0 keeps channels forever."],
+        ["max_local_groups", "", 10000,
+         "Number of channels in memory over which those without local "
+         "users are dropped early."],
+        ["group_size_reconcile_interval", "", 300.0,
+         "Seconds between corrections of the channel member counts, 0 "
+         "disables them."],
+        ["large_group_threshold", "", 1000,
+         "Number of members from which the joins and parts of a channel "
+         "are batched, 0 never batches them."],
+        ["large_group_batch_window", "", 1.0,
+         "Seconds during which the joins and parts of a large channel are "
+         "collected."],
+        ["large_group_idle_timeout", "", 0.0,
+         "Seconds of silence after which a user of a large channel no "
+         "longer sees its joins and parts, 0 always shows them."],
+        ["list_page_size", "", 100,
+         "Number of channels fetched at once when answering LIST."],
+        ["list_snapshot_interval", "", 30.0,
+         "Seconds between rebuilds of the LIST snapshot, 0 disables it."],
+        ["list_max_age", "", 60.0,
+         "Seconds after which the LIST snapshot is too stale to serve."],
+        ["message_routing", "", "topic",
+         "How messages reach other nodes: 'topic' publishes to one topic "
+         "per user and group, 'node' to one inbox topic per node."],
+        ["nsq_batch_window", "", 0.0,
+         "Seconds for which published messages are batched into a single "
+         "MPUB, 0 disables batching."],
+        ["nsq_batch_size", "", 100,
+         "Number of buffered messages which triggers an MPUB."],
+        ["nsq_envelope", "", "json",
+         "Envelope of published messages, 'json' or 'binary'. Enable "
+         "'binary' once every node of the cluster can read it."],
+        ["nsq_unsubscribe_grace", "", 10.0,
+         "Seconds for which an unused NSQ reader is kept open."],
+        ["nsq_channel_sweep_interval", "", 600.0,
+         "Seconds between two deletions of the NSQ channels of expired "
+         "nodes, 0 to disable them. Each node also deletes the channel "
+         "named after itself which versions before the 'ircdd.' channel "
+         "prefix read from; those of nodes which are never restarted "
+         "must be deleted by hand."],
+        ["nsq_topic_sweep_interval", "", 3600.0,
+         "Seconds between two deletions of unused NSQ topics, "
+         "0 to disable them."],
+        ["nsq_topic_retention", "", 86400.0,
+         "Seconds for which a topic must stay unused to be deleted."],
+        ["nsq_topic_sweep_limit", "", 100,
+         "Maximum number of topics deleted at once."],
+        ["nsq_max_in_flight", "", 100,
+         "Highest number of in-flight messages per NSQ reader, which is "
+         "adapted to the load below it. 0 keeps pynsq's fixed default."],
+        ["nsq_in_flight_limits", "", None,
+         "Per-topic highest in-flight limits, as "
+         "'pattern=limit,pattern=limit' with shell-style patterns."],
+        ["max_reactor_lag", "", 0.1,
+         "Reactor lag, in seconds, over which NSQ messages are requeued "
+         "with backoff instead of being handled."],
+        ["message_transport", "", "nsq",
+         "Transport of the messages between nodes, 'nsq', 'mesh' or "
+         "'loopback'. 'mesh' connects the nodes directly, falling back "
+         "to NSQ, and 'loopback' only reaches the nodes of this process."],
+        ["mesh_host", "", None,
+         "Host on which other nodes reach this node's mesh listener. "
+         "Defaults to the hostname."],
+        ["mesh_port", "", 5800, "Port of the mesh listener."],
+        ["mesh_connect_timeout", "", 1.0,
+         "Seconds to wait for a connection to a mesh peer."],
         ["config", "C", None, "Configuration file."]
         ]
 
     optFlags = [["ssl", "S", "Use ssl."],
                 ["verbose", "V", "Log verbose output."],
                 ["group_on_request", "G", "Create groups on request."],
-                ["user_on_request", "U", "Create users on request."]]
+                ["user_on_request", "U", "Create users on request."],
+                ["nsq_ephemeral_channels", "",
+                 "Read from ephemeral NSQ channels, which are dropped "
+                 "along with their backlog when this node goes away."]]
 
     def __init__(self):
         usage.Options.__init__(self)